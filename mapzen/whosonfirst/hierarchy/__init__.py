@@ -1,12 +1,23 @@
 import os
+import copy
+import json
+import time
 import logging
-import deepdiff
-import pprint
 
 import mapzen.whosonfirst.utils
 import mapzen.whosonfirst.export
 import mapzen.whosonfirst.placetypes
 
+import mapzen.whosonfirst.hierarchy.cache
+import mapzen.whosonfirst.hierarchy.coverage
+import mapzen.whosonfirst.hierarchy.geometry
+import mapzen.whosonfirst.hierarchy.journal
+import mapzen.whosonfirst.hierarchy.pool
+import mapzen.whosonfirst.hierarchy.pipeline
+import mapzen.whosonfirst.hierarchy.rebuilt
+import mapzen.whosonfirst.hierarchy.stats
+import mapzen.whosonfirst.hierarchy.writer
+
 class ancestors:
 
     def __init__(self, **kwargs):
@@ -26,13 +37,110 @@ class ancestors:
         
         self.to_skip = [ "address", "building" ]
 
+        # the properties a feature returned by the spatial client needs to have
+        # in order to rebuild its hierarchy without loading it from disk (see
+        # also: rebuild_descendant and the 'use_spatial_feature' argument)
+
+        self.required_properties = kwargs.get("required_properties", [
+            "wof:id", "wof:placetype", "wof:repo", "wof:parent_id", "wof:hierarchy", "geom:latitude", "geom:longitude"
+        ])
+
+        # if true then ask the spatial client for all the candidate parent (and
+        # ancestor) placetypes for a given coordinate in a single point-in-polygon
+        # query and sort out which one wins in Python, rather than issuing one
+        # query per placetype. this requires that the spatial client understand
+        # a list of values for the 'wof:placetype_id' filter, which it says by
+        # having a 'supports_placetype_lists' attribute which is true; if it
+        # doesn't then we go back to one query per placetype (see also:
+        # batch_supported)
+
+        self.batch = kwargs.get("batch", False)
+
+        if self.batch and self.spatial_client != None and not self.batch_supported(self.spatial_client):
+            logging.warning("spatial client does not support lists of placetypes, looking up one placetype at a time")
+
+        # an optional mapzen.whosonfirst.hierarchy.cache.pip_cache instance
+        # (or True to use one with the default settings) for remembering
+        # point-in-polygon results. it is invalidated by self.index_feature
+
+        self.cache = kwargs.get("cache", None)
+
+        if self.cache == True:
+            self.cache = mapzen.whosonfirst.hierarchy.cache.pip_cache()
+
+        # an optional mapzen.whosonfirst.hierarchy.index.hierarchy_index instance
+        # for finding descendants by ancestry rather than geometry (see also: the
+        # 'descendants_from' argument to rebuild_descendants). it is updated
+        # whenever rebuild_and_export writes something to disk
+
+        self.index = kwargs.get("index", None)
+
+        # an optional mapzen.whosonfirst.hierarchy.coverage.coverage instance
+        # for skipping point-in-polygon queries for placetypes that don't have
+        # any places at a given point. it is updated by self.index_feature
+
+        self.coverage = kwargs.get("coverage", None)
+
+        # an optional mapzen.whosonfirst.hierarchy.stats.stats instance (or True
+        # to create one) for counting and timing things (see also: timer)
+
+        self.stats = kwargs.get("stats", None)
+
+        if self.stats == True:
+            self.stats = mapzen.whosonfirst.hierarchy.stats.stats()
+
+        self.null_timer = mapzen.whosonfirst.hierarchy.stats.null_timer()
+
+        # the IDs of records that have been deleted (see also: remove_feature)
+        # which are never a parent, or a descendant, of anything even if the
+        # spatial client still knows about them
+
+        self.removed = kwargs.get("removed", set())
+
+        # the only properties of a possible parent (or ancestor) that we ever
+        # look at. if the spatial client says it can return just these (rather
+        # than whole features, with big polygons, that are immediately thrown
+        # away) then it is asked to. set 'properties_only' to false to always
+        # ask for whole features (see also: properties_only)
+
+        self.properties_only = kwargs.get("properties_only", True)
+
+        # it's on by default so only complain if someone asked for it
+
+        if kwargs.get("properties_only", False) and self.spatial_client != None and getattr(self.spatial_client, "supports_properties", False) != True:
+            logging.warning("spatial client does not support returning properties only, fetching whole features")
+
+        self.pip_properties = kwargs.get("pip_properties", [
+            "wof:id", "wof:name", "wof:placetype", "wof:placetype_id", "wof:parent_id", "wof:hierarchy"
+        ])
+
     def debug(self, feature, msg):
 
         props = feature["properties"]
         logging.debug("[hierarchy][%s][%s] %s" % (props["wof:id"], props.get("wof:name", "NO NAME"), msg))
 
+    def timer(self, phase):
+
+        # a context manager for timing a phase (see also: stats) which does
+        # nothing at all if there is no stats instance
+
+        if not self.stats:
+            return self.null_timer
+
+        return self.stats.timer(phase)
+
+    def incr(self, name, count=1):
+
+        if self.stats:
+            self.stats.incr(name, count)
+
     def rebuild_feature(self, feature, **kwargs):
 
+        with self.timer("rebuild"):
+            return self._rebuild_feature(feature, **kwargs)
+
+    def _rebuild_feature(self, feature, **kwargs):
+
         props = feature["properties"]
         wofid = props["wof:id"]
 
@@ -88,407 +196,1541 @@ class ancestors:
 
         if old_parent != new_parent:
             logging.info("parent ID has changed for %s" % wofid)
+            self.incr("changed")
             return True
 
-        d = deepdiff.DeepDiff(old_hier, new_hier)
+        # this used to use deepdiff for every feature but all we really need
+        # to know is whether anything has changed so compare a canonical
+        # representation of each hierarchy instead and only bother with
+        # deepdiff (and importing it) when someone is going to see the details
+
+        with self.timer("compare"):
+
+            hier_changed = self.canonical_hierarchy(old_hier) != self.canonical_hierarchy(new_hier)
+
+            if hier_changed and logging.getLogger().isEnabledFor(logging.DEBUG):
+
+                import deepdiff
+                logging.debug(deepdiff.DeepDiff(old_hier, new_hier))
+
+        if hier_changed:
 
-        if len(d.keys()) > 0:
             logging.info("hierarchy has changed for %s" % wofid)
-            logging.debug(d)
+            self.incr("changed")
             return True
 
         logging.info("nothing has changed when rebuilding the hierarchy for %s" % wofid)
+        self.incr("unchanged")
         return False
 
-    def rebuild_descendants(self, feature, cb, **kwargs):
+    def canonical_hierarchy(self, hier):
 
-        self.debug(feature, "rebuild descendants w/ kwargs %s" % kwargs)
+        # dictionary keys are sorted but the order of lists (as in multiple
+        # hierarchies) is preserved, which is the same thing that deepdiff
+        # considers a change; so are types (1 versus 1.0 versus "1")
 
-        props = feature["properties"]
+        return json.dumps(hier, sort_keys=True)
 
-        data_root = kwargs.get("data_root", None)
-        
-        placetypes = kwargs.get("placetypes", None)
-        exclude = kwargs.get("exclude", [])
-        include = kwargs.get("include", [])
+    def rebuild_features(self, features, **kwargs):
 
-        logging.debug("rebuild descendants for %s (%s)" % (props["wof:id"], props.get("wof:name", "NO NAME")))
-        logging.debug("exclude descendants for %s (%s) %s" % (props["wof:id"], props.get("wof:name", "NO NAME"), ";".join(exclude)))
-        logging.debug("include descendants for %s (%s) %s" % (props["wof:id"], props.get("wof:name", "NO NAME"), ";".join(include)))
+        # rebuild the hierarchies for an iterable of features, yielding a
+        # (feature, has_changed) tuple for each one. features are processed
+        # in batches (of 'batch_size') and if the spatial client has a
+        # point_in_polygon_many method then all the points in a batch are
+        # looked up in a single query per placetype, rather than one (or more)
+        # queries per feature. the rules for choosing parents are the same as
+        # rebuild_feature (because that's what ends up being called)
 
-        updated = []
+        batch_size = kwargs.get("batch_size", 1000)
 
-        if placetypes == None:
+        batch = []
 
-            logging.info("lookup descendants for %s" % props['wof:placetype'])
+        for feature in features:
 
-            pt = mapzen.whosonfirst.placetypes.placetype(props['wof:placetype'])
-            placetypes = pt.descendants(['common', 'common_optional', 'optional'])
+            batch.append(feature)
 
-        logging.info(";".join(placetypes))
+            if len(batch) >= batch_size:
 
-        # TO DO: use fancy-pants define placetypes by cli args (include, exclude) code to generate to_skip
+                for rsp in self.rebuild_features_batch(batch, **kwargs):
+                    yield rsp
 
-        to_skip = [
-            'constituency',
-            'address',
-            'building',
-        ]
+                batch = []
 
-        for p in to_skip:
+        if len(batch):
 
-            if not p in exclude:
-                exclude.append(p)
+            for rsp in self.rebuild_features_batch(batch, **kwargs):
+                yield rsp
 
-        for p in placetypes:
+    def rebuild_features_batch(self, features, **kwargs):
 
-            if len(include) and not p in include:
-                continue
+        possible = self.point_in_polygon_features(features, **kwargs)
 
-            if p in exclude:
-                continue
+        for i in range(len(features)):
 
-            logging.info("find intersecting descendants of placetype %s (for %s (%s))" % (p, props["wof:id"], props.get("wof:name", "NO NAME")))
+            feature = features[i]
 
-            _p = mapzen.whosonfirst.placetypes.placetype(p)
-            pid = _p.id()
+            _kwargs = kwargs.copy()
 
-            pg_kwargs = {
-                'filters': {
-                    'wof:placetype_id': pid,
-                    'wof:is_superseded': 0,
-                    'wof:is_deprecated': 0,
-                    'wof:is_ceased': 0
-                },
-                'as_feature': True,
-                'check_centroid': True,
-            }
+            if possible[i] != None:
+                _kwargs["possible"] = possible[i]
 
-            if kwargs.get("buffer", None):
-                pg_kwargs["buffer"] = kwargs.get("buffer")
+            yield feature, self.rebuild_feature(feature, **_kwargs)
 
-            if p == 'venue':
-                pg_kwargs['use_centroid'] = True
+    def point_in_polygon_features(self, features, **kwargs):
 
-            intersects = 0
+        # returns a list (in the same order as features) of dictionaries
+        # mapping placetype -> possible matches, or None for features whose
+        # possible matches should be looked up the usual way
 
-            # TO DO: do these in parallel... translation: my kingdom for Go's
-            # sync.WaitGroup in python... (20161206/thisisaaronland)
+        results = [ None ] * len(features)
 
-            props = feature["properties"]
+        many = getattr(self.spatial_client, "point_in_polygon_many", None)
 
-            self.debug(feature, "find intersecting places where placetype is %s" % p)
+        if not many:
+            logging.debug("spatial client does not support point_in_polygon_many, looking up features one at a time")
+            return results
 
-            for row in self.spatial_client.intersects_paginated(feature, **pg_kwargs):
+        coords = []
+        by_placetype = {}
 
-                intersects += 1
-                
-                logging.info("process intersection %s (%s)" % (row['properties']['wof:id'], row['properties']['wof:placetype']))
+        for i in range(len(features)):
 
-                # load from disk - HOW CAN WE GET RID OF THIS PIECE?
+            feature = features[i]
 
-                props = row['properties']
-                wofid = props['wof:id']
-                repo = props['wof:repo']
-                
-                _data = os.path.join(data_root, repo)
-                _data = os.path.join(_data, "data")
-            
-                child = mapzen.whosonfirst.utils.load(_data, wofid)
+            try:
+                lat, lon = mapzen.whosonfirst.utils.reverse_geocoordinates(feature)
+            except Exception as e:
+                self.debug(feature, "failed to determine coordinates for batched lookup, because %s" % e)
+                coords.append(None)
+                continue
 
-                _kwargs = {
-                    'as_feature': True,
-                    'filters': {
-                        'wof:placetype_id': pid,
-                        'wof:is_superseded': 0,
-                        'wof:is_deprecated': 0,
-                        'wof:is_ceased': 0
-                    }
-                }
+            coords.append((lat, lon))
+            results[i] = {}
 
-                child_changed = self.rebuild_feature(child, **_kwargs)
-                child_props = child["properties"]
+            for p in self.candidate_placetypes(feature, **kwargs):
+                by_placetype.setdefault(p, []).append(i)
 
-                self.debug(child, "rebuilt feature (descendant of %s (%s)) - changes: %s" % (props["wof:id"], props.get("wof:name", "NO NAME"), child_changed))
-                    
-                if child_changed:
+        for p, idx in by_placetype.items():
 
-                    if not cb(child):
-                        logging.error("post-rebuild callback failed for %s" % wofid)
+            _pt = mapzen.whosonfirst.placetypes.placetype(p)
 
-                        if kwargs.get("strict", False):
-                            raise Exception("post-rebuild callback failed for %s" % wofid)
+            # don't ask about points where there can't be anything (see
+            # also: covered_kwargs)
 
-                        continue
+            if self.coverage:
 
-                    if not repo in updated:
-                        updated.append(repo)
-                        
-        return updated
+                covered = []
 
-    def append_parent_and_hierarchy(self, feature, **kwargs):
+                for i in idx:
 
-        if not kwargs.has_key("filters"):
-            kwargs["filters"] = {}
+                    if self.coverage.covers(coords[i][0], coords[i][1], _pt.id()):
+                        covered.append(i)
+                    else:
+                        results[i][p] = []
 
-        props = feature['properties']
+                self.incr("pip.coverage.skip", len(idx) - len(covered))
 
-        self.debug(feature, "append parent and hierarchy")
+                idx = covered
 
-        lat, lon = mapzen.whosonfirst.utils.reverse_geocoordinates(feature)
+                if len(idx) == 0:
+                    continue
 
-        logging.debug("reverse geocoordinates for %s: %s, %s" % (feature['properties']['wof:id'], lat, lon))
+            _kwargs = {
+                'filters': {
+                    'wof:placetype_id' :  _pt.id(),
+                    'wof:is_superseded': 0,
+                    'wof:is_deprecated': 0,
+                    'wof:is_ceased': 0
+                } ,
+                'as_feature': True,
+            }
 
-        # get the list of possible parents for this feature, filtering out
-        # some things we know aren't going concerns right now
+            self.incr("pip_many.%s" % _kwargs["filters"]["wof:placetype_id"])
 
-        pt = mapzen.whosonfirst.placetypes.placetype(props['wof:placetype'])
+            _kwargs, lean = self.pip_kwargs(self.spatial_client, **_kwargs)
 
-        parents = []
+            with self.timer("pip_many"):
+                possible = many([ coords[i] for i in idx ], **_kwargs)
 
-        for p in list(pt.parents()):
+            if lean:
+                possible = [ self.as_features(rows) for rows in possible ]
 
-            if str(p) in self.to_skip:
-                self.debug(feature, "skip point in polygon for %s (%s)" % (str(p), ";".join(self.to_skip)))
-                continue
+            possible = [ self.without_removed(rows) for rows in possible ]
 
-            parents.append(p)
+            logging.debug("point in polygon (many) for %s points with placetype %s" % (len(idx), p))
 
-        append = False
+            for j in range(len(idx)):
+                results[ idx[j] ][ p ] = possible[j]
 
-        str_parents = ";".join(map(str, parents))
-        self.debug(feature, "POSSIBLE reverse parents : %s for %s" % (str_parents, pt))
+        return results
 
-        # this is the meat of it - start looping through possible parents and see if there's
-        # a match - be sure to append the hierarchies for any match
+    def rebuild_descendants(self, feature, cb, **kwargs):
 
-        if len(parents) == 0:
-            logging.debug("feature placetype (%s) has no parents" % str(pt))
+        return self.rebuild_descendants_many([ feature ], cb, **kwargs)
 
-        for p in parents:
+    def rebuild_descendants_many(self, features, cb, **kwargs):
 
-            kwargs['filters']['wof:placetype_id'] = p.id()
-            kwargs['filters']['wof:is_superseded'] = 0
-            kwargs['filters']['wof:is_deprecated'] = 0
-            kwargs['filters']['wof:is_ceased'] = 0
-            kwargs['as_feature'] = True
+        updated = []
 
-            possible = list(self.spatial_client.point_in_polygon(lat, lon, **kwargs))
+        # see notes in iter_rebuild_descendants_many
 
-            logging.debug("FIND parent (%s) for %s, %s : %s" % (p, lat, lon, len(possible)))
+        results = self.iter_rebuild_descendants_many(features, **kwargs)
 
-            if self.append_possible_hierarchies(feature, possible, set_parentid=True):
-                append = True
-                break
+        try:
 
-        # okay - here is a bunch of special-case code to ensure that localities parented by multiple counties
-        # don't clone that information too far down the stack, like to say neighbourhoods or boroughs which
-        # should only have a single county in their hierarchy.
+            for rsp in results:
 
-        if append and props['wof:placetype'] in ("borough", "macrohood", "neighbourhood"):
-            
-            if len(feature["properties"]["wof:hierarchy"]) > 1:
+                if not rsp["changed"]:
+                    continue
 
-                counties = []
+                child = rsp["feature"]
+                wofid = rsp["wof:id"]
+                repo = rsp["wof:repo"]
 
-                for hier in feature["properties"]["wof:hierarchy"]:
+                if not cb(child):
+                    logging.error("post-rebuild callback failed for %s" % wofid)
 
-                    c = hier.get("county_id", None)
+                    if kwargs.get("strict", False):
+                        raise Exception("post-rebuild callback failed for %s" % wofid)
 
-                    if c and not c in counties:
-                        counties.append(c)
+                    # so that it isn't recorded as done (see also: the
+                    # 'journal' argument to iter_rebuild_descendants_many)
 
-                if len(counties) > 1:
+                    rsp["error"] = "post-rebuild callback failed"
+                    continue
 
-                    pt = mapzen.whosonfirst.placetypes.placetype("county")
+                if not repo in updated:
+                    updated.append(repo)
 
-                    kwargs = {
-                        'filters': {
-                            'wof:placetype_id' :  pt.id(),
-                            'wof:is_superseded': 0,
-                            'wof:is_deprecated': 0,
-                            'wof:is_ceased': 0
-                        } ,
-                        'as_feature': True,
-                    }
-
-                    possible = list(self.spatial_client.point_in_polygon(lat, lon, **kwargs))
-                    new_hier = []
+        finally:
+            results.close()
 
-                    if len(possible) > 0:
-                    
-                        valid = []
+        return updated
 
-                        for f in possible:
-                            valid.append(f["properties"]["wof:id"])
+    def iter_rebuild_descendants(self, feature, **kwargs):
 
-                        for hier in feature["properties"]["wof:hierarchy"]:
-                    
-                            c = hier.get("county_id", None)
+        # yield a dictionary for each descendant of feature as its hierarchy
+        # is rebuilt (see also: rebuild_descendant_record). nothing is exported
+        # or indexed; that's up to whoever is consuming the results. things
+        # are only fetched and rebuilt as fast as they are consumed (plus
+        # whatever is in flight in a pool of workers) so memory stays flat
+        # and it's fine to stop early.
 
-                            if c == None or c in valid:
-                                new_hier.append(hier)
-                                
+        return self.iter_rebuild_descendants_many([ feature ], **kwargs)
 
-                        feature["properties"]["wof:hierarchy"] = new_hier
+    def iter_rebuild_descendants_many(self, features, **kwargs):
 
-        # see this - we ensure the hierarchy by default
+        # the same as iter_rebuild_descendants but for the descendants of
+        # lots of places at once - for example a batch of neighbourhoods in
+        # the same city that have all been edited. a descendant that is
+        # inside more than one of features is only rebuilt (and yielded)
+        # once and none of features are treated as descendants of one
+        # another; it's assumed that they have already been rebuilt (see
+        # also: rebuild_and_export_many)
 
-        self.debug(feature, "append: %s ensure_hierarchy: %s" % (append, kwargs.get("ensure_hierarchy", True)))
+        exclude = kwargs.get("exclude", [])
+        include = kwargs.get("include", [])
 
-        if not append and kwargs.get("ensure_hierarchy", True):
+        for feature in features:
+
+            self.debug(feature, "rebuild descendants w/ kwargs %s" % kwargs)
 
             props = feature["properties"]
-            match = self.ensure_hierarchy(feature, **kwargs)
 
-            self.debug(feature, "no append but ensure hierarchy - matches: %s" % match)
+            logging.debug("rebuild descendants for %s (%s)" % (props["wof:id"], props.get("wof:name", "NO NAME")))
+            logging.debug("exclude descendants for %s (%s) %s" % (props["wof:id"], props.get("wof:name", "NO NAME"), ";".join(exclude)))
+            logging.debug("include descendants for %s (%s) %s" % (props["wof:id"], props.get("wof:name", "NO NAME"), ";".join(include)))
 
-        # ensure common properties and ancestors are always present
+        placetypes = self.descendant_placetypes_many(features, **kwargs)
 
-        props = feature["properties"]
-        parent_id = props.get("wof:parent_id", None)
+        # the 'placetypes' argument (if there was one) has been dealt with
+        # and would otherwise get in the way of descendant_rows
 
-        if not parent_id:
+        kwargs.pop("placetypes", None)
 
-            logging.warning("WOF ID %s (%s) is missing a wof:parent_id property" % (props["wof:id"], props.get("wof:name", "NO NAME")))
+        # if true then descendants are processed strictly from the top down
+        # (by the number of ancestors each placetype has) and everything that
+        # is rebuilt along the way is kept in memory so that its descendants
+        # are resolved against the new version of things rather than whatever
+        # the spatial client has, which might not have been re-indexed yet
+        # (see also: mapzen.whosonfirst.hierarchy.rebuilt)
 
-            parent_id = -1
-            props["wof:parent_id"] = parent_id
+        top_down = kwargs.get("top_down", False)
 
-        # find the things that are ancestors of this placetype and
-        # ensure that they are in the hierarchy
+        if top_down:
 
-        pt = props["wof:placetype"]
-        pt = mapzen.whosonfirst.placetypes.placetype(pt)
+            placetypes = sorted(placetypes, key=self.placetype_depth)
 
-        # see what's happening? we're making a list of strings
+            # if 'resolve_locally' is true then some point-in-polygon lookups
+            # are answered with the places rebuilt so far, which only works if
+            # all the places that overlap features were rebuilt rather than
+            # just the ones whose centroid is inside them (see also:
+            # descendant_query_kwargs)
 
-        common = map(str, pt.ancestors(['common']))
+            resolve_locally = kwargs.get("resolve_locally", False)
 
-        self.debug(feature, "ensure common ancestors (is a %s) : %s" % (pt, ";".join(common)))
+            if resolve_locally and (kwargs.get("descendants_from", "spatial") != "spatial" or kwargs.get("query_geometry", None) in ("tiles", "bbox")):
+                logging.warning("'resolve_locally' only works when descendants are found by intersecting the geometry of features, asking the spatial client instead")
+                resolve_locally = False
 
-        for h in feature['properties']['wof:hierarchy']:
+            kwargs["rebuilt"] = mapzen.whosonfirst.hierarchy.rebuilt.rebuilt(features, placetypes, resolve_locally=resolve_locally)
 
-            for p in common:
+        # descendants are processed one placetype at a time, in order, so that
+        # everything of one placetype has been rebuilt (and flushed) before
+        # anything that might be its descendant
 
-                k = "%s_id" % p
+        groups = [ [ p ] for p in placetypes ]
 
-                if not h.has_key(k):
-                    self.debug(feature, "set %s to -1" % k)
-                    h[k] = -1
+        # an optional mapzen.whosonfirst.hierarchy.journal.journal instance
+        # for recording progress and skipping anything that was done by a
+        # previous run (see also: the 'journal' argument to rebuild_and_export)
 
-        # final check...
+        journal = kwargs.get("journal", None)
 
-        if len(feature['properties']['wof:hierarchy']) == 0:
+        # if true then the intersects queries for every placetype are started
+        # at the same time (in separate threads), each one buffering up to
+        # 'maxsize' rows, but rows are still processed one placetype after
+        # another as above. as with thread pools the spatial client needs to
+        # be thread-safe unless a 'client_factory' argument is present (see
+        # also: mapzen.whosonfirst.hierarchy.pool)
 
-            pt_key = "%s_id" % props["wof:placetype"]
-            pt_id = props["wof:id"]
+        prefetched = {}
 
-            hier = {
-                pt_key: pt_id
-            }
+        if kwargs.get("concurrent_placetypes", False) and len(groups) > 1:
 
-            for p in common:
+            factory = kwargs.get("client_factory", None)
 
-                pt_key = "%s_id" % p
-                pt_id = -1
-                hier[ pt_key ] = pt_id
+            logging.info("find intersecting descendants for %s placetypes concurrently" % len(groups))
 
-            feature['properties']['wof:hierarchy'] = [ hier ]
+            for group in groups:
 
-    def ensure_hierarchy(self, feature, **kwargs):
+                if journal and journal.is_complete(group):
+                    continue
 
-        props = feature["properties"]
+                _kwargs = kwargs
 
-        logging.debug("ensure hierarchy for %s (%s)" % (props["wof:id"], props.get("wof:name", "NO NAME")))
+                if factory:
+                    _kwargs = dict(kwargs)
+                    _kwargs["spatial_client"] = factory()
 
-        roles = kwargs.get("roles", [ "common", "common_optional", "optional" ] )
+                rows = self.descendant_rows_many(features, group, **_kwargs)
+                prefetched[ group[0] ] = mapzen.whosonfirst.hierarchy.pipeline.prefetch(rows, maxsize=kwargs.get("maxsize", 1000))
 
-        if int(props.get("wof:parent_id", 0)) > 0:
-            logging.debug("no point in ensuring hierarchy for %s (%s): parent ID > 0 (%s)" % (props["wof:id"], props.get("wof:name", "NO NAME"), props.get("wof:parent_id", 0)))
-            return True
+        try:
 
-        if len(props.get("wof:hierarchy", [])) > 1:
-            logging.debug("not point in ensuring hierarchy for %s (%s): multiple hierarchies" % (props["wof:id"], props.get("wof:name", "NO NAME")))
-            return True
-            
-        lat, lon = mapzen.whosonfirst.utils.reverse_geocoordinates(feature)
+            for rsp in self._iter_rebuild_descendant_groups(features, groups, prefetched, **kwargs):
+                yield rsp
 
-        pt = mapzen.whosonfirst.placetypes.placetype(props["wof:placetype"])
+        finally:
 
-        match = False
+            # anything that was fetched but never got used because we
+            # stopped early
 
-        # build on the existing to_skip list and append possible parents
-        # because if we've gotten here then we're just going to assume
-        # that they've all failed and we're looking for something higher
-        # up the stack
+            for rows in prefetched.values():
+                rows.close()
 
-        # see this we're building a new array rather than assigning self.to_skip
-        # to a left-hand value since python will treat it as a reference and
-        # eventually self.to_skip will be full of all kinds of stuff that any
-        # kind of meaningful processing will be impossible... computers.
-        # (20170512/thisisaaronland)
+    def _iter_rebuild_descendant_groups(self, features, groups, prefetched, **kwargs):
 
-        to_skip = []
+        # see also: iter_rebuild_descendants_many
 
-        for p in self.to_skip:
-            to_skip.append(p)
+        # if workers > 1 then descendants are loaded and rebuilt by a pool
+        # of threads (or processes) but results are always yielded here,
+        # one feature at a time, so whoever is consuming them (for example
+        # the callback in rebuild_descendants) doesn't need to worry about
+        # being thread-safe - see also: mapzen.whosonfirst.hierarchy.pool
 
-        for p in list(pt.parents()):
-            
-            p = str(p)
+        workers = kwargs.get("workers", 1)
 
-            if not p in to_skip:
-                to_skip.append(p)
+        # an optional function to call once all the descendants of a given
+        # placetype have been processed - for example to make sure that their
+        # changes are visible to the spatial client before their own descendants
+        # are rebuilt (see also: rebuild_and_export)
 
-        self.debug(feature, "update to skip list to be : %s (%s)" % (";".join(to_skip), ";".join(self.to_skip)))
+        flush = kwargs.get("flush", None)
 
-        # go!
+        journal = kwargs.get("journal", None)
+        rebuilt = kwargs.get("rebuilt", None)
 
-        for p in pt.ancestors(roles):
+        for group in groups:
 
-            if str(p) in to_skip:
+            if journal and journal.is_complete(group):
+                logging.info("skip %s, already completed according to journal" % ";".join(group))
                 continue
 
-            logging.debug("try to ensure hierarchy for %s with placetype %s" % (props["wof:id"], p))
+            rows = prefetched.pop(group[0], None)
 
-            _pt = mapzen.whosonfirst.placetypes.placetype(p)
+            if rows == None:
+                rows = self.descendant_rows_many(features, group, **kwargs)
 
-            kwargs = {
-                'filters': {
-                    'wof:placetype_id' :  _pt.id(),
-                    'wof:is_superseded': 0,
-                    'wof:is_deprecated': 0,
-                    'wof:is_ceased': 0
-                } ,
-                'as_feature': True,
-            }
+            source = rows
 
-            possible = list(self.spatial_client.point_in_polygon(lat, lon, **kwargs))
+            # if some of these were done by a previous run then we don't
+            # know about all of them, so don't pretend otherwise
 
-            logging.debug("ensure hierarchy for %s with placetype %s : %s possible" % (props["wof:id"], p, len(possible)))
+            partial = journal and len(journal.processed) > 0
 
-            if self.append_possible_hierarchies(feature, possible):
+            if journal:
+                rows = journal.filter(rows, group)
 
-                if len(feature["properties"]["wof:hierarchy"]) >= 1:
+            if workers and workers > 1:
+                results = mapzen.whosonfirst.hierarchy.pool.rebuild_descendants(self, rows, **kwargs)
+            else:
+                results = self.rebuild_descendant_rows(rows, **kwargs)
 
-                    logging.debug("successfully ensured hierarchy for %s with placetype %s" % (props["wof:id"], p))
-                    match = True
-                    break
+            try:
 
-                logging.warning("possible ancestor had no hierarchy")
+                for rsp in results:
 
-        # make sure that feature is always present in wof:hierarchy
-        # no matter what (20170824/thisisaaronland)
+                    if rebuilt:
+                        rebuilt.add(rsp["feature"])
 
-        if not match:
+                    yield rsp
 
-            wofid = props["wof:id"]
-            hiers = props["wof:hierarchy"]
+                    # things are only recorded in the journal once they've been
+                    # flushed, which means flushing a little more often than we
+                    # might otherwise. if whoever is consuming results couldn't
+                    # deal with one (say because the callback in
+                    # rebuild_descendants failed) they set its 'error' key and
+                    # it's left to be tried again by the next run
 
-            pt_k = "%s_id" % props["wof:placetype"]
+                    if journal:
 
-            if len(hiers) == 0:
+                        if rsp.get("error", None):
+                            journal.failed(rsp["wof:id"])
+                        else:
+                            journal.record(rsp)
+
+                        if journal.should_checkpoint():
+
+                            if flush:
+                                flush()
+
+                            journal.checkpoint(group)
+
+            finally:
+
+                results.close()
+
+                # make sure that anything fetching rows in the background
+                # (see also: the 'readahead' and 'concurrent_placetypes'
+                # arguments) stops now rather than whenever rows is garbage
+                # collected
+
+                for r in (rows, source):
+
+                    close = getattr(r, "close", None)
+
+                    if close:
+                        close()
+
+            # because this is a generator we only get here once everything
+            # yielded above has been dealt with
+
+            if flush:
+                flush()
+
+            if journal:
+                journal.complete(group)
+
+            if rebuilt and not partial:
+                rebuilt.complete(group)
+
+    def descendant_placetypes(self, feature, **kwargs):
+
+        props = feature["properties"]
+
+        placetypes = kwargs.get("placetypes", None)
+        exclude = kwargs.get("exclude", [])
+        include = kwargs.get("include", [])
+
+        if placetypes == None:
+
+            logging.info("lookup descendants for %s" % props['wof:placetype'])
+
+            pt = mapzen.whosonfirst.placetypes.placetype(props['wof:placetype'])
+            placetypes = pt.descendants(['common', 'common_optional', 'optional'])
+
+        logging.info(";".join(placetypes))
+
+        # TO DO: use fancy-pants define placetypes by cli args (include, exclude) code to generate to_skip
+
+        to_skip = [
+            'constituency',
+            'address',
+            'building',
+        ]
+
+        for p in to_skip:
+
+            if not p in exclude:
+                exclude.append(p)
+
+        descendants = []
+
+        for p in placetypes:
+
+            if len(include) and not p in include:
+                continue
+
+            if p in exclude:
+                continue
+
+            descendants.append(p)
+
+        return descendants
+
+    def descendant_placetypes_many(self, features, **kwargs):
+
+        # all the descendant placetypes for all of features, from the top
+        # down (so that parents are always rebuilt before their children)
+
+        if len(features) == 1:
+            return self.descendant_placetypes(features[0], **kwargs)
+
+        placetypes = []
+
+        for feature in features:
+
+            for p in self.descendant_placetypes(feature, **kwargs):
+
+                if not p in placetypes:
+                    placetypes.append(p)
+
+        return sorted(placetypes, key=self.placetype_depth)
+
+    def placetype_depth(self, p):
+
+        pt = mapzen.whosonfirst.placetypes.placetype(p)
+        return len(list(pt.ancestors(['common', 'common_optional', 'optional'])))
+
+    def descendant_rows_many(self, features, placetypes, **kwargs):
+
+        # yield (placetype ID, row) tuples for all the places that intersect
+        # any of features, for each of placetypes, but only once per place
+        # and never for features themselves
+
+        if len(features) == 1:
+
+            for pid, row in self.descendant_rows(features[0], placetypes, **kwargs):
+                yield pid, row
+
+            return
+
+        seen = set()
+
+        for feature in features:
+            seen.add(feature["properties"]["wof:id"])
+
+        duplicates = 0
+
+        for feature in features:
+
+            for pid, row in self.descendant_rows(feature, placetypes, **kwargs):
+
+                wofid = row["properties"]["wof:id"]
+
+                if wofid in seen:
+                    duplicates += 1
+                    continue
+
+                seen.add(wofid)
+                yield pid, row
+
+        self.incr("descendants.duplicate", duplicates)
+
+        if duplicates:
+            logging.info("skipped %s descendants (%s) that were found more than once" % (duplicates, ";".join(map(str, placetypes))))
+
+    def descendant_rows(self, feature, placetypes, **kwargs):
+
+        # yield (placetype ID, row) tuples for all the places that intersect
+        # feature for each of placetypes (see also: descendant_placetypes)
+
+        for p in placetypes:
+
+            for pid, row in self.descendant_rows_for_placetype(feature, p, **kwargs):
+
+                if row["properties"]["wof:id"] in self.removed:
+                    continue
+
+                yield pid, row
+
+    def descendant_rows_for_placetype(self, feature, p, **kwargs):
+
+        # descendants are found by asking the spatial client for things that
+        # intersect feature ("spatial"), by asking the hierarchy index for
+        # things that have feature in their hierarchy ("index") or both, in
+        # which case anything that the index knows about that the spatial
+        # client didn't return is yielded last
+
+        descendants_from = kwargs.get("descendants_from", "spatial")
+
+        if not descendants_from in ("spatial", "index", "both"):
+            raise Exception("Unsupported descendants_from value '%s'" % descendants_from)
+
+        if descendants_from != "spatial" and not self.index:
+            raise Exception("You must specify an index to find descendants from '%s'" % descendants_from)
+
+        if descendants_from == "index":
+
+            for pid, row in self.descendant_rows_from_index(feature, p, **kwargs):
+                yield pid, row
+
+            return
+
+        seen = set()
+
+        for pid, row in self.descendant_rows_from_spatial(feature, p, **kwargs):
+
+            if descendants_from == "both":
+                seen.add(row["properties"]["wof:id"])
+
+            yield pid, row
+
+        if descendants_from == "both":
+
+            for pid, row in self.descendant_rows_from_index(feature, p, **kwargs):
+
+                if row["properties"]["wof:id"] in seen:
+                    continue
+
+                logging.info("process %s (%s) from hierarchy index (not returned by spatial client)" % (row["properties"]["wof:id"], p))
+                yield pid, row
+
+    def descendant_rows_from_index(self, feature, p, **kwargs):
+
+        props = feature["properties"]
+
+        logging.info("find descendants of placetype %s in hierarchy index (for %s (%s))" % (p, props["wof:id"], props.get("wof:name", "NO NAME")))
+
+        _p = mapzen.whosonfirst.placetypes.placetype(p)
+        pid = _p.id()
+
+        # if there is a 'tiles' argument (see also: descendant_rows_from_tiles
+        # and mapzen.whosonfirst.hierarchy.shard) then only the rows that
+        # belong to one of those tiles are wanted, otherwise every job for
+        # every tile would rebuild everything the index knows about. rows the
+        # index doesn't have coordinates for belong to the first tile.
+
+        tiles = kwargs.get("tiles", None)
+        tiling = None
+
+        if tiles != None:
+
+            tiling = kwargs.get("tiling", None)
+
+            if tiling == None:
+
+                geom = feature["geometry"]
+                bbox = feature.get("bbox", None) or mapzen.whosonfirst.hierarchy.geometry.bbox(geom)
+
+                tiling = mapzen.whosonfirst.hierarchy.geometry.tiling(geom, kwargs.get("tile_size", 1.0), bbox=bbox)
+
+            wanted = set(map(tuple, tiles))
+            known = set(tiling.tiles())
+
+        for row in self.index.descendants(props["wof:id"], placetype=str(p)):
+
+            if tiling != None:
+
+                lat, lon = self.row_coordinates(row)
+
+                if lat == None or lon == None:
+                    owner = min(known)
+                else:
+                    owner = self.tile_owner(tiling, known, lat, lon)
+
+                if not owner in wanted:
+                    continue
+
+            yield pid, row
+
+    def descendant_rows_from_spatial(self, feature, p, **kwargs):
+
+        props = feature["properties"]
+        spatial_client = kwargs.get("spatial_client", self.spatial_client)
+
+        logging.info("find intersecting descendants of placetype %s (for %s (%s))" % (p, props["wof:id"], props.get("wof:name", "NO NAME")))
+
+        _p = mapzen.whosonfirst.placetypes.placetype(p)
+        pid = _p.id()
+
+        pg_kwargs = self.descendant_query_kwargs(p, **kwargs)
+
+        self.debug(feature, "find intersecting places where placetype is %s" % p)
+
+        # if 'query_geometry' is 'tiles' or 'bbox' then the spatial client is
+        # asked about (lots of) boxes rather than the geometry for feature,
+        # which can be enormous (see also: descendant_rows_from_tiles)
+
+        # if 'readahead' is more than zero then rows are fetched in the
+        # background, up to that many rows ahead of whoever is consuming
+        # them, so that the spatial client is busy fetching the next page
+        # while the current one is being rebuilt. this isn't necessary if
+        # placetypes are already being fetched concurrently (see also:
+        # descendant_rows)
+
+        readahead = kwargs.get("readahead", 0)
+
+        if kwargs.get("concurrent_placetypes", False):
+            readahead = 0
+
+        if readahead and spatial_client == self.spatial_client and kwargs.get("client_factory", None):
+            spatial_client = kwargs["client_factory"]()
+
+        if kwargs.get("query_geometry", None) in ("tiles", "bbox"):
+            rows = self.descendant_rows_from_tiles(feature, spatial_client, pg_kwargs, **kwargs)
+        else:
+            rows = spatial_client.intersects_paginated(feature, **pg_kwargs)
+
+        if readahead:
+            rows = mapzen.whosonfirst.hierarchy.pipeline.readahead(rows, maxsize=readahead)
+
+        if self.stats:
+            rows = self.timed_rows(rows, "intersects")
+
+        for row in rows:
+
+            logging.info("process intersection %s (%s)" % (row['properties']['wof:id'], row['properties']['wof:placetype']))
+            yield pid, row
+
+    def descendant_rows_from_tiles(self, feature, spatial_client, pg_kwargs, **kwargs):
+
+        # yield the rows that intersects_paginated would have for feature by
+        # asking about a grid of 'tile_size' degree tiles (or just feature's
+        # bounding box) instead and then checking, here, that each row's
+        # centroid is inside feature (or within 'buffer' degrees of it) - which
+        # is what the 'check_centroid' and 'use_centroid' arguments always added
+        # by descendant_query_kwargs mean. each row belongs to the tile its
+        # centroid is in so that rows returned for more than one tile are only
+        # yielded once.
+
+        props = feature["properties"]
+        geom = feature.get("geometry", None)
+
+        if not geom or not geom["type"] in ("Polygon", "MultiPolygon"):
+            logging.debug("can't tile %s geometry for %s, using it as is" % (geom and geom["type"], props["wof:id"]))
+
+            for row in spatial_client.intersects_paginated(feature, **pg_kwargs):
+                yield row
+
+            return
+
+        bbox = feature.get("bbox", None) or mapzen.whosonfirst.hierarchy.geometry.bbox(geom)
+
+        if kwargs.get("query_geometry", None) == "bbox":
+            size = max(bbox[2] - bbox[0], bbox[3] - bbox[1], 0.000001)
+        else:
+            size = kwargs.get("tile_size", 1.0)
+
+        # a 'tiling' argument is a geometry.tiling instance for feature that
+        # has already been worked out (see also: the 'tiles' argument below)
+
+        tiling = kwargs.get("tiling", None)
+
+        if tiling == None:
+            tiling = mapzen.whosonfirst.hierarchy.geometry.tiling(geom, size, bbox=bbox)
+
+        tiles = tiling.tiles()
+
+        # if there is a 'tiles' argument, a list of (i, j) tuples, then only
+        # those tiles are queried (see also: mapzen.whosonfirst.hierarchy.shard)
+
+        if kwargs.get("tiles", None) != None:
+
+            wanted = set(map(tuple, kwargs["tiles"]))
+            tiles = [ t for t in tiles if t in wanted ]
+
+        logging.info("find intersecting descendants for %s (%s) using %s tiles" % (props["wof:id"], props.get("wof:name", "NO NAME"), len(tiles)))
+
+        # each row belongs to exactly one tile, the one its centroid is in, so
+        # that it is only ever yielded once even when the tiles are handed out
+        # to different workers (see also: tile_owner)
+
+        sharded = kwargs.get("tiles", None) != None
+        known = set(tiling.tiles())
+
+        # a 'buffer' means that the spatial client returns things near (as
+        # well as inside) feature so the same goes for the centroid check
+
+        buffer = kwargs.get("buffer", None) or 0.0
+
+        # the IDs of things that might otherwise be yielded twice; that's
+        # rows the spatial client thinks are in a tile that we don't (because
+        # it has a different idea of where their centroid is) and rows we
+        # can't place at all
+
+        seen = set()
+
+        for i, j in tiles:
+
+            b = tiling.tile(i, j)
+
+            tile = {
+                "type": "Feature",
+                "bbox": b,
+                "geometry": mapzen.whosonfirst.hierarchy.geometry.box(b),
+                "properties": {},
+            }
+
+            for row in spatial_client.intersects_paginated(tile, **pg_kwargs):
+
+                wofid = row["properties"]["wof:id"]
+                lat, lon = self.row_coordinates(row)
+
+                if lat == None or lon == None:
+
+                    # there is no way to know which tile this belongs to so
+                    # if the tiles are being shared out it belongs to the
+                    # first one, which every worker agrees on
+
+                    if sharded and (i, j) != min(known):
+                        continue
+
+                    if wofid in seen:
+                        continue
+
+                    seen.add(wofid)
+                    yield row
+                    continue
+
+                if self.tile_owner(tiling, known, lat, lon) == (i, j):
+
+                    if wofid in seen:
+                        continue
+
+                elif mapzen.whosonfirst.hierarchy.geometry.bbox_distance(b, lat, lon) <= buffer:
+
+                    # on the edge of (or, with a buffer, near) this tile and
+                    # the one it belongs to
+                    continue
+
+                else:
+
+                    if wofid in seen:
+                        continue
+
+                    seen.add(wofid)
+
+                if not tiling.contains(lat, lon):
+
+                    if not buffer or mapzen.whosonfirst.hierarchy.geometry.distance(geom, lat, lon) > buffer:
+                        continue
+
+                yield row
+
+    def row_coordinates(self, row):
+
+        # the (lat, lon) coordinates of a row returned by a spatial client (or
+        # the hierarchy index) or the middle of its geometry if it doesn't
+        # have any, or (None, None) if there's nothing to go on
+
+        try:
+            return mapzen.whosonfirst.utils.reverse_geocoordinates(row)
+        except Exception as e:
+            pass
+
+        geom = row.get("geometry", None)
+
+        if not geom:
+            return None, None
+
+        try:
+            bbox = mapzen.whosonfirst.hierarchy.geometry.bbox(geom)
+        except Exception as e:
+            return None, None
+
+        return (bbox[1] + bbox[3]) / 2.0, (bbox[0] + bbox[2]) / 2.0
+
+    def tile_owner(self, tiling, known, lat, lon):
+
+        # the tile, out of the ones in known, that a point belongs to: the
+        # one it's in or, for points outside all of them (say in a buffer
+        # around the edge), the nearest one
+
+        t = tiling.index(lat, lon)
+
+        if t in known:
+            return t
+
+        owner = None
+        nearest = None
+
+        for i, j in sorted(known):
+
+            d = mapzen.whosonfirst.hierarchy.geometry.bbox_distance(tiling.tile(i, j), lat, lon)
+
+            if nearest == None or d < nearest:
+                owner = (i, j)
+                nearest = d
+
+        return owner
+
+    def timed_rows(self, rows, phase):
+
+        # time how long we spend waiting for each row from an iterable, which
+        # for a paginated query means that fetching a new page shows up as a
+        # (much) slower row
+
+        rows = iter(rows)
+
+        while True:
+
+            with self.timer(phase):
+
+                try:
+                    row = next(rows)
+                except StopIteration:
+                    return
+
+            self.incr("%s.rows" % phase)
+            yield row
+
+    def descendant_query_kwargs(self, p, **kwargs):
+
+        # the arguments passed to the spatial client's intersects_paginated
+        # method when looking for descendants of placetype p
+
+        _p = mapzen.whosonfirst.placetypes.placetype(p)
+        pid = _p.id()
+
+        pg_kwargs = {
+            'filters': {
+                'wof:placetype_id': pid,
+                'wof:is_superseded': 0,
+                'wof:is_deprecated': 0,
+                'wof:is_ceased': 0
+            },
+            'as_feature': True,
+            'check_centroid': True,
+        }
+
+        if kwargs.get("buffer", None):
+            pg_kwargs["buffer"] = kwargs.get("buffer")
+
+        # places that will be used to resolve point-in-polygon lookups locally
+        # (see also: rebuilt.point_in_polygon) need to include everything that
+        # overlaps feature, even if its centroid is somewhere else, otherwise
+        # a point near the edge would miss a parent that straddles it
+
+        rebuilt = kwargs.get("rebuilt", None)
+
+        if rebuilt and rebuilt.resolves(p):
+            del(pg_kwargs["check_centroid"])
+
+        elif p == 'venue':
+            pg_kwargs['use_centroid'] = True
+
+        return pg_kwargs
+
+    def rebuild_descendant_rows(self, rows, **kwargs):
+
+        for pid, row in rows:
+            yield self.rebuild_descendant_record(row, pid, **kwargs)
+
+    def rebuild_descendant_record(self, row, pid, **kwargs):
+
+        # rebuild a descendant and return a dictionary describing what happened,
+        # including the feature itself. the old parent ID is the one reported by
+        # the spatial client. 'time' is the number of seconds it took to load
+        # and rebuild the feature.
+
+        props = row["properties"]
+
+        t1 = time.time()
+        child, child_changed = self.rebuild_descendant(row, pid, **kwargs)
+        t2 = time.time()
+
+        if self.stats:
+            self.stats.record("descendant", t2 - t1)
+
+        child_props = child["properties"]
+
+        return {
+            "wof:id": child_props["wof:id"],
+            "wof:repo": child_props.get("wof:repo", None),
+            "wof:placetype": child_props.get("wof:placetype", None),
+            "changed": child_changed,
+            "old_parent_id": props.get("wof:parent_id", None),
+            "new_parent_id": child_props.get("wof:parent_id", None),
+            "time": t2 - t1,
+            "feature": child,
+        }
+
+    def rebuild_descendant(self, row, pid, **kwargs):
+
+        # rebuild the hierarchy for a descendant (returned by descendant_rows),
+        # returning a (feature, has_changed) tuple
+
+        props = row['properties']
+
+        _kwargs = {
+            'as_feature': True,
+            'filters': {
+                'wof:placetype_id': pid,
+                'wof:is_superseded': 0,
+                'wof:is_deprecated': 0,
+                'wof:is_ceased': 0
+            }
+        }
+
+        # if there is a 'splice' argument (see also: hierarchy_splice) then
+        # the new upper hierarchy of the feature whose descendants these are
+        # is copied in to each descendant directly rather than asking the
+        # spatial client to work everything out again
+
+        splice = kwargs.get("splice", None)
+
+        # see notes in iter_rebuild_descendants_many
+
+        if kwargs.get("rebuilt", None):
+            _kwargs["rebuilt"] = kwargs["rebuilt"]
+
+        def rebuild(child):
+
+            # spliced records never go through rebuild_feature so they are
+            # counted here, as well as on their own
+
+            if splice:
+
+                changed = self.splice_hierarchy(child, splice)
+
+                self.incr("spliced")
+                self.incr("changed" if changed else "unchanged")
+
+                return changed
+
+            return self.rebuild_feature(child, **_kwargs)
+
+        # if true then use the feature returned by the spatial client to
+        # rebuild the hierarchy rather than loading it from disk, so long as
+        # it has all the properties that rebuild_feature needs. if something
+        # has changed the record is (still) loaded from disk before being
+        # handed back since we don't want to export a partial record, unless
+        # 'complete_features' is true which means the spatial client returns
+        # the whole thing
+
+        if kwargs.get("use_spatial_feature", False):
+
+            required = kwargs.get("required_properties", self.required_properties)
+            missing = []
+
+            for k in required:
+
+                if not k in props:
+                    missing.append(k)
+
+            if len(missing) == 0:
+
+                child = copy.deepcopy(row)
+                child_changed = rebuild(child)
+
+                self.debug(child, "rebuilt feature (descendant of %s (%s)) from spatial client - changes: %s" % (props["wof:id"], props.get("wof:name", "NO NAME"), child_changed))
+
+                if not child_changed or kwargs.get("complete_features", False):
+                    return child, child_changed
+
+                feature = self.load_descendant(row, **kwargs)
+
+                # the spatial client might not know about wof:controlled in which
+                # case we can't be sure that we did the right thing so do it
+                # again, for real
+
+                if feature["properties"].get("wof:controlled", []) != child["properties"].get("wof:controlled", []):
+
+                    self.debug(feature, "wof:controlled differs from spatial client, rebuilding from disk")
+
+                    child_changed = rebuild(feature)
+                    return feature, child_changed
+
+                child_props = child["properties"]
+
+                feature["properties"]["wof:parent_id"] = child_props["wof:parent_id"]
+                feature["properties"]["wof:hierarchy"] = child_props["wof:hierarchy"]
+
+                return feature, child_changed
+
+            self.debug(row, "spatial client feature is missing %s, loading from disk" % ";".join(missing))
+
+        # load from disk - HOW CAN WE GET RID OF THIS PIECE? (see above)
+
+        child = self.load_descendant(row, **kwargs)
+        child_changed = rebuild(child)
+
+        self.debug(child, "rebuilt feature (descendant of %s (%s)) - changes: %s" % (props["wof:id"], props.get("wof:name", "NO NAME"), child_changed))
+
+        return child, child_changed
+
+    def hierarchy_splice(self, feature, old_hierarchy):
+
+        # work out what needs to change in the hierarchies of the descendants
+        # of feature given its old and (current) new hierarchies. returns a
+        # dictionary that can be passed to rebuild_descendants as the 'splice'
+        # argument, or None if that's not possible because feature has more
+        # (or less) than one hierarchy in which case there's no way to know
+        # which descendants should get which chain without asking the spatial
+        # client (see also: splice_hierarchy)
+
+        props = feature["properties"]
+        new_hierarchy = props.get("wof:hierarchy", [])
+
+        if len(old_hierarchy) != 1 or len(new_hierarchy) != 1:
+            self.debug(feature, "can not splice hierarchies, %s old and %s new hierarchies" % (len(old_hierarchy), len(new_hierarchy)))
+            return None
+
+        old = old_hierarchy[0]
+        new = new_hierarchy[0]
+
+        key = "%s_id" % props["wof:placetype"]
+
+        # everything above feature in its old hierarchy gets removed from the
+        # hierarchies of its descendants and is replaced by everything in its
+        # new hierarchy
+
+        remove = []
+
+        for k in list(old.keys()) + list(new.keys()):
+
+            if k != key and not k in remove:
+                remove.append(k)
+
+        return {
+            "key": key,
+            "id": props["wof:id"],
+            "remove": remove,
+            "hierarchy": new,
+        }
+
+    def splice_hierarchy(self, feature, splice, **kwargs):
+
+        # update the hierarchies of feature that contain the place described
+        # by splice (see also: hierarchy_splice) with its new upper chain and
+        # return a boolean indicating whether anything changed. hierarchies
+        # that don't contain that place, as well as wof:parent_id, are left
+        # alone.
+
+        props = feature["properties"]
+
+        if "wof:hierarchy" in props.get("wof:controlled", []):
+            self.debug(feature, "wof:hierarchy is controlled, not splicing hierarchy")
+            return False
+
+        key = splice["key"]
+        wofid = splice["id"]
+
+        old_hier = props.get("wof:hierarchy", [])
+        new_hier = []
+
+        seen = []
+
+        for h in old_hier:
+
+            if h.get(key, None) == wofid:
+
+                _h = {}
+
+                for k, v in h.items():
+
+                    if not k in splice["remove"]:
+                        _h[k] = v
+
+                _h.update(splice["hierarchy"])
+                h = _h
+
+            # two hierarchies that only differed above the place being
+            # spliced in are now the same thing
+
+            c = self.canonical_hierarchy(h)
+
+            if c in seen:
+                continue
+
+            seen.append(c)
+            new_hier.append(h)
+
+        props["wof:hierarchy"] = new_hier
+
+        changed = self.canonical_hierarchy(old_hier) != self.canonical_hierarchy(new_hier)
+
+        self.debug(feature, "spliced hierarchy from %s - changes: %s" % (wofid, changed))
+        return changed
+
+    def geometry_changed(self, feature, **kwargs):
+
+        # has the geometry for feature changed since the 'previous' version of
+        # it? if there isn't one then we don't know, which is the same as yes.
+        # note that we don't compare it with the version on disk because if
+        # you've edited a record in place (which is the usual thing) that IS
+        # the new version and nothing would ever look like it had changed.
+
+        previous = kwargs.get("previous", None)
+
+        if previous == None:
+            self.debug(feature, "no previous version to compare geometries with, assuming that it has changed")
+            return True
+
+        old_geom = json.dumps(previous.get("geometry", None), sort_keys=True)
+        new_geom = json.dumps(feature.get("geometry", None), sort_keys=True)
+
+        return old_geom != new_geom
+
+    def load_descendant(self, row, **kwargs):
+
+        data_root = kwargs.get("data_root", None)
+
+        props = row['properties']
+        wofid = props['wof:id']
+        repo = props['wof:repo']
+
+        _data = os.path.join(data_root, repo)
+        _data = os.path.join(_data, "data")
+
+        self.incr("loaded")
+
+        with self.timer("load"):
+            return mapzen.whosonfirst.utils.load(_data, wofid)
+
+    def clone(self, **kwargs):
+
+        # return a new ancestors instance with the same settings as this one,
+        # for example with its own spatial client for use in another thread
+
+        kwargs.setdefault("spatial_client", self.spatial_client)
+        kwargs.setdefault("batch", self.batch)
+        kwargs.setdefault("cache", self.cache)
+        kwargs.setdefault("required_properties", self.required_properties)
+        kwargs.setdefault("index", self.index)
+        kwargs.setdefault("coverage", self.coverage)
+        kwargs.setdefault("stats", self.stats)
+        kwargs.setdefault("removed", self.removed)
+        kwargs.setdefault("properties_only", self.properties_only)
+        kwargs.setdefault("pip_properties", self.pip_properties)
+
+        return ancestors(**kwargs)
+
+    def append_parent_and_hierarchy(self, feature, **kwargs):
+
+        if not "filters" in kwargs:
+            kwargs["filters"] = {}
+
+        # a dictionary of placetype (string) -> list of possible matches that
+        # have already been looked up (see also: batch mode) - if present we
+        # consult it instead of the spatial client
+
+        possible_by_placetype = kwargs.pop("possible", None)
+
+        # an optional mapzen.whosonfirst.hierarchy.rebuilt.rebuilt instance
+        # of places that have been rebuilt during this run (see also: the
+        # 'top_down' argument to iter_rebuild_descendants_many)
+
+        rebuilt = kwargs.pop("rebuilt", None)
+
+        props = feature['properties']
+
+        self.debug(feature, "append parent and hierarchy")
+
+        lat, lon = mapzen.whosonfirst.utils.reverse_geocoordinates(feature)
+
+        logging.debug("reverse geocoordinates for %s: %s, %s" % (feature['properties']['wof:id'], lat, lon))
+
+        if possible_by_placetype == None and self.batch_supported(self.spatial_client):
+            possible_by_placetype = self.point_in_polygon_batch(feature, lat, lon, roles=kwargs.get("roles", [ "common", "common_optional", "optional" ]))
+
+        # get the list of possible parents for this feature, filtering out
+        # some things we know aren't going concerns right now
+
+        pt = mapzen.whosonfirst.placetypes.placetype(props['wof:placetype'])
+
+        parents = []
+
+        for p in list(pt.parents()):
+
+            if str(p) in self.to_skip:
+                self.debug(feature, "skip point in polygon for %s (%s)" % (str(p), ";".join(self.to_skip)))
+                continue
+
+            parents.append(p)
+
+        append = False
+
+        str_parents = ";".join(map(str, parents))
+        self.debug(feature, "POSSIBLE reverse parents : %s for %s" % (str_parents, pt))
+
+        # this is the meat of it - start looping through possible parents and see if there's
+        # a match - be sure to append the hierarchies for any match
+
+        if len(parents) == 0:
+            logging.debug("feature placetype (%s) has no parents" % str(pt))
+
+        for p in parents:
+
+            if possible_by_placetype != None:
+                possible = possible_by_placetype.get(str(p), [])
+                logging.debug("FIND parent (%s) for %s, %s : %s (batched)" % (p, lat, lon, len(possible)))
+
+                if rebuilt:
+                    possible = rebuilt.substitute(possible)
+
+                if self.append_possible_hierarchies(feature, possible, set_parentid=True):
+                    append = True
+                    break
+
+                continue
+
+            kwargs['filters']['wof:placetype_id'] = p.id()
+            kwargs['filters']['wof:is_superseded'] = 0
+            kwargs['filters']['wof:is_deprecated'] = 0
+            kwargs['filters']['wof:is_ceased'] = 0
+            kwargs['as_feature'] = True
+
+            possible = self.rebuilt_point_in_polygon(rebuilt, lat, lon, p, **kwargs)
+
+            logging.debug("FIND parent (%s) for %s, %s : %s" % (p, lat, lon, len(possible)))
+
+            if self.append_possible_hierarchies(feature, possible, set_parentid=True):
+                append = True
+                break
+
+        # okay - here is a bunch of special-case code to ensure that localities parented by multiple counties
+        # don't clone that information too far down the stack, like to say neighbourhoods or boroughs which
+        # should only have a single county in their hierarchy.
+
+        if append and props['wof:placetype'] in ("borough", "macrohood", "neighbourhood"):
+            
+            if len(feature["properties"]["wof:hierarchy"]) > 1:
+
+                counties = []
+
+                for hier in feature["properties"]["wof:hierarchy"]:
+
+                    c = hier.get("county_id", None)
+
+                    if c and not c in counties:
+                        counties.append(c)
+
+                if len(counties) > 1:
+
+                    pt = mapzen.whosonfirst.placetypes.placetype("county")
+
+                    if possible_by_placetype != None and str(pt) in possible_by_placetype:
+
+                        possible = possible_by_placetype[str(pt)]
+
+                    else:
+
+                        _kwargs = {
+                            'filters': {
+                                'wof:placetype_id' :  pt.id(),
+                                'wof:is_superseded': 0,
+                                'wof:is_deprecated': 0,
+                                'wof:is_ceased': 0
+                            } ,
+                            'as_feature': True,
+                        }
+
+                        possible = self.rebuilt_point_in_polygon(rebuilt, lat, lon, pt, **_kwargs)
+
+                    new_hier = []
+
+                    if len(possible) > 0:
+                    
+                        valid = []
+
+                        for f in possible:
+                            valid.append(f["properties"]["wof:id"])
+
+                        for hier in feature["properties"]["wof:hierarchy"]:
+                    
+                            c = hier.get("county_id", None)
+
+                            if c == None or c in valid:
+                                new_hier.append(hier)
+                                
+
+                        feature["properties"]["wof:hierarchy"] = new_hier
+
+        # see this - we ensure the hierarchy by default
+
+        self.debug(feature, "append: %s ensure_hierarchy: %s" % (append, kwargs.get("ensure_hierarchy", True)))
+
+        if not append and kwargs.get("ensure_hierarchy", True):
+
+            props = feature["properties"]
+            match = self.ensure_hierarchy(feature, possible=possible_by_placetype, rebuilt=rebuilt, **kwargs)
+
+            self.debug(feature, "no append but ensure hierarchy - matches: %s" % match)
+
+        # ensure common properties and ancestors are always present
+
+        props = feature["properties"]
+        parent_id = props.get("wof:parent_id", None)
+
+        if not parent_id:
+
+            logging.warning("WOF ID %s (%s) is missing a wof:parent_id property" % (props["wof:id"], props.get("wof:name", "NO NAME")))
+
+            parent_id = -1
+            props["wof:parent_id"] = parent_id
+
+        # find the things that are ancestors of this placetype and
+        # ensure that they are in the hierarchy
+
+        pt = props["wof:placetype"]
+        pt = mapzen.whosonfirst.placetypes.placetype(pt)
+
+        # see what's happening? we're making a list of strings
+
+        common = list(map(str, pt.ancestors(['common'])))
+
+        self.debug(feature, "ensure common ancestors (is a %s) : %s" % (pt, ";".join(common)))
+
+        for h in feature['properties']['wof:hierarchy']:
+
+            for p in common:
+
+                k = "%s_id" % p
+
+                if not k in h:
+                    self.debug(feature, "set %s to -1" % k)
+                    h[k] = -1
+
+        # final check...
+
+        if len(feature['properties']['wof:hierarchy']) == 0:
+
+            pt_key = "%s_id" % props["wof:placetype"]
+            pt_id = props["wof:id"]
+
+            hier = {
+                pt_key: pt_id
+            }
+
+            for p in common:
+
+                pt_key = "%s_id" % p
+                pt_id = -1
+                hier[ pt_key ] = pt_id
+
+            feature['properties']['wof:hierarchy'] = [ hier ]
+
+    def ensure_hierarchy(self, feature, **kwargs):
+
+        props = feature["properties"]
+
+        logging.debug("ensure hierarchy for %s (%s)" % (props["wof:id"], props.get("wof:name", "NO NAME")))
+
+        roles = kwargs.get("roles", [ "common", "common_optional", "optional" ] )
+
+        # see notes in append_parent_and_hierarchy
+
+        possible_by_placetype = kwargs.pop("possible", None)
+        rebuilt = kwargs.pop("rebuilt", None)
+
+        if int(props.get("wof:parent_id", 0)) > 0:
+            logging.debug("no point in ensuring hierarchy for %s (%s): parent ID > 0 (%s)" % (props["wof:id"], props.get("wof:name", "NO NAME"), props.get("wof:parent_id", 0)))
+            return True
+
+        if len(props.get("wof:hierarchy", [])) > 1:
+            logging.debug("not point in ensuring hierarchy for %s (%s): multiple hierarchies" % (props["wof:id"], props.get("wof:name", "NO NAME")))
+            return True
+            
+        lat, lon = mapzen.whosonfirst.utils.reverse_geocoordinates(feature)
+
+        pt = mapzen.whosonfirst.placetypes.placetype(props["wof:placetype"])
+
+        match = False
+
+        # build on the existing to_skip list and append possible parents
+        # because if we've gotten here then we're just going to assume
+        # that they've all failed and we're looking for something higher
+        # up the stack
+
+        # see this we're building a new array rather than assigning self.to_skip
+        # to a left-hand value since python will treat it as a reference and
+        # eventually self.to_skip will be full of all kinds of stuff that any
+        # kind of meaningful processing will be impossible... computers.
+        # (20170512/thisisaaronland)
+
+        to_skip = []
+
+        for p in self.to_skip:
+            to_skip.append(p)
+
+        for p in list(pt.parents()):
+            
+            p = str(p)
+
+            if not p in to_skip:
+                to_skip.append(p)
+
+        self.debug(feature, "update to skip list to be : %s (%s)" % (";".join(to_skip), ";".join(self.to_skip)))
+
+        if possible_by_placetype == None and self.batch_supported(self.spatial_client):
+
+            placetypes = []
+
+            for p in pt.ancestors(roles):
+
+                if not str(p) in to_skip:
+                    placetypes.append(str(p))
+
+            possible_by_placetype = self.point_in_polygon_batch(feature, lat, lon, placetypes=placetypes)
+
+        # go!
+
+        for p in pt.ancestors(roles):
+
+            if str(p) in to_skip:
+                continue
+
+            logging.debug("try to ensure hierarchy for %s with placetype %s" % (props["wof:id"], p))
+
+            if possible_by_placetype != None:
+
+                possible = possible_by_placetype.get(str(p), [])
+
+                if rebuilt:
+                    possible = rebuilt.substitute(possible)
+
+            else:
+
+                _pt = mapzen.whosonfirst.placetypes.placetype(p)
+
+                kwargs = {
+                    'filters': {
+                        'wof:placetype_id' :  _pt.id(),
+                        'wof:is_superseded': 0,
+                        'wof:is_deprecated': 0,
+                        'wof:is_ceased': 0
+                    } ,
+                    'as_feature': True,
+                }
+
+                possible = self.rebuilt_point_in_polygon(rebuilt, lat, lon, p, **kwargs)
+
+            logging.debug("ensure hierarchy for %s with placetype %s : %s possible" % (props["wof:id"], p, len(possible)))
+
+            if self.append_possible_hierarchies(feature, possible):
+
+                if len(feature["properties"]["wof:hierarchy"]) >= 1:
+
+                    logging.debug("successfully ensured hierarchy for %s with placetype %s" % (props["wof:id"], p))
+                    match = True
+                    break
+
+                logging.warning("possible ancestor had no hierarchy")
+
+        # make sure that feature is always present in wof:hierarchy
+        # no matter what (20170824/thisisaaronland)
+
+        if not match:
+
+            wofid = props["wof:id"]
+            hiers = props["wof:hierarchy"]
+
+            pt_k = "%s_id" % props["wof:placetype"]
+
+            if len(hiers) == 0:
 
                 hiers = [
                     { pt_k : wofid }
@@ -496,14 +1738,422 @@ class ancestors:
 
             else:
 
-                for h in hiers:
-                    
-                    if not h.has_key(pt_k):
-                        h[pt_k] = wofid
+                for h in hiers:
+                    
+                    if not pt_k in h:
+                        h[pt_k] = wofid
+
+            props["wof:hierarchy"] = hiers
+
+        return match
+
+    def point_in_polygon(self, lat, lon, **kwargs):
+
+        # a thin wrapper around the spatial client's point_in_polygon method
+        # that returns a list (rather than a generator) and consults the
+        # coverage index and the cache if there are any
+
+        if self.coverage:
+
+            kwargs = self.covered_kwargs(lat, lon, **kwargs)
+
+            if kwargs == None:
+                return []
+
+        if not self.cache:
+            return self._point_in_polygon(lat, lon, **kwargs)
+
+        filters = kwargs.get("filters", {})
+        possible = self.cache.get(lat, lon, filters)
+
+        if possible != None:
+            self.incr("pip.cache.hit")
+            return possible
+
+        self.incr("pip.cache.miss")
+
+        possible = self._point_in_polygon(lat, lon, **kwargs)
+
+        # if the cache is remembering polygons then it needs to know about
+        # everything that overlaps them too (see also: pip_candidates)
+
+        candidates = None
+
+        if self.cache.wants_candidates(filters, possible):
+            candidates = self.pip_candidates(possible, **kwargs)
+
+        self.cache.set(lat, lon, filters, possible, candidates=candidates)
+
+        return possible
+
+    def pip_candidates(self, possible, **kwargs):
+
+        # returns the list of places matching the same filters as a point-in-
+        # polygon query that intersect any of the places it returned or None
+        # if the spatial client can't tell us
+
+        intersects_paginated = getattr(self.spatial_client, "intersects_paginated", None)
+
+        if not intersects_paginated:
+            return None
+
+        filters = kwargs.get("filters", {})
+        candidates = {}
+
+        try:
+
+            with self.timer("pip.candidates"):
+
+                for row in possible:
+
+                    candidates[ row["properties"]["wof:id"] ] = row
+
+                    for c in intersects_paginated(row, filters=filters, as_feature=True):
+                        candidates.setdefault(c["properties"]["wof:id"], c)
+
+        except Exception as e:
+            logging.warning("failed to find candidates for point in polygon cache, because %s" % e)
+            return None
+
+        self.incr("pip.candidates")
+        return list(candidates.values())
+
+    def covered_kwargs(self, lat, lon, **kwargs):
+
+        # returns kwargs with any placetypes that the coverage index says
+        # can't be at (lat, lon) removed from the 'wof:placetype_id' filter
+        # or None if there's nothing left to ask about
+
+        filters = kwargs.get("filters", {})
+        pid = filters.get("wof:placetype_id", None)
+
+        if pid == None:
+            return kwargs
+
+        if type(pid) != list:
+
+            if self.coverage.covers(lat, lon, pid):
+                return kwargs
+
+            self.incr("pip.coverage.skip")
+            return None
+
+        ids = []
+
+        for _pid in pid:
+
+            if self.coverage.covers(lat, lon, _pid):
+                ids.append(_pid)
+
+        self.incr("pip.coverage.skip", len(pid) - len(ids))
+
+        if len(ids) == 0:
+            return None
+
+        if len(ids) == len(pid):
+            return kwargs
+
+        kwargs = dict(kwargs)
+        kwargs["filters"] = dict(filters)
+        kwargs["filters"]["wof:placetype_id"] = ids
+
+        return kwargs
+
+    def rebuilt_point_in_polygon(self, rebuilt, lat, lon, placetype, **kwargs):
+
+        # point_in_polygon for a single placetype, by way of the places that
+        # have been rebuilt during this run if there are any (see also:
+        # mapzen.whosonfirst.hierarchy.rebuilt)
+
+        if not rebuilt:
+            return list(self.point_in_polygon(lat, lon, **kwargs))
+
+        possible = rebuilt.point_in_polygon(lat, lon, placetype)
+
+        if possible != None:
+            self.incr("pip.rebuilt")
+            return possible
+
+        return rebuilt.substitute(self.point_in_polygon(lat, lon, **kwargs))
+
+    def _point_in_polygon(self, lat, lon, **kwargs):
+
+        kwargs, lean = self.pip_kwargs(self.spatial_client, **kwargs)
+
+        if self.stats:
+
+            pid = kwargs.get("filters", {}).get("wof:placetype_id", None)
+
+            if type(pid) == list:
+                pid = "batch"
+
+            self.stats.incr("pip.%s" % pid)
+
+        with self.timer("pip"):
+            possible = list(self.spatial_client.point_in_polygon(lat, lon, **kwargs))
+
+        if lean:
+            self.incr("pip.properties_only")
+            possible = self.as_features(possible)
+
+        return self.without_removed(possible)
+
+    def without_removed(self, possible):
+
+        # see also: remove_feature
+
+        if not self.removed:
+            return possible
+
+        return [ row for row in possible if not row["properties"]["wof:id"] in self.removed ]
+
+    def properties_only_supported(self, client):
+
+        # can (and should) we ask this spatial client for properties rather
+        # than whole features? the cache needs geometries if it's looking
+        # after polygons
+
+        if not self.properties_only:
+            return False
+
+        if self.cache and getattr(self.cache, "polygons", False):
+            return False
+
+        return getattr(client, "supports_properties", False) == True
+
+    def batch_supported(self, client):
+
+        # can (and should) we ask this spatial client about all the candidate
+        # placetypes for a point at once? (see also: batch_query_kwargs)
+
+        if not self.batch:
+            return False
+
+        return getattr(client, "supports_placetype_lists", False) == True
+
+    def pip_kwargs(self, client, **kwargs):
+
+        # returns a (kwargs, is_properties_only) tuple where kwargs are the
+        # arguments to pass to client's point_in_polygon (or point_in_polygon_many)
+        # method, asking for only the properties we need (rather than whole
+        # features) if that's possible. the client is expected to return a
+        # list of dictionaries of properties (see also: as_features)
+
+        if not kwargs.get("as_feature", False):
+            return kwargs, False
+
+        if not self.properties_only_supported(client):
+            return kwargs, False
+
+        kwargs = kwargs.copy()
+        kwargs["as_feature"] = False
+        kwargs["properties"] = self.pip_properties
+
+        return kwargs, True
+
+    def as_features(self, rows):
+
+        # wrap a list of properties (see also: pip_kwargs) so they look like
+        # GeoJSON features, minus the geometry, which is all that the code
+        # that deals with possible parents knows about
+
+        features = []
+
+        for row in rows:
+
+            if "properties" in row:
+                features.append(row)
+                continue
+
+            features.append({ "type": "Feature", "properties": row })
+
+        return features
+
+    def index_feature(self, feature, **kwargs):
+
+        # (re) index a feature with the spatial client and make sure that
+        # nothing in the cache refers to the old version of it
+
+        with self.timer("index"):
+            rsp = self.spatial_client.index_feature(feature, **kwargs)
+
+        self.incr("indexed")
+
+        self.removed.discard(feature["properties"]["wof:id"])
+
+        if self.cache:
+            self.cache.invalidate(feature)
+
+        if self.coverage:
+            self.coverage.add_feature(feature)
+
+        return rsp
+
+    def remove_feature(self, feature):
+
+        # the opposite of index_feature, for records that have been deleted,
+        # so that nothing is parented by them (see also: changes.rebuild).
+        # they are removed from the spatial client, if it has a remove_feature
+        # method, and the hierarchy index and anything in the cache that refers
+        # to them is discarded. either way their IDs are remembered so that the
+        # spatial client's results can be filtered. the coverage index doesn't
+        # forget about places but that only means a point-in-polygon query it
+        # might otherwise have skipped.
+
+        props = feature["properties"]
+        wofid = props["wof:id"]
+
+        self.removed.add(wofid)
+
+        remove = getattr(self.spatial_client, "remove_feature", None)
+
+        if remove:
+            remove(wofid)
+
+        if self.index:
+            self.index.remove_feature(wofid)
+
+        if self.cache:
+            self.cache.invalidate(feature)
+
+        self.incr("removed")
+
+    def index_features(self, features, **kwargs):
+
+        # the same as index_feature but for a list of features, using the
+        # spatial client's index_features method if it has one
+
+        index_features = getattr(self.spatial_client, "index_features", None)
+
+        with self.timer("index"):
+
+            if index_features:
+                rsp = index_features(features, **kwargs)
+            else:
+
+                rsp = []
 
-            props["wof:hierarchy"] = hiers
+                for feature in features:
+                    rsp.append(self.spatial_client.index_feature(feature, **kwargs))
 
-        return match
+        self.incr("indexed", len(features))
+
+        for feature in features:
+            self.removed.discard(feature["properties"]["wof:id"])
+
+        if self.cache:
+
+            for feature in features:
+                self.cache.invalidate(feature)
+
+        if self.coverage:
+            self.coverage.add_features(features)
+
+        return rsp
+
+    def candidate_placetypes(self, feature, **kwargs):
+
+        # return the list of all the placetypes that append_parent_and_hierarchy
+        # and ensure_hierarchy might ask the spatial client about for a given
+        # feature, in the order they would be asked
+
+        props = feature["properties"]
+        roles = kwargs.get("roles", [ "common", "common_optional", "optional" ] )
+
+        pt = mapzen.whosonfirst.placetypes.placetype(props["wof:placetype"])
+
+        candidates = []
+
+        for p in list(pt.parents()) + list(pt.ancestors(roles)):
+
+            p = str(p)
+
+            if p in self.to_skip:
+                continue
+
+            if not p in candidates:
+                candidates.append(p)
+
+        # see the county-pruning code in append_parent_and_hierarchy
+
+        if props["wof:placetype"] in ("borough", "macrohood", "neighbourhood") and not "county" in candidates:
+            candidates.append("county")
+
+        return candidates
+
+    def point_in_polygon_batch(self, feature, lat, lon, **kwargs):
+
+        # ask the spatial client for every candidate placetype at once and
+        # then bucket the results by placetype; the parent-selection order
+        # and the -3 / -4 ambiguity rules are still applied by the code that
+        # consumes the buckets
+
+        placetypes = kwargs.get("placetypes", None)
+
+        if placetypes == None:
+            placetypes = self.candidate_placetypes(feature, **kwargs)
+
+        if len(placetypes) == 0:
+            return self.bucket_possible(placetypes, [])
+
+        _kwargs = self.batch_query_kwargs(placetypes)
+
+        rows = self.point_in_polygon(lat, lon, **_kwargs)
+        possible_by_placetype = self.bucket_possible(placetypes, rows)
+
+        self.debug(feature, "batched point in polygon for %s : %s possible across %s placetypes" % (";".join(map(str, placetypes)), len(rows), len(placetypes)))
+
+        return possible_by_placetype
+
+    def batch_query_kwargs(self, placetypes):
+
+        ids = []
+
+        for p in placetypes:
+
+            _pt = mapzen.whosonfirst.placetypes.placetype(p)
+            ids.append(_pt.id())
+
+        return {
+            'filters': {
+                'wof:placetype_id' : ids,
+                'wof:is_superseded': 0,
+                'wof:is_deprecated': 0,
+                'wof:is_ceased': 0
+            } ,
+            'as_feature': True,
+        }
+
+    def bucket_possible(self, placetypes, rows):
+
+        # returns a dictionary mapping each of placetypes (as a string) to
+        # the list of rows with that placetype
+
+        possible_by_placetype = {}
+        ids = {}
+
+        for p in placetypes:
+
+            _pt = mapzen.whosonfirst.placetypes.placetype(p)
+            ids[ _pt.id() ] = str(p)
+
+            possible_by_placetype[ str(p) ] = []
+
+        for row in rows:
+
+            row_props = row["properties"]
+            p = row_props.get("wof:placetype", None)
+
+            if p == None:
+                p = ids.get(row_props.get("wof:placetype_id", None), None)
+
+            if not p in possible_by_placetype:
+                logging.warning("batched point in polygon query returned unexpected placetype (%s) for %s" % (p, row_props.get("wof:id", None)))
+                continue
+
+            possible_by_placetype[p].append(row)
+
+        return possible_by_placetype
 
     def append_possible_hierarchies(self, feature, possible, **kwargs):
 
@@ -540,7 +2190,12 @@ class ancestors:
             parent_hier = parent['properties']['wof:hierarchy']
             hiers = []
 
+            # copy the parent's hierarchy rather than updating it in place
+            # since the same possible parent may be shared by more than one
+            # feature (see also: batch mode)
+
             for _h in parent_hier:
+                _h = dict(_h)
                 _h[ wofpt ] = wofid
                 hiers.append(_h)
 
@@ -562,6 +2217,7 @@ class ancestors:
             for f in possible:
 
                 for _h in f['properties']['wof:hierarchy']:
+                    _h = dict(_h)
                     _h[ wofpt ] = wofid
                     hiers.append(_h)
                     
@@ -594,40 +2250,38 @@ class ancestors:
 
         return self.rebuild_and_export(feature, **kwargs)
 
-    def rebuild_and_export(self, feature, **kwargs):
-
-        props = feature["properties"]
-
-        self.debug(feature, "rebuild and export w/ kwargs %s" % kwargs)
-
-        # this is a helper method to wrap calling rebuild_feature and
-        # rebuild_descendants and to provide a common function (callback)
-        # for updating data in all the necessary places.
-
-        data_root = kwargs.get("data_root", None)
+    def export_writer(self, **kwargs):
 
-        rebuild_feature = kwargs.get("rebuild_feature", True)
-        rebuild_descendants = kwargs.get("rebuild_descendants", True)
+        # here's where we actually write things to disk and touch databases
+        # (see also: mapzen.whosonfirst.hierarchy.writer)
 
         # let's say that sometimes for the purpose of debugging you want
         # to export all your changes to disk but not re-index them in a
         # database because it's a lot easier and faster to `git stash` a
         # repo than to wait around for a database to be indexed. the default
-        # is do both unless you say otherwise.
+        # is do both unless you say otherwise ('export' and 'import').
 
-        export = kwargs.get("export", True)
-        index = kwargs.get("import", True)
+        writer_kwargs = self.export_writer_kwargs(**kwargs)
+        return mapzen.whosonfirst.hierarchy.writer.writer(self, **writer_kwargs)
 
-        skip_check = kwargs.get("skip_check", False)
+    def export_writer_kwargs(self, **kwargs):
 
-        debug = kwargs.get("debug", False)
-        
-        if not data_root:
-            raise Exception("You forgot to specify a data_root parameter")
+        # the arguments for a mapzen.whosonfirst.hierarchy.writer.writer
+        # instance, pulled out of the arguments to rebuild_and_export
 
-        spatial_client = self.spatial_client
+        return {
+            "data_root": kwargs.get("data_root", None),
+            "export": kwargs.get("export", True),
+            "import": kwargs.get("import", True),
+            "debug": kwargs.get("debug", False),
+            "export_batch_size": kwargs.get("export_batch_size", 1),
+            "index_batch_size": kwargs.get("index_batch_size", 1),
+            "index_kwargs": kwargs,
+        }
 
-        # here's where we actually write things to disk and touch databases
+    def export_callback(self, writer):
+
+        # a common function for updating data in all the necessary places
 
         def callback(feature):
 
@@ -649,54 +2303,244 @@ class ancestors:
                 props["wof:repo"] = repo
                 """
 
-            root = os.path.join(data_root, repo)
-            data = os.path.join(root, "data")
-            
-            if debug:
-                logging.info("debugging enabled but normally we would export %s (%s) here", props['wof:id'], props.get("wof:name", "NO NAME"))
-                logging.debug(pprint.pformat(feature['properties']))
-            elif export == False:
-                logging.info("exporting is disabled but normally we would export %s (%s) here", props['wof:id'], props.get("wof:name", "NO NAME"))                
-                logging.debug(pprint.pformat(feature['properties']))
-            else:
-                logging.debug("EXPORT %s (%s)" % (props["wof:id"], props.get("wof:name", "NO NAME")))
-                exporter = mapzen.whosonfirst.export.flatfile(data)
-                path = exporter.export_feature(feature)
+            return writer.write(feature)
 
-            # debugging behaviour is handled by the spatial_client thingy
+        return callback
 
-            if index == False:
-                logging.info("indexing is disabled but normally we would index %s (%s) here", props['wof:id'], props.get("wof:name", "NO NAME"))
-            else:
-                logging.debug("REINDEX %s (%s)" % (props['wof:id'], props.get("wof:name", "NO NAME")))
-                spatial_client.index_feature(feature, **kwargs)
+    def rebuild_and_export(self, feature, **kwargs):
 
-            return True
+        props = feature["properties"]
+
+        self.debug(feature, "rebuild and export w/ kwargs %s" % kwargs)
+
+        # this is a helper method to wrap calling rebuild_feature and
+        # rebuild_descendants and to provide a common function (callback)
+        # for updating data in all the necessary places.
+
+        data_root = kwargs.get("data_root", None)
+
+        rebuild_feature = kwargs.get("rebuild_feature", True)
+        rebuild_descendants = kwargs.get("rebuild_descendants", True)
+
+        skip_check = kwargs.get("skip_check", False)
+
+        if not data_root:
+            raise Exception("You forgot to specify a data_root parameter")
+
+        writer = self.export_writer(**kwargs)
+
+        # if there is a 'journal' argument (the path to a file) then progress
+        # is recorded there and if it already exists, for the same feature,
+        # anything it says was done already is skipped (see also:
+        # mapzen.whosonfirst.hierarchy.journal)
+
+        journal = None
+
+        if kwargs.get("journal", None):
+
+            journal = mapzen.whosonfirst.hierarchy.journal.journal(kwargs["journal"], feature, checkpoint_size=kwargs.get("checkpoint_size", 1000))
+
+            if journal.feature:
+                logging.info("feature %s already rebuilt according to journal, skipping" % props["wof:id"])
+                rebuild_feature = False
+
+            kwargs["journal"] = journal
+
+        callback = self.export_callback(writer)
+
+        # if true then, rather than re-resolving the hierarchy for every
+        # descendant, the difference between the old and new hierarchies of
+        # feature is spliced in to the hierarchies of the descendants that
+        # contain it (see also: hierarchy_splice). this doesn't happen if the
+        # geometry for feature has changed (because its descendants might have
+        # too) or if it has more than one hierarchy in which case everything
+        # is rebuilt the usual way.
+
+        incremental = kwargs.get("incremental", False)
+
+        old_hier = copy.deepcopy(props.get("wof:hierarchy", []))
+        hier_changed = True
+
+        # this needs to happen before feature is exported below
+
+        geom_changed = True
+
+        if incremental:
+
+            geom_changed = kwargs.get("geometry_changed", None)
+
+            if geom_changed == None and kwargs.get("previous", None) == None:
+                logging.warning("incremental update for %s without a 'previous' or 'geometry_changed' argument, assuming the geometry has changed" % props["wof:id"])
+
+            if geom_changed == None:
+                geom_changed = self.geometry_changed(feature, **kwargs)
 
         updated = []
 
-        if rebuild_feature:
+        try:
 
-            # first update the record itself and invoke the callback
-            # if there have been changes
+            if rebuild_feature:
 
-            if self.rebuild_feature(feature, **kwargs) or skip_check:
+                # first update the record itself and invoke the callback
+                # if there have been changes
 
-                if callback(feature):
-                    props = feature["properties"]
-                    repo = props["wof:repo"]
-                    updated.append(repo)
-                    
-        # now plough through through all the descendants of this place
-        # note the part where we pass the callback along in the args
+                hier_changed = self.rebuild_feature(feature, **kwargs)
+
+                feature_ok = True
+
+                if hier_changed or skip_check:
+
+                    if callback(feature):
+                        props = feature["properties"]
+                        repo = props["wof:repo"]
+                        updated.append(repo)
+                    else:
+                        logging.error("post-rebuild callback failed for %s" % props["wof:id"])
+                        feature_ok = False
+
+                # make sure the descendants see the new version of things
+
+                writer.flush()
+
+                # if the callback failed then the feature is rebuilt again
+                # the next time around
 
-        if rebuild_descendants:
+                if journal and not feature_ok:
+                    journal.failed(props["wof:id"])
+
+                elif journal:
+
+                    repo = None
+
+                    if len(updated):
+                        repo = updated[0]
+
+                    journal.feature_done(repo)
+
+            # now plough through through all the descendants of this place
+            # note the part where we pass the callback along in the args
+
+            if rebuild_descendants and incremental:
+
+                if geom_changed:
+                    logging.info("geometry has changed for %s, rebuilding descendants in full" % props["wof:id"])
+
+                elif not hier_changed:
+                    logging.info("neither the geometry nor the hierarchy has changed for %s, skipping descendants" % props["wof:id"])
+                    rebuild_descendants = False
+
+                else:
+
+                    splice = self.hierarchy_splice(feature, old_hier)
+
+                    if splice:
+                        logging.info("splice new hierarchy for %s in to descendants" % props["wof:id"])
+                        kwargs["splice"] = splice
+                    else:
+                        logging.info("unable to splice hierarchy for %s, rebuilding descendants in full" % props["wof:id"])
+
+            if rebuild_descendants:
+
+                for repo in self.rebuild_descendants(feature, callback, flush=writer.flush, **kwargs):
+
+                    if not repo in updated:
+                        updated.append(repo)
+
+        finally:
+
+            # make sure that anything still waiting to be written is written
+            # even if something went wrong
+
+            try:
+                writer.flush()
+            finally:
+
+                if journal:
+                    journal.close()
+
+        # all done
+
+        if journal:
+
+            for repo in journal.updated:
 
-            for repo in self.rebuild_descendants(feature, callback, **kwargs):
-                
                 if not repo in updated:
                     updated.append(repo)
 
-        # all done
+            journal.finish()
+
+        return updated
+
+    def rebuild_and_export_many(self, features, **kwargs):
+
+        # like rebuild_and_export but for lots of places at once, for example
+        # a batch of admin edits. all of features are rebuilt (and exported)
+        # first, from the top down, and then their descendants are rebuilt
+        # exactly once each no matter how many of features they are inside
+        # (see also: iter_rebuild_descendants_many). returns the union of
+        # repos that were updated. the 'incremental' and 'journal' arguments
+        # are specific to a single feature and are ignored here.
+
+        data_root = kwargs.get("data_root", None)
+
+        rebuild_feature = kwargs.get("rebuild_feature", True)
+        rebuild_descendants = kwargs.get("rebuild_descendants", True)
+
+        skip_check = kwargs.get("skip_check", False)
+
+        if not data_root:
+            raise Exception("You forgot to specify a data_root parameter")
+
+        for k in ("incremental", "journal", "splice"):
+
+            if kwargs.get(k, None):
+                logging.warning("'%s' is not supported when rebuilding and exporting many features, ignoring" % k)
+                del(kwargs[k])
+
+        writer = self.export_writer(**kwargs)
+        callback = self.export_callback(writer)
+
+        features = sorted(features, key=lambda f: self.placetype_depth(f["properties"]["wof:placetype"]))
+
+        updated = []
+
+        try:
+
+            if rebuild_feature:
+
+                depth = None
+
+                for feature in features:
+
+                    # make sure that features see the new version of any
+                    # of the other features that might be their parents
+
+                    d = self.placetype_depth(feature["properties"]["wof:placetype"])
+
+                    if depth != None and d != depth:
+                        writer.flush()
+
+                    depth = d
+
+                    if self.rebuild_feature(feature, **kwargs) or skip_check:
+
+                        if callback(feature):
+
+                            repo = feature["properties"]["wof:repo"]
+
+                            if not repo in updated:
+                                updated.append(repo)
+
+                writer.flush()
+
+            if rebuild_descendants:
+
+                for repo in self.rebuild_descendants_many(features, callback, flush=writer.flush, **kwargs):
+
+                    if not repo in updated:
+                        updated.append(repo)
+
+        finally:
+            writer.flush()
 
         return updated
@@ -0,0 +1,663 @@
+import asyncio
+import logging
+import functools
+
+import mapzen.whosonfirst.utils
+import mapzen.whosonfirst.placetypes
+
+import mapzen.whosonfirst.hierarchy
+import mapzen.whosonfirst.hierarchy.writer
+
+# an asyncio flavoured version of the ancestors class, for when you want
+# to resolve the hierarchies for lots of things at the same time without a
+# thread per thing. it expects an async spatial client, which is to say
+# something with the following methods:
+#
+# async def point_in_polygon(lat, lon, **kwargs) - returns a list
+# async def intersects_paginated(feature, **kwargs) - an async generator
+# async def index_feature(feature, **kwargs)
+#
+# if all you have is a plain old (blocking) spatial client you can wrap it
+# in a sync_client_adapter which runs everything in an executor:
+#
+# client = mapzen.whosonfirst.hierarchy.aio.sync_client_adapter(pg_client)
+# ancs = mapzen.whosonfirst.hierarchy.aio.async_ancestors(spatial_client=client, concurrency=20)
+#
+# changed = await ancs.rebuild_feature(feature)
+#
+# the rules for deciding parents and hierarchies are the same; in fact they
+# are applied by a regular ancestors instance once all the possible matches
+# for a feature have been fetched. that means that all the candidate placetypes
+# for a feature are looked up (concurrently, or in a single query if 'batch'
+# is true) rather than stopping at the first one that matches.
+
+class sync_client_adapter:
+
+    def __init__(self, client, **kwargs):
+
+        self.client = client
+
+        # a concurrent.futures executor; None means the event loop's default
+
+        self.executor = kwargs.get("executor", None)
+
+    async def run(self, fn, *args, **kwargs):
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(fn, *args, **kwargs))
+
+    @property
+    def supports_properties(self):
+        return getattr(self.client, "supports_properties", False)
+
+    @property
+    def supports_placetype_lists(self):
+        return getattr(self.client, "supports_placetype_lists", False)
+
+    async def point_in_polygon(self, lat, lon, **kwargs):
+
+        def pip():
+            return list(self.client.point_in_polygon(lat, lon, **kwargs))
+
+        return await self.run(pip)
+
+    async def intersects_paginated(self, feature, **kwargs):
+
+        # the underlying generator is advanced one row at a time in the
+        # executor; never from more than one thread at once
+
+        rows = self.client.intersects_paginated(feature, **kwargs)
+        done = object()
+
+        try:
+
+            while True:
+
+                row = await self.run(next, rows, done)
+
+                if row is done:
+                    break
+
+                yield row
+
+        finally:
+
+            close = getattr(rows, "close", None)
+
+            if close:
+                close()
+
+    async def index_feature(self, feature, **kwargs):
+
+        return await self.run(self.client.index_feature, feature, **kwargs)
+
+# arguments that ancestors.rebuild_descendants (or rebuild_and_export)
+# understands but async_ancestors doesn't (yet). rather than quietly doing
+# something other than what was asked for (like not keeping a journal) an
+# exception is raised if any of them are passed (see also: check_kwargs)
+
+unsupported_kwargs = (
+    "use_spatial_feature", "complete_features", "pool", "client_factory", "readahead",
+    "journal", "checkpoint_size", "incremental", "geometry_changed", "previous", "splice",
+    "top_down", "concurrent_placetypes", "resolve_locally", "rebuilt",
+    "tiles", "tiling", "tile_size",
+)
+
+class async_ancestors:
+
+    def __init__(self, **kwargs):
+
+        self.spatial_client = kwargs.get("spatial_client", None)
+
+        # the maximum number of features being rebuilt at any given time
+
+        self.concurrency = kwargs.get("concurrency", 10)
+
+        # used for loading and exporting things on disk; None means the event
+        # loop's default executor
+
+        self.executor = kwargs.get("executor", None)
+
+        # this is what actually decides parents and hierarchies; it never
+        # talks to a spatial client itself
+
+        ancestors_kwargs = {
+            "spatial_client": None,
+        }
+
+        for k in ("batch", "cache", "coverage", "index", "required_properties", "properties_only", "pip_properties", "stats"):
+
+            if k in kwargs:
+                ancestors_kwargs[k] = kwargs[k]
+
+        self.ancestors = mapzen.whosonfirst.hierarchy.ancestors(**ancestors_kwargs)
+
+        self.batch = self.ancestors.batch_supported(self.spatial_client)
+
+        if self.ancestors.batch and not self.batch:
+            logging.warning("spatial client does not support lists of placetypes, looking up one placetype at a time")
+
+        if kwargs.get("properties_only", False) and getattr(self.spatial_client, "supports_properties", False) != True:
+            logging.warning("spatial client does not support returning properties only, fetching whole features")
+
+        self.cache = self.ancestors.cache
+        self.coverage = self.ancestors.coverage
+
+        # everything is counted and timed with the same stats instance as the
+        # ancestors class, including things (like point-in-polygon queries)
+        # that happen here rather than there
+
+        self.stats = self.ancestors.stats
+
+        self.semaphore = None
+
+    def limit(self):
+
+        # created lazily so that it belongs to the running event loop
+
+        if self.semaphore == None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+
+        return self.semaphore
+
+    def debug(self, feature, msg):
+
+        self.ancestors.debug(feature, msg)
+
+    async def run(self, fn, *args, **kwargs):
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(fn, *args, **kwargs))
+
+    async def point_in_polygon(self, lat, lon, **kwargs):
+
+        # see also: ancestors.point_in_polygon
+
+        if self.coverage:
+
+            kwargs = self.ancestors.covered_kwargs(lat, lon, **kwargs)
+
+            if kwargs == None:
+                return []
+
+        if not self.cache:
+            return await self._point_in_polygon(lat, lon, **kwargs)
+
+        filters = kwargs.get("filters", {})
+        possible = self.cache.get(lat, lon, filters)
+
+        if possible != None:
+            self.ancestors.incr("pip.cache.hit")
+            return possible
+
+        self.ancestors.incr("pip.cache.miss")
+
+        possible = await self._point_in_polygon(lat, lon, **kwargs)
+
+        candidates = None
+
+        if self.cache.wants_candidates(filters, possible):
+            candidates = await self.pip_candidates(possible, **kwargs)
+
+        self.cache.set(lat, lon, filters, possible, candidates=candidates)
+
+        return possible
+
+    async def pip_candidates(self, possible, **kwargs):
+
+        # see also: ancestors.pip_candidates
+
+        if not getattr(self.spatial_client, "intersects_paginated", None):
+            return None
+
+        filters = kwargs.get("filters", {})
+        candidates = {}
+
+        try:
+
+            for row in possible:
+
+                candidates[ row["properties"]["wof:id"] ] = row
+
+                async for c in self.spatial_client.intersects_paginated(row, filters=filters, as_feature=True):
+                    candidates.setdefault(c["properties"]["wof:id"], c)
+
+        except Exception as e:
+            logging.warning("failed to find candidates for point in polygon cache, because %s" % e)
+            return None
+
+        return list(candidates.values())
+
+    async def _point_in_polygon(self, lat, lon, **kwargs):
+
+        # see also: ancestors.pip_kwargs
+
+        kwargs, lean = self.ancestors.pip_kwargs(self.spatial_client, **kwargs)
+
+        if self.stats:
+
+            pid = kwargs.get("filters", {}).get("wof:placetype_id", None)
+
+            if type(pid) == list:
+                pid = "batch"
+
+            self.stats.incr("pip.%s" % pid)
+
+        # this includes any time spent waiting on other queries
+
+        with self.ancestors.timer("pip"):
+            possible = list(await self.spatial_client.point_in_polygon(lat, lon, **kwargs))
+
+        if lean:
+            self.ancestors.incr("pip.properties_only")
+            possible = self.ancestors.as_features(possible)
+
+        return possible
+
+    async def index_feature(self, feature, **kwargs):
+
+        rsp = await self.spatial_client.index_feature(feature, **kwargs)
+
+        if self.cache:
+            self.cache.invalidate(feature)
+
+        if self.coverage:
+            self.coverage.add_feature(feature)
+
+        return rsp
+
+    async def index_features(self, features, **kwargs):
+
+        # see also: ancestors.index_features
+
+        index_features = getattr(self.spatial_client, "index_features", None)
+
+        if index_features:
+            rsp = await index_features(features, **kwargs)
+        else:
+
+            rsp = []
+
+            for feature in features:
+                rsp.append(await self.spatial_client.index_feature(feature, **kwargs))
+
+        self.ancestors.incr("indexed", len(features))
+
+        if self.cache:
+
+            for feature in features:
+                self.cache.invalidate(feature)
+
+        if self.coverage:
+            self.coverage.add_features(features)
+
+        return rsp
+
+    async def possible_for_feature(self, feature, **kwargs):
+
+        # returns a dictionary mapping every candidate placetype for feature
+        # to a list of possible matches (see also: ancestors.candidate_placetypes)
+
+        lat, lon = mapzen.whosonfirst.utils.reverse_geocoordinates(feature)
+
+        placetypes = self.ancestors.candidate_placetypes(feature, **kwargs)
+
+        if len(placetypes) == 0:
+            return self.ancestors.bucket_possible(placetypes, [])
+
+        if self.batch:
+
+            _kwargs = self.ancestors.batch_query_kwargs(placetypes)
+
+            rows = await self.point_in_polygon(lat, lon, **_kwargs)
+            return self.ancestors.bucket_possible(placetypes, rows)
+
+        lookups = []
+
+        for p in placetypes:
+
+            _pt = mapzen.whosonfirst.placetypes.placetype(p)
+
+            _kwargs = {
+                'filters': {
+                    'wof:placetype_id' :  _pt.id(),
+                    'wof:is_superseded': 0,
+                    'wof:is_deprecated': 0,
+                    'wof:is_ceased': 0
+                } ,
+                'as_feature': True,
+            }
+
+            lookups.append(self.point_in_polygon(lat, lon, **_kwargs))
+
+        results = await asyncio.gather(*lookups)
+
+        possible_by_placetype = {}
+
+        for i in range(len(placetypes)):
+            possible_by_placetype[ str(placetypes[i]) ] = results[i]
+
+        return possible_by_placetype
+
+    async def rebuild_feature(self, feature, **kwargs):
+
+        async with self.limit():
+            return await self._rebuild_feature(feature, **kwargs)
+
+    async def _rebuild_feature(self, feature, **kwargs):
+
+        # assumes the caller is holding the semaphore
+
+        possible = await self.possible_for_feature(feature, **kwargs)
+
+        _kwargs = kwargs.copy()
+        _kwargs["possible"] = possible
+
+        return self.ancestors.rebuild_feature(feature, **_kwargs)
+
+    def check_kwargs(self, **kwargs):
+
+        # see notes above
+
+        unsupported = []
+
+        for k in unsupported_kwargs:
+
+            if kwargs.get(k, None) not in (None, False):
+                unsupported.append(k)
+
+        # concurrency is what 'concurrency' is for
+
+        if kwargs.get("workers", 1) > 1:
+            unsupported.append("workers")
+
+        if kwargs.get("descendants_from", "spatial") != "spatial":
+            unsupported.append("descendants_from=%s" % kwargs["descendants_from"])
+
+        if kwargs.get("query_geometry", None) != None:
+            unsupported.append("query_geometry=%s" % kwargs["query_geometry"])
+
+        if len(unsupported):
+            raise Exception("Unsupported arguments for async_ancestors: %s" % ", ".join(unsupported))
+
+    async def rebuild_descendants(self, feature, cb, **kwargs):
+
+        # cb may be a regular function or a coroutine function; either way
+        # it is only ever invoked for one feature at a time
+
+        self.check_kwargs(**kwargs)
+
+        updated = []
+
+        strict = kwargs.get("strict", False)
+        flush = kwargs.get("flush", None)
+
+        lock = asyncio.Lock()
+
+        async def rebuild(row, pid):
+
+            with self.ancestors.timer("descendant"):
+                await _rebuild(row, pid)
+
+        async def _rebuild(row, pid):
+
+            child = await self.run(self.ancestors.load_descendant, row, data_root=kwargs.get("data_root", None))
+
+            _kwargs = {
+                'as_feature': True,
+                'filters': {
+                    'wof:placetype_id': pid,
+                    'wof:is_superseded': 0,
+                    'wof:is_deprecated': 0,
+                    'wof:is_ceased': 0
+                }
+            }
+
+            child_changed = await self._rebuild_feature(child, **_kwargs)
+
+            if not child_changed:
+                return
+
+            child_props = child["properties"]
+
+            wofid = child_props["wof:id"]
+            repo = child_props["wof:repo"]
+
+            async with lock:
+
+                ok = cb(child)
+
+                if asyncio.iscoroutine(ok):
+                    ok = await ok
+
+            if not ok:
+
+                logging.error("post-rebuild callback failed for %s" % wofid)
+
+                if strict:
+                    raise Exception("post-rebuild callback failed for %s" % wofid)
+
+                return
+
+            if not repo in updated:
+                updated.append(repo)
+
+        for p in self.ancestors.descendant_placetypes(feature, **kwargs):
+
+            _p = mapzen.whosonfirst.placetypes.placetype(p)
+            pid = _p.id()
+
+            pg_kwargs = self.ancestors.descendant_query_kwargs(p, **kwargs)
+
+            self.debug(feature, "find intersecting places where placetype is %s" % p)
+
+            tasks = set()
+            errors = []
+
+            def done(t):
+
+                # this is called even if the task was cancelled before it
+                # ever started so it's where the slot gets handed back
+
+                tasks.discard(t)
+                self.limit().release()
+
+                if not t.cancelled() and t.exception():
+                    errors.append(t.exception())
+
+            try:
+
+                rows = self.spatial_client.intersects_paginated(feature, **pg_kwargs).__aiter__()
+
+                while True:
+
+                    # see also: ancestors.timed_rows
+
+                    with self.ancestors.timer("intersects"):
+
+                        try:
+                            row = await rows.__anext__()
+                        except StopAsyncIteration:
+                            break
+
+                    self.ancestors.incr("intersects.rows")
+
+                    if len(errors):
+                        raise errors[0]
+
+                    # wait for a free slot before starting anything new so that
+                    # we don't end up with a task for every descendant
+
+                    await self.limit().acquire()
+
+                    t = asyncio.ensure_future(rebuild(row, pid))
+                    t.add_done_callback(done)
+
+                    tasks.add(t)
+
+                if len(tasks):
+                    await asyncio.gather(*list(tasks))
+
+                if len(errors):
+                    raise errors[0]
+
+            except BaseException:
+
+                for t in list(tasks):
+                    t.cancel()
+
+                raise
+
+            # see notes in ancestors.iter_rebuild_descendants
+
+            if flush:
+
+                rsp = flush()
+
+                if asyncio.iscoroutine(rsp):
+                    await rsp
+
+        return updated
+
+    async def rebuild_and_export_feature(self, feature, **kwargs):
+
+        kwargs["rebuild_feature"] = True
+        kwargs["rebuild_descendants"] = True
+        kwargs["skip_check"] = True
+
+        return await self.rebuild_and_export(feature, **kwargs)
+
+    async def rebuild_and_export_descendants(self, feature, **kwargs):
+
+        kwargs["rebuild_feature"] = False
+        kwargs["rebuild_descendants"] = True
+
+        return await self.rebuild_and_export(feature, **kwargs)
+
+    async def rebuild_and_export(self, feature, **kwargs):
+
+        # see notes in ancestors.rebuild_and_export
+
+        self.debug(feature, "rebuild and export w/ kwargs %s" % kwargs)
+
+        data_root = kwargs.get("data_root", None)
+
+        rebuild_feature = kwargs.get("rebuild_feature", True)
+        rebuild_descendants = kwargs.get("rebuild_descendants", True)
+
+        skip_check = kwargs.get("skip_check", False)
+
+        if not data_root:
+            raise Exception("You forgot to specify a data_root parameter")
+
+        # before anything is written to disk
+
+        self.check_kwargs(**kwargs)
+
+        # the same writer (and the same 'export', 'import' and batch size
+        # arguments) as ancestors.rebuild_and_export except that index
+        # updates go through the async spatial client
+
+        writer = async_writer(self, **self.ancestors.export_writer_kwargs(**kwargs))
+
+        async def callback(feature):
+
+            props = feature["properties"]
+            repo = props.get("wof:repo", None)
+
+            self.debug(feature, "invoking rebuild and export callback")
+
+            if not repo:
+                raise Exception("WOF ID %s (%s) does not have a wof:repo property" % (props["wof:id"], props.get("wof:name", "NO NAME")))
+
+            return await writer.write_async(feature)
+
+        updated = []
+
+        try:
+
+            if rebuild_feature:
+
+                if await self.rebuild_feature(feature, **kwargs) or skip_check:
+
+                    if await callback(feature):
+                        props = feature["properties"]
+                        repo = props["wof:repo"]
+                        updated.append(repo)
+
+                # make sure the descendants see the new version of things
+
+                await writer.flush_async()
+
+            if rebuild_descendants:
+
+                for repo in await self.rebuild_descendants(feature, callback, flush=writer.flush_async, **kwargs):
+
+                    if not repo in updated:
+                        updated.append(repo)
+
+        finally:
+            await writer.flush_async()
+
+        return updated
+
+class async_writer(mapzen.whosonfirst.hierarchy.writer.writer):
+
+    # the same as mapzen.whosonfirst.hierarchy.writer.writer except that
+    # things are exported in an executor and (re) indexed by an async spatial
+    # client. call write_async and flush_async rather than write and flush.
+
+    def __init__(self, ancs, **kwargs):
+
+        mapzen.whosonfirst.hierarchy.writer.writer.__init__(self, ancs.ancestors, **kwargs)
+
+        self.async_ancestors = ancs
+
+    # write (see above) only buffers things and then calls these when a
+    # batch is full; write_async does the actual work
+
+    def flush_exports(self):
+        pass
+
+    def flush_index(self):
+        pass
+
+    async def write_async(self, feature):
+
+        self.write(feature)
+
+        if len(self.to_export) >= self.export_batch_size:
+            await self.flush_exports_async()
+
+        if len(self.to_index) >= self.index_batch_size:
+            await self.flush_index_async()
+
+        return True
+
+    async def flush_async(self):
+
+        # see also: writer.flush
+
+        try:
+            await self.flush_exports_async()
+        finally:
+            await self.flush_index_async()
+
+    async def flush_exports_async(self):
+
+        await self.async_ancestors.run(mapzen.whosonfirst.hierarchy.writer.writer.flush_exports, self)
+
+    async def flush_index_async(self):
+
+        features = self.ready_to_index()
+
+        if len(features) == 0:
+            return
+
+        logging.debug("REINDEX %s features" % len(features))
+
+        try:
+            await self.async_ancestors.index_features(features, **self.index_kwargs)
+        except Exception:
+            self.to_index = features + self.to_index
+            raise
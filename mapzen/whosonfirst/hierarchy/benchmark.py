@@ -0,0 +1,401 @@
+import os
+import copy
+import time
+import random
+import shutil
+import logging
+import tempfile
+
+import mapzen.whosonfirst.export
+
+import mapzen.whosonfirst.hierarchy
+import mapzen.whosonfirst.hierarchy.spatial
+import mapzen.whosonfirst.hierarchy.geometry
+
+# a reproducible benchmark for rebuilding hierarchies that doesn't need
+# PostGIS (or anything else). it generates a synthetic WOF-shaped dataset -
+# nested continent, country, region, county, locality and neighbourhood
+# boxes and venues inside the neighbourhoods - writes it to disk under a
+# temporary data_root and then times rebuild_feature, rebuild_descendants
+# and rebuild_and_export using the local spatial client, optionally wrapped
+# in something that adds latency to every query to make it a little more
+# like talking to a database (see also: scripts/wof-hierarchy-benchmark)
+#
+# for example:
+#
+# for rsp in mapzen.whosonfirst.hierarchy.benchmark.run(scales=["small", "medium"], pip_latency=0.001):
+#     print(rsp)
+
+# the number of children for each place, at each level
+
+scales = {
+    "small": {"countries": 1, "regions": 2, "counties": 2, "localities": 2, "neighbourhoods": 2, "venues": 5},
+    "medium": {"countries": 2, "regions": 3, "counties": 3, "localities": 3, "neighbourhoods": 3, "venues": 10},
+    "large": {"countries": 2, "regions": 4, "counties": 4, "localities": 4, "neighbourhoods": 4, "venues": 25},
+}
+
+levels = [
+    ("country", "countries"),
+    ("region", "regions"),
+    ("county", "counties"),
+    ("locality", "localities"),
+    ("neighbourhood", "neighbourhoods"),
+]
+
+admin_repo = "whosonfirst-data-admin-xy"
+venue_repo = "whosonfirst-data-venue-xy"
+
+def box(minx, miny, maxx, maxy):
+
+    return {
+        "type": "Polygon",
+        "coordinates": [[ [minx, miny], [maxx, miny], [maxx, maxy], [minx, maxy], [minx, miny] ]]
+    }
+
+def split(bbox, count, depth):
+
+    # split a bounding box in to count strips (alternating between columns
+    # and rows at each level) that are a little smaller than they need to
+    # be so that siblings never touch
+
+    minx, miny, maxx, maxy = bbox
+    boxes = []
+
+    for i in range(count):
+
+        if depth % 2 == 0:
+
+            w = (maxx - minx) / count
+            b = [ minx + (w * i), miny, minx + (w * (i + 1)), maxy ]
+
+        else:
+
+            h = (maxy - miny) / count
+            b = [ minx, miny + (h * i), maxx, miny + (h * (i + 1)) ]
+
+        dx = (b[2] - b[0]) * 0.01
+        dy = (b[3] - b[1]) * 0.01
+
+        boxes.append([ b[0] + dx, b[1] + dy, b[2] - dx, b[3] - dy ])
+
+    return boxes
+
+def record(wofid, placetype, repo, geom, bbox, parent_id, hierarchy):
+
+    lat = (bbox[1] + bbox[3]) / 2.0
+    lon = (bbox[0] + bbox[2]) / 2.0
+
+    return {
+        "type": "Feature",
+        "id": wofid,
+        "bbox": bbox,
+        "geometry": geom,
+        "properties": {
+            "wof:id": wofid,
+            "wof:name": "%s %s" % (placetype, wofid),
+            "wof:placetype": placetype,
+            "wof:repo": repo,
+            "wof:parent_id": parent_id,
+            "wof:hierarchy": [ hierarchy ],
+            "geom:latitude": lat,
+            "geom:longitude": lon,
+        }
+    }
+
+def generate(scale, **kwargs):
+
+    # yield all the features for a given scale (the name of one of the
+    # scales above or a dictionary of counts). if 'stale' is true (which is
+    # the default) venues have no parent or hierarchy so that there's
+    # something to do when they are rebuilt
+
+    if type(scale) != dict:
+        scale = scales[scale]
+
+    stale = kwargs.get("stale", True)
+    seed = kwargs.get("seed", 1)
+
+    rnd = random.Random(seed)
+
+    ids = { "next": 1000 }
+
+    def next_id():
+        ids["next"] += 1
+        return ids["next"]
+
+    continent_id = next_id()
+    continent_bbox = [ -170.0, -80.0, 170.0, 80.0 ]
+    continent_hier = { "continent_id": continent_id }
+
+    yield record(continent_id, "continent", admin_repo, box(*continent_bbox), continent_bbox, -1, continent_hier)
+
+    parents = [ (continent_id, continent_bbox, continent_hier) ]
+
+    for depth in range(len(levels)):
+
+        placetype, key = levels[depth]
+        children = []
+
+        for parent_id, parent_bbox, parent_hier in parents:
+
+            for bbox in split(parent_bbox, scale[key], depth):
+
+                wofid = next_id()
+
+                hier = dict(parent_hier)
+                hier["%s_id" % placetype] = wofid
+
+                yield record(wofid, placetype, admin_repo, box(*bbox), bbox, parent_id, hier)
+                children.append((wofid, bbox, hier))
+
+        parents = children
+
+    for parent_id, parent_bbox, parent_hier in parents:
+
+        minx, miny, maxx, maxy = parent_bbox
+
+        for i in range(scale["venues"]):
+
+            wofid = next_id()
+
+            lon = rnd.uniform(minx, maxx)
+            lat = rnd.uniform(miny, maxy)
+
+            hier = dict(parent_hier)
+            hier["venue_id"] = wofid
+
+            geom = { "type": "Point", "coordinates": [ lon, lat ] }
+            feature = record(wofid, "venue", venue_repo, geom, [ lon, lat, lon, lat ], parent_id, hier)
+
+            if stale:
+                feature["properties"]["wof:parent_id"] = -1
+                feature["properties"]["wof:hierarchy"] = []
+
+            yield feature
+
+def write(data_root, features):
+
+    # write features to disk as flatfiles, returning a dictionary of
+    # counts by placetype
+
+    exporters = {}
+    counts = {}
+
+    for feature in features:
+
+        props = feature["properties"]
+        repo = props["wof:repo"]
+
+        exporter = exporters.get(repo, None)
+
+        if exporter == None:
+
+            data = os.path.join(data_root, repo, "data")
+
+            if not os.path.exists(data):
+                os.makedirs(data)
+
+            exporter = mapzen.whosonfirst.export.flatfile(data)
+            exporters[repo] = exporter
+
+        exporter.export_feature(feature)
+
+        pt = props["wof:placetype"]
+        counts[pt] = counts.get(pt, 0) + 1
+
+    return counts
+
+class latency_client:
+
+    # wraps a spatial client and sleeps for a while before every query, and
+    # for every 'page_size' rows returned by intersects_paginated, to make a
+    # local client behave a little more like a remote database. latencies
+    # are in seconds.
+
+    def __init__(self, client, **kwargs):
+
+        self.client = client
+
+        self.pip_latency = kwargs.get("pip_latency", 0.0)
+        self.intersects_latency = kwargs.get("intersects_latency", 0.0)
+        self.index_latency = kwargs.get("index_latency", 0.0)
+
+        self.page_size = kwargs.get("page_size", 100)
+
+    def sleep(self, seconds):
+
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def point_in_polygon(self, lat, lon, **kwargs):
+
+        self.sleep(self.pip_latency)
+        return self.client.point_in_polygon(lat, lon, **kwargs)
+
+    def intersects(self, feature, **kwargs):
+
+        self.sleep(self.intersects_latency)
+        return self.client.intersects(feature, **kwargs)
+
+    def intersects_paginated(self, feature, **kwargs):
+
+        count = 0
+
+        for row in self.client.intersects_paginated(feature, **kwargs):
+
+            if count % self.page_size == 0:
+                self.sleep(self.intersects_latency)
+
+            count += 1
+            yield row
+
+    def index_feature(self, feature, **kwargs):
+
+        self.sleep(self.index_latency)
+        return self.client.index_feature(feature, **kwargs)
+
+    def __getattr__(self, name):
+
+        # point_in_polygon_many and index_features are optional so only
+        # pretend to have them if the client we're wrapping does
+
+        fn = getattr(self.client, name)
+
+        if name == "point_in_polygon_many":
+            latency = self.pip_latency
+        elif name == "index_features":
+            latency = self.index_latency
+        else:
+            return fn
+
+        def wrapped(*args, **kwargs):
+            self.sleep(latency)
+            return fn(*args, **kwargs)
+
+        return wrapped
+
+def timed(scale, phase, count, fn):
+
+    t1 = time.time()
+    fn()
+    t2 = time.time()
+
+    seconds = t2 - t1
+    per_second = None
+
+    if seconds > 0:
+        per_second = count / seconds
+
+    logging.info("%s %s %s records in %.3fs" % (scale, phase, count, seconds))
+
+    return {
+        "scale": scale,
+        "phase": phase,
+        "count": count,
+        "seconds": seconds,
+        "per_second": per_second,
+    }
+
+def run(**kwargs):
+
+    # yield a dictionary with the timings for each phase at each scale. any
+    # 'ancestors_kwargs' are passed to the ancestors class (for example
+    # batch or cache) and any 'descendants_kwargs' to rebuild_descendants
+    # and rebuild_and_export (for example workers)
+
+    names = kwargs.get("scales", [ "small" ])
+
+    ancestors_kwargs = kwargs.get("ancestors_kwargs", {})
+    descendants_kwargs = kwargs.get("descendants_kwargs", {})
+
+    latency_kwargs = {
+        "pip_latency": kwargs.get("pip_latency", 0.0),
+        "intersects_latency": kwargs.get("intersects_latency", 0.0),
+        "index_latency": kwargs.get("index_latency", 0.0),
+        "page_size": kwargs.get("page_size", 100),
+    }
+
+    for name in names:
+
+        features = list(generate(name, seed=kwargs.get("seed", 1)))
+
+        by_placetype = {}
+
+        for f in features:
+            pt = f["properties"]["wof:placetype"]
+            by_placetype.setdefault(pt, []).append(f)
+
+        data_root = tempfile.mkdtemp(prefix="wof-hierarchy-benchmark-")
+
+        try:
+
+            yield timed(name, "write", len(features), lambda: write(data_root, features))
+
+            clients = []
+
+            def load():
+                local = mapzen.whosonfirst.hierarchy.spatial.local(data_root=data_root)
+                clients.append(latency_client(local, **latency_kwargs))
+
+            yield timed(name, "load", len(features), load)
+
+            client = clients[0]
+
+            ancs = mapzen.whosonfirst.hierarchy.ancestors(spatial_client=client, **ancestors_kwargs)
+
+            # rebuild_feature, for all the venues
+
+            venues = [ copy.deepcopy(f) for f in by_placetype["venue"] ]
+
+            def rebuild_venues():
+
+                for f in venues:
+                    ancs.rebuild_feature(f)
+
+            yield timed(name, "rebuild_feature", len(venues), rebuild_venues)
+
+            # rebuild_descendants, for the first region, without exporting
+            # anything
+
+            region = copy.deepcopy(by_placetype["region"][0])
+            counts = { "descendants": 0 }
+
+            def rebuild_descendants():
+
+                for rsp in ancs.iter_rebuild_descendants(region, data_root=data_root, **descendants_kwargs):
+                    counts["descendants"] += 1
+
+            rsp = timed(name, "rebuild_descendants", 0, rebuild_descendants)
+            rsp["count"] = counts["descendants"]
+
+            if rsp["seconds"] > 0:
+                rsp["per_second"] = rsp["count"] / rsp["seconds"]
+
+            yield rsp
+
+            # rebuild_and_export, for the first country (this is last because
+            # it changes things on disk)
+
+            country = copy.deepcopy(by_placetype["country"][0])
+
+            def rebuild_and_export():
+                ancs.rebuild_and_export_feature(country, data_root=data_root, **descendants_kwargs)
+
+            # the country and everything inside it
+
+            total = 0
+
+            for f in features:
+
+                props = f["properties"]
+
+                if props["wof:placetype"] in ("continent", "country") and props["wof:id"] != country["properties"]["wof:id"]:
+                    continue
+
+                if mapzen.whosonfirst.hierarchy.geometry.bbox_contains(country["bbox"], props["geom:latitude"], props["geom:longitude"]):
+                    total += 1
+
+            yield timed(name, "rebuild_and_export", total, rebuild_and_export)
+
+        finally:
+            shutil.rmtree(data_root)
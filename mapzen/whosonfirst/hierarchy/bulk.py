@@ -0,0 +1,316 @@
+import os
+import sys
+import time
+import logging
+import multiprocessing
+
+import mapzen.whosonfirst.utils
+import mapzen.whosonfirst.export
+
+import mapzen.whosonfirst.hierarchy
+import mapzen.whosonfirst.hierarchy.index
+
+# helpers for rebuilding the hierarchies of lots of records at once, from
+# the command line (see also: scripts/wof-hierarchy-rebuild) using one or
+# more worker processes each with its own spatial client. everything that
+# crosses a process boundary is a plain old dictionary so that this works
+# whether processes are forked or spawned.
+
+def client(name, **kwargs):
+
+    # return a new spatial client; name is one of 'postgis', 'pip' or 'local'
+
+    if name == 'postgis':
+
+        import mapzen.whosonfirst.spatial.postgres
+
+        pg_args = {
+            "dbname": kwargs.get("pgis_database", "whosonfirst"),
+            "username": kwargs.get("pgis_username", "whosonfirst"),
+            "password": kwargs.get("pgis_password", None),
+            "host": kwargs.get("pgis_host", "localhost"),
+        }
+
+        return mapzen.whosonfirst.spatial.postgres.postgis(**pg_args)
+
+    if name == 'pip':
+
+        import mapzen.whosonfirst.spatial.whosonfirst
+        return mapzen.whosonfirst.spatial.whosonfirst.pip()
+
+    if name == 'local':
+
+        import mapzen.whosonfirst.hierarchy.spatial
+        return mapzen.whosonfirst.hierarchy.spatial.local(data_root=kwargs.get("data_root", None), repos=kwargs.get("local_repos", None))
+
+    raise Exception("Unsupported spatial client")
+
+def paths(args, **kwargs):
+
+    # yield the path of every record referenced by args which may be files,
+    # directories (in which case they are crawled), repos (directories with
+    # a data folder) or WOF IDs (which are looked for in each repo under
+    # data_root). if an arg is '-' then args are read from STDIN, one per line.
+    # args that can't be resolved are logged and, if 'errors' is a list, added
+    # to it so that the caller can tell that something was skipped.
+
+    data_root = kwargs.get("data_root", None)
+    stdin = kwargs.get("stdin", sys.stdin)
+    errors = kwargs.get("errors", None)
+
+    def failed(arg, msg):
+
+        logging.error(msg)
+
+        if errors != None:
+            errors.append(arg)
+
+    for arg in args:
+
+        if arg == "-":
+
+            for ln in stdin:
+
+                ln = ln.strip()
+
+                if ln == "" or ln.startswith("#"):
+                    continue
+
+                for path in paths([ ln ], data_root=data_root, errors=errors):
+                    yield path
+
+            continue
+
+        if os.path.isfile(arg):
+            yield arg
+            continue
+
+        if os.path.isdir(arg):
+
+            root = arg
+            data = os.path.join(arg, "data")
+
+            if os.path.isdir(data):
+                root = data
+
+            for path in crawl(root):
+                yield path
+
+            continue
+
+        if arg.isdigit():
+
+            path = find(int(arg), data_root)
+
+            if path:
+                yield path
+            else:
+                failed(arg, "unable to find %s in %s" % (arg, data_root))
+
+            continue
+
+        failed(arg, "%s is not a file, a directory or a WOF ID" % arg)
+
+def crawl(root):
+
+    for dirpath, dirs, files in os.walk(root):
+
+        dirs.sort()
+
+        for fname in sorted(files):
+
+            if not fname.endswith(".geojson"):
+                continue
+
+            # alternate geometries are not part of the hierarchy
+
+            if "-alt-" in fname:
+                continue
+
+            yield os.path.join(dirpath, fname)
+
+def find(wofid, data_root):
+
+    if not data_root or not os.path.isdir(data_root):
+        return None
+
+    rel = mapzen.whosonfirst.hierarchy.index.relpath(wofid)
+
+    for repo in sorted(os.listdir(data_root)):
+
+        path = os.path.join(data_root, repo, "data", rel)
+
+        if os.path.exists(path):
+            return path
+
+    return None
+
+# the state for a given worker process (see also: init_worker)
+
+_worker = {}
+
+def init_worker(options):
+
+    _worker["options"] = options
+    _worker["exporters"] = {}
+
+    sp_client = client(options["client"], **options)
+    _worker["ancestors"] = mapzen.whosonfirst.hierarchy.ancestors(spatial_client=sp_client, **options.get("ancestors_kwargs", {}))
+
+def rebuild_path(path):
+
+    # rebuild (and optionally export) the hierarchy for the record at path
+    # and return a dictionary describing what happened
+
+    options = _worker["options"]
+    ancs = _worker["ancestors"]
+
+    rsp = {
+        "path": path,
+    }
+
+    try:
+
+        feature = mapzen.whosonfirst.utils.load_file(path)
+        props = feature["properties"]
+
+        old_parent = props.get("wof:parent_id", -1)
+
+        changed = ancs.rebuild_feature(feature)
+
+        props = feature["properties"]
+
+        rsp["wof:id"] = props["wof:id"]
+        rsp["wof:name"] = props.get("wof:name", None)
+        rsp["wof:repo"] = props.get("wof:repo", None)
+        rsp["changed"] = changed
+        rsp["old_parent_id"] = old_parent
+        rsp["new_parent_id"] = props.get("wof:parent_id", -1)
+
+        if options.get("show_hierarchy", False):
+            rsp["wof:hierarchy"] = props.get("wof:hierarchy", [])
+
+        # only records that have changed are written back to disk, unless
+        # 'export_all' is true
+
+        if options.get("update", False) and (changed or options.get("export_all", False)):
+
+            repo = props["wof:repo"]
+            exporter = _worker["exporters"].get(repo, None)
+
+            if exporter == None:
+
+                data = os.path.join(options["data_root"], repo, "data")
+                exporter = mapzen.whosonfirst.export.flatfile(data)
+
+                _worker["exporters"][repo] = exporter
+
+            exporter.export_feature(feature)
+            rsp["exported"] = True
+
+    except Exception as e:
+
+        logging.error("failed to rebuild %s, because %s" % (path, e))
+        rsp["error"] = str(e)
+
+    # whatever was counted (or timed) for this record is handed back to be
+    # merged with everything else (see also: rebuild)
+
+    if ancs.stats:
+        rsp["stats"] = ancs.stats.drain()
+
+    return rsp
+
+def rebuild(paths, options, **kwargs):
+
+    # yield the output of rebuild_path for each of paths, in order, using
+    # 'workers' processes. if workers is 1 then everything happens in this
+    # process. if there is a 'stats' argument (a stats instance) then the
+    # stats from every worker are merged in to it.
+
+    workers = kwargs.get("workers", 1)
+    chunksize = kwargs.get("chunksize", 10)
+    stats = kwargs.get("stats", None)
+
+    def merge(rsp):
+
+        s = rsp.pop("stats", None)
+
+        if s and stats:
+            stats.merge(s)
+
+        return rsp
+
+    if workers <= 1:
+
+        init_worker(options)
+
+        for path in paths:
+            yield merge(rebuild_path(path))
+
+        return
+
+    pool = multiprocessing.Pool(processes=workers, initializer=init_worker, initargs=(options,))
+
+    try:
+
+        for rsp in pool.imap(rebuild_path, paths, chunksize):
+            yield merge(rsp)
+
+        pool.close()
+
+    except BaseException:
+        pool.terminate()
+        raise
+
+    finally:
+        pool.join()
+
+class progress:
+
+    # keeps track of (and periodically logs) how many things have been
+    # processed and how quickly
+
+    def __init__(self, **kwargs):
+
+        self.every = kwargs.get("every", 1000)
+
+        self.started = time.time()
+
+        self.count = 0
+        self.changed = 0
+        self.errors = 0
+
+    def add(self, rsp):
+
+        self.count += 1
+
+        if rsp.get("error", None):
+            self.errors += 1
+
+        elif rsp.get("changed", False):
+            self.changed += 1
+
+        if self.every and self.count % self.every == 0:
+            logging.info(self.report())
+
+    def summary(self):
+
+        elapsed = time.time() - self.started
+        rate = 0.0
+
+        if elapsed > 0:
+            rate = self.count / elapsed
+
+        return {
+            "count": self.count,
+            "changed": self.changed,
+            "errors": self.errors,
+            "elapsed": elapsed,
+            "per_second": rate,
+        }
+
+    def report(self):
+
+        s = self.summary()
+        return "processed %s records (%s changed, %s errors) in %.1fs, %.1f records per second" % (s["count"], s["changed"], s["errors"], s["elapsed"], s["per_second"])
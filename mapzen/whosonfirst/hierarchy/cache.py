@@ -0,0 +1,388 @@
+import copy
+import time
+import logging
+import threading
+import collections
+
+import mapzen.whosonfirst.placetypes
+import mapzen.whosonfirst.hierarchy.geometry
+
+# a bounded (LRU) cache of point-in-polygon results, keyed on a quantized
+# coordinate and the set of filters passed to the spatial client. it is meant
+# to be handed to mapzen.whosonfirst.hierarchy.ancestors, like this:
+#
+# cache = mapzen.whosonfirst.hierarchy.cache.pip_cache(size=50000, ttl=3600)
+# ancs = mapzen.whosonfirst.hierarchy.ancestors(spatial_client=pg_client, cache=cache)
+#
+# the ancestors class takes care of invalidating things when a feature is
+# (re) indexed by the spatial client
+
+class pip_cache:
+
+    def __init__(self, **kwargs):
+
+        # the maximum number of entries (per lookup type) before we start
+        # evicting the least recently used ones
+
+        self.size = kwargs.get("size", 10000)
+
+        # the number of seconds an entry is considered valid for; None
+        # means forever (or until it is evicted or invalidated)
+
+        self.ttl = kwargs.get("ttl", None)
+
+        # the number of decimal places coordinates are rounded to in order
+        # to generate a cache key. the default (6) is about 10cm which for
+        # the purposes of WOF records is the same point. fewer decimal places
+        # means more hits and less precision.
+
+        self.precision = kwargs.get("precision", 6)
+
+        # if true then remember the polygons returned by the spatial client,
+        # along with every other place (with the same filters) that overlaps
+        # them, and resolve subsequent points that fall inside them locally
+        # by testing the point against all of those places. this only works
+        # for lookups of a single placetype, when the spatial client returns
+        # geometries (as in 'as_feature=True') and when whoever calls 'set'
+        # supplies the 'candidates' argument (see also: wants_candidates and
+        # ancestors.pip_candidates); anything else is cached by point only
+
+        self.polygons = kwargs.get("polygons", False)
+
+        self.points = collections.OrderedDict()
+        self.containing = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+        self.lock = threading.Lock()
+
+    def filters_key(self, filters):
+
+        key = []
+
+        for k in sorted(filters.keys()):
+
+            v = filters[k]
+
+            if type(v) in (list, tuple, set):
+                v = tuple(sorted(v))
+
+            key.append((k, v))
+
+        return tuple(key)
+
+    def point_key(self, lat, lon, filters):
+
+        lat = round(float(lat), self.precision)
+        lon = round(float(lon), self.precision)
+
+        return (lat, lon, self.filters_key(filters))
+
+    def get(self, lat, lon, filters):
+
+        # returns a list of possible matches or None if there's nothing in
+        # the cache - note that an empty list is a valid (cached) result
+
+        now = time.time()
+        key = self.point_key(lat, lon, filters)
+
+        with self.lock:
+
+            entry = self.points.get(key, None)
+
+            if entry != None:
+
+                if self.is_expired(entry, now):
+
+                    del(self.points[key])
+                    self.expirations += 1
+
+                else:
+
+                    self.points.move_to_end(key)
+                    self.hits += 1
+
+                    return copy.deepcopy(entry["possible"])
+
+            if self.polygons:
+
+                possible = self.get_containing(lat, lon, key[2], now)
+
+                if possible != None:
+                    self.hits += 1
+                    return possible
+
+            self.misses += 1
+
+        return None
+
+    def get_containing(self, lat, lon, fkey, now):
+
+        # assumes the lock is held
+
+        entries = self.containing.get(fkey, None)
+
+        if not entries:
+            return None
+
+        for cache_key in list(entries.keys()):
+
+            entry = entries[cache_key]
+
+            if self.is_expired(entry, now):
+                del(entries[cache_key])
+                self.expirations += 1
+                continue
+
+            if not mapzen.whosonfirst.hierarchy.geometry.bbox_contains(entry["bbox"], lat, lon):
+                continue
+
+            contained = False
+
+            for geom in entry["geometries"]:
+
+                if mapzen.whosonfirst.hierarchy.geometry.contains(geom, lat, lon):
+                    contained = True
+                    break
+
+            if not contained:
+                continue
+
+            # anything that contains the point must overlap one of the
+            # polygons it's inside, so it's one of the candidates
+
+            possible = []
+
+            for bbox, row in entry["candidates"]:
+
+                if not mapzen.whosonfirst.hierarchy.geometry.bbox_contains(bbox, lat, lon):
+                    continue
+
+                if mapzen.whosonfirst.hierarchy.geometry.contains(row["geometry"], lat, lon):
+                    possible.append(row)
+
+            entries.move_to_end(cache_key)
+            return copy.deepcopy(possible)
+
+        return None
+
+    def wants_candidates(self, filters, possible):
+
+        # should the polygons in possible be remembered? if so whoever calls
+        # 'set' needs to pass a 'candidates' argument listing every place
+        # that matches filters and overlaps any of them
+
+        if not self.polygons or len(possible) == 0:
+            return False
+
+        pid = filters.get("wof:placetype_id", None)
+
+        if pid == None or type(pid) in (list, tuple, set):
+            return False
+
+        for row in possible:
+
+            if not row.get("geometry", None):
+                return False
+
+        return True
+
+    def set(self, lat, lon, filters, possible, **kwargs):
+
+        now = time.time()
+        key = self.point_key(lat, lon, filters)
+
+        entry = {
+            "possible": copy.deepcopy(possible),
+            "ids": self.ids(possible),
+            "lat": lat,
+            "lon": lon,
+            "created": now,
+        }
+
+        candidates = kwargs.get("candidates", None)
+
+        with self.lock:
+
+            self.points[key] = entry
+            self.points.move_to_end(key)
+
+            while len(self.points) > self.size:
+                self.points.popitem(last=False)
+                self.evictions += 1
+
+            if candidates != None and self.wants_candidates(filters, possible):
+                self.set_containing(key[2], entry, candidates, now)
+
+    def set_containing(self, fkey, entry, candidates, now):
+
+        # assumes the lock is held
+
+        geometries = []
+        bbox = None
+
+        for row in entry["possible"]:
+
+            geom = row["geometry"]
+            _bbox = mapzen.whosonfirst.hierarchy.geometry.bbox(geom)
+
+            if bbox == None:
+                bbox = _bbox
+            else:
+                bbox = [ min(bbox[0], _bbox[0]), min(bbox[1], _bbox[1]), max(bbox[2], _bbox[2]), max(bbox[3], _bbox[3]) ]
+
+            geometries.append(geom)
+
+        _candidates = []
+
+        for row in candidates:
+
+            geom = row.get("geometry", None)
+
+            if not geom:
+                return
+
+            _candidates.append((mapzen.whosonfirst.hierarchy.geometry.bbox(geom), copy.deepcopy(row)))
+
+        cache_key = tuple(sorted(entry["ids"]))
+
+        entries = self.containing.setdefault(fkey, collections.OrderedDict())
+
+        entries[cache_key] = {
+            "ids": self.ids(candidates),
+            "geometries": geometries,
+            "candidates": _candidates,
+            "bbox": bbox,
+            "created": now,
+        }
+
+        entries.move_to_end(cache_key)
+
+        count = 0
+
+        for e in self.containing.values():
+            count += len(e)
+
+        while count > self.size:
+
+            for k in list(self.containing.keys()):
+
+                e = self.containing[k]
+
+                if len(e):
+                    e.popitem(last=False)
+                    self.evictions += 1
+                    count -= 1
+                    break
+
+    def is_expired(self, entry, now):
+
+        if self.ttl == None:
+            return False
+
+        return (now - entry["created"]) > self.ttl
+
+    def ids(self, possible):
+
+        ids = set()
+
+        for row in possible:
+            ids.add(row["properties"]["wof:id"])
+
+        return ids
+
+    def invalidate(self, feature):
+
+        # remove anything that refers to this feature or that might be
+        # affected by it (as in it's geometry might now contain a cached
+        # point) - see also: ancestors.index_feature
+
+        props = feature["properties"]
+        wofid = props["wof:id"]
+
+        placetype_id = props.get("wof:placetype_id", None)
+
+        if placetype_id == None:
+
+            try:
+                pt = mapzen.whosonfirst.placetypes.placetype(props["wof:placetype"])
+                placetype_id = pt.id()
+            except Exception as e:
+                logging.warning("failed to determine placetype ID for %s, because %s" % (wofid, e))
+
+        bbox = None
+        geom = feature.get("geometry", None)
+
+        if geom:
+            bbox = mapzen.whosonfirst.hierarchy.geometry.bbox(geom)
+
+        def is_affected(fkey, ids, contains):
+
+            if wofid in ids:
+                return True
+
+            if bbox == None or not contains(bbox):
+                return False
+
+            filters = dict(fkey)
+            pid = filters.get("wof:placetype_id", None)
+
+            if pid == None or placetype_id == None:
+                return True
+
+            if type(pid) == tuple:
+                return placetype_id in pid
+
+            return placetype_id == pid
+
+        count = 0
+
+        with self.lock:
+
+            for key in list(self.points.keys()):
+
+                entry = self.points[key]
+                contains = lambda b: mapzen.whosonfirst.hierarchy.geometry.bbox_contains(b, entry["lat"], entry["lon"])
+
+                if is_affected(key[2], entry["ids"], contains):
+                    del(self.points[key])
+                    count += 1
+
+            for fkey, entries in self.containing.items():
+
+                for key in list(entries.keys()):
+
+                    entry = entries[key]
+                    contains = lambda b: mapzen.whosonfirst.hierarchy.geometry.bbox_intersects(b, entry["bbox"])
+
+                    if is_affected(fkey, entry["ids"], contains):
+                        del(entries[key])
+                        count += 1
+
+            self.invalidations += count
+
+        logging.debug("invalidated %s point in polygon cache entries for %s" % (count, wofid))
+        return count
+
+    def clear(self):
+
+        with self.lock:
+            self.points.clear()
+            self.containing.clear()
+
+    def stats(self):
+
+        with self.lock:
+
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+                "size": len(self.points),
+            }
@@ -0,0 +1,367 @@
+import os
+import json
+import logging
+import subprocess
+
+import mapzen.whosonfirst.utils
+
+import mapzen.whosonfirst.hierarchy.spatial
+
+# rebuilding hierarchies for just the records that have changed in a range
+# of commits in a (git) repo, rather than for the whole repo. only records
+# whose geometry (or the coordinates used for point-in-polygon lookups),
+# placetype or status (superseded, deprecated or ceased) has changed are
+# rebuilt and the descendants of a record are only rebuilt if it's the kind
+# of thing that has descendants. for example:
+#
+# ancs = mapzen.whosonfirst.hierarchy.ancestors(spatial_client=pg_client)
+#
+# for rsp in mapzen.whosonfirst.hierarchy.changes.rebuild(ancs, "/usr/local/data", "whosonfirst-data", "HEAD~1..HEAD"):
+#     print(rsp)
+#
+# records that have been deleted are removed from the spatial client (see
+# also: ancestors.remove_feature) before anything is rebuilt.
+#
+# the last thing yielded (unless 'update' is false) is a dictionary with a
+# single 'updated' key listing all the repos that were updated.
+#
+# records are read from disk (as in the working tree, which is assumed to be
+# the end of the commit range) and compared with the version at the start of
+# the range, read from the git history. see also: scripts/wof-hierarchy-rebuild
+# and the --git-range flag.
+
+def git(repo_path, *args):
+
+    cmd = [ "git", "-C", repo_path ] + list(args)
+
+    logging.debug(" ".join(cmd))
+
+    return subprocess.check_output(cmd)
+
+def parse_range(commits):
+
+    # "A..B" or just "A" which means "A..HEAD"
+
+    if ".." in commits:
+
+        start, end = commits.split("..", 1)
+
+        if end == "":
+            end = "HEAD"
+
+        return start, end
+
+    return commits, "HEAD"
+
+def changed_files(repo_path, commits):
+
+    # yield (status, path) tuples for all the records added, modified or
+    # deleted in a range of commits. status is 'A', 'M' or 'D' and paths are
+    # relative to repo_path. renames are reported as a delete and an add.
+
+    start, end = parse_range(commits)
+
+    out = git(repo_path, "diff", "--name-status", "--no-renames", "-z", start, end, "--", "data")
+    parts = out.decode("utf-8").split("\0")
+
+    for i in range(0, len(parts) - 1, 2):
+
+        status = parts[i][0:1]
+        path = parts[i + 1]
+
+        if not path.endswith(".geojson"):
+            continue
+
+        # alternate geometries are not part of the hierarchy
+
+        if "-alt-" in os.path.basename(path):
+            continue
+
+        if status == "T":
+            status = "M"
+
+        if not status in ("A", "M", "D"):
+            logging.warning("unexpected status '%s' for %s, skipping" % (status, path))
+            continue
+
+        yield status, path
+
+def show(repo_path, commit, path):
+
+    # returns the record at path as of commit (or None)
+
+    try:
+        out = git(repo_path, "show", "%s:%s" % (commit, path))
+    except subprocess.CalledProcessError as e:
+        logging.warning("failed to read %s at %s, because %s" % (path, commit, e))
+        return None
+
+    return json.loads(out.decode("utf-8"))
+
+def coordinates(feature):
+
+    try:
+        return mapzen.whosonfirst.utils.reverse_geocoordinates(feature)
+    except Exception as e:
+        return None
+
+def compare(old, new):
+
+    # returns a list of the reasons a record's hierarchy (or the hierarchies
+    # of its descendants) might have changed
+
+    if old == None:
+        return [ "added" ]
+
+    if new == None:
+        return [ "deleted" ]
+
+    reasons = []
+
+    old_props = old["properties"]
+    new_props = new["properties"]
+
+    old_geom = json.dumps(old.get("geometry", None), sort_keys=True)
+    new_geom = json.dumps(new.get("geometry", None), sort_keys=True)
+
+    if old_geom != new_geom or coordinates(old) != coordinates(new):
+        reasons.append("geometry")
+
+    if old_props.get("wof:placetype", None) != new_props.get("wof:placetype", None):
+        reasons.append("placetype")
+
+    if mapzen.whosonfirst.hierarchy.spatial.status(old_props) != mapzen.whosonfirst.hierarchy.spatial.status(new_props):
+        reasons.append("status")
+
+    return reasons
+
+def is_admin(ancs, feature):
+
+    # could this record have descendants?
+
+    geom = feature.get("geometry", None)
+
+    if not geom or not geom["type"] in ("Polygon", "MultiPolygon"):
+        return False
+
+    try:
+        return len(ancs.descendant_placetypes(feature)) > 0
+    except Exception as e:
+        logging.warning("failed to determine descendants for %s, because %s" % (feature["properties"].get("wof:id", None), e))
+        return False
+
+def changes(ancs, data_root, repo, commits):
+
+    # yield a dictionary for every record that changed in a range of commits
+    # in repo (under data_root), whether or not it needs to be rebuilt
+
+    repo_path = os.path.join(data_root, repo)
+    start, end = parse_range(commits)
+
+    for status, path in changed_files(repo_path, commits):
+
+        old = None
+        new = None
+
+        if status in ("M", "D"):
+            old = show(repo_path, start, path)
+
+        if status in ("A", "M"):
+
+            abs_path = os.path.join(repo_path, path)
+
+            if os.path.exists(abs_path):
+                new = mapzen.whosonfirst.utils.load_file(abs_path)
+            else:
+                logging.warning("%s has been removed since %s, skipping" % (abs_path, end))
+                continue
+
+        feature = new or old
+
+        if feature == None:
+            continue
+
+        props = feature["properties"]
+        reasons = compare(old, new)
+
+        yield {
+            "wof:id": props.get("wof:id", None),
+            "wof:placetype": props.get("wof:placetype", None),
+            "path": path,
+            "status": status,
+            "reasons": reasons,
+            "admin": is_admin(ancs, feature),
+            "old": old,
+            "new": new,
+        }
+
+def previous_root(old, new):
+
+    # the old version of an admin record, for finding descendants that were
+    # inside it but might not be any more, with its new hierarchy so that it
+    # can't be mistaken for the new version (see also: rebuilt.substitute)
+
+    root = dict(old)
+    root["properties"] = dict(old["properties"])
+
+    if new != None:
+
+        for k in ("wof:hierarchy", "wof:parent_id"):
+
+            if k in new["properties"]:
+                root["properties"][k] = new["properties"][k]
+
+    return root
+
+def rebuild(ancs, data_root, repo, commits, **kwargs):
+
+    # rebuild (and export, unless 'update' is false) the records that need
+    # it, yielding a dictionary for each record that changed. changed admin
+    # records are rebuilt first, from the top down, then the descendants of
+    # both their old and new versions (and of any deleted admin records) all
+    # at once so that descendants they have in common are only rebuilt once
+    # (see also: rebuild_and_export_many) and then everything else. once
+    # everything has been exported a final { "updated": [ repo, ... ] }
+    # dictionary listing all the repos that were updated is yielded. any
+    # other arguments are passed along to rebuild_and_export_many and
+    # rebuild_and_export.
+
+    update = kwargs.pop("update", True)
+
+    admins = []
+    previous = []
+    others = []
+    deleted = []
+
+    results = []
+
+    for ch in changes(ancs, data_root, repo, commits):
+
+        rsp = {
+            "wof:id": ch["wof:id"],
+            "wof:placetype": ch["wof:placetype"],
+            "path": ch["path"],
+            "status": ch["status"],
+            "reasons": ch["reasons"],
+            "rebuild": len(ch["reasons"]) > 0 and ch["new"] != None,
+            "descendants": False,
+        }
+
+        results.append(rsp)
+
+        if len(ch["reasons"]) == 0:
+            continue
+
+        old = ch["old"]
+        new = ch["new"]
+
+        if new == None:
+            deleted.append(old)
+
+        # descendants of the old version of an admin record, or a deleted
+        # one, may have lost their parent
+
+        if old != None and is_admin(ancs, old):
+
+            if new == None or "geometry" in ch["reasons"] or "placetype" in ch["reasons"]:
+                previous.append(previous_root(old, new))
+                rsp["descendants"] = True
+
+        if new == None:
+            continue
+
+        if ch["admin"]:
+            rsp["descendants"] = True
+            admins.append((rsp, new))
+        else:
+            others.append((rsp, new))
+
+    logging.info("%s changed records in %s (%s): %s admin, %s other, %s previous versions, %s deleted" % (len(results), repo, commits, len(admins), len(others), len(previous), len(deleted)))
+
+    if not update:
+
+        # nothing is written anywhere, including the spatial client, but
+        # deleted records still shouldn't be anyone's parent (see also:
+        # ancestors.remove_feature)
+
+        for feature in deleted:
+            ancs.removed.add(feature["properties"]["wof:id"])
+
+        # just say what would happen, and what the new parents would be
+
+        for rsp, feature in admins + others:
+            rsp["changed"] = ancs.rebuild_feature(feature)
+            rsp["new_parent_id"] = feature["properties"].get("wof:parent_id", -1)
+
+        for rsp in results:
+            yield rsp
+
+        return
+
+    # changed records are always exported (and re-indexed) whether or not
+    # their hierarchy has changed so that the spatial client sees their new
+    # geometry, placetype or status
+
+    _kwargs = dict(kwargs)
+    _kwargs["data_root"] = data_root
+    _kwargs["skip_check"] = True
+
+    for k in ("rebuild_feature", "rebuild_descendants"):
+        _kwargs.pop(k, None)
+
+    # deleted records are removed from the spatial client, the hierarchy
+    # index and the cache before anything is rebuilt so that their (former)
+    # descendants can't be re-parented on to them
+
+    for feature in deleted:
+        ancs.remove_feature(feature)
+
+    updated = []
+
+    if len(admins):
+
+        features = [ feature for rsp, feature in admins ]
+
+        for r in ancs.rebuild_and_export_many(features, rebuild_descendants=False, **_kwargs):
+
+            if not r in updated:
+                updated.append(r)
+
+        for rsp, feature in admins:
+            rsp["new_parent_id"] = feature["properties"].get("wof:parent_id", -1)
+
+    roots = previous + [ feature for rsp, feature in admins ]
+
+    if len(roots):
+
+        # the old versions of things aren't what the spatial client has any
+        # more so nothing can be resolved locally against them
+
+        if len(previous) and _kwargs.get("resolve_locally", False):
+            logging.warning("'resolve_locally' is not supported when the geometry of an admin record has changed, ignoring")
+            del(_kwargs["resolve_locally"])
+
+        for r in ancs.rebuild_and_export_many(roots, rebuild_feature=False, **_kwargs):
+
+            if not r in updated:
+                updated.append(r)
+
+    for rsp, feature in others:
+
+        for r in ancs.rebuild_and_export(feature, rebuild_feature=True, rebuild_descendants=False, **_kwargs):
+
+            if not r in updated:
+                updated.append(r)
+
+        rsp["new_parent_id"] = feature["properties"].get("wof:parent_id", -1)
+
+    for rsp in results:
+        yield rsp
+
+    # the repos that were updated, once, rather than with every record since
+    # most of them will have been updated by descendants rather than the
+    # record itself
+
+    yield {
+        "updated": updated,
+    }
@@ -0,0 +1,281 @@
+import os
+import json
+import math
+import logging
+import threading
+
+import mapzen.whosonfirst.utils
+import mapzen.whosonfirst.placetypes
+
+import mapzen.whosonfirst.hierarchy.geometry
+
+# a coarse index of where there are places of a given placetype, so that we
+# don't bother asking the spatial client for (say) campuses or microhoods at
+# a point where there aren't any, which is most of them. it is meant to be
+# handed to mapzen.whosonfirst.hierarchy.ancestors, like this:
+#
+# cov = mapzen.whosonfirst.hierarchy.coverage.coverage(cell_size=0.5)
+# cov.build("/usr/local/data", repos=[ "whosonfirst-data" ])
+#
+# ancs = mapzen.whosonfirst.hierarchy.ancestors(spatial_client=pg_client, coverage=cov)
+#
+# for each placetype (ID) it records the set of grid cells that the bounding
+# box of at least one place of that placetype overlaps. if the cell a point is
+# in isn't one of them there can't be a place of that placetype containing the
+# point. that is only true if coverage knows about every place that the spatial
+# client does so build it from the same data. placetypes that coverage has
+# never seen a place for (say because their repo wasn't loaded) are assumed to
+# be everywhere, unless they were listed in 'placetypes' and build has been
+# run. anything (re) indexed by the ancestors class is added; nothing is ever
+# removed, which is safe because it only means asking the spatial client when
+# we didn't need to.
+
+class coverage:
+
+    def __init__(self, **kwargs):
+
+        # in degrees
+
+        self.cell_size = float(kwargs.get("cell_size", 1.0))
+
+        # bounding boxes that would cover more than this many cells are kept
+        # in a list and checked one at a time instead (think continents and
+        # oceans)
+
+        self.max_cells = kwargs.get("max_cells", 10000)
+
+        # if present only these placetypes (names) are tracked; everything
+        # else is assumed to be everywhere
+
+        self.placetypes = None
+
+        if kwargs.get("placetypes", None) != None:
+            self.placetypes = set()
+
+            for p in kwargs["placetypes"]:
+                self.placetypes.add(mapzen.whosonfirst.placetypes.placetype(p).id())
+
+        self.cells = {}
+        self.large = {}
+
+        # the placetype IDs that coverage knows about, as in it's been told
+        # about at least one place of that placetype (or about all the places
+        # there are, see also: build); everything else is assumed to be
+        # everywhere
+
+        self.loaded = set()
+
+        self.lock = threading.Lock()
+
+    def cell(self, lat, lon):
+
+        x = int(math.floor(lon / self.cell_size))
+        y = int(math.floor(lat / self.cell_size))
+
+        return (x, y)
+
+    def placetype_id(self, props):
+
+        pid = props.get("wof:placetype_id", None)
+
+        if pid == None:
+            pt = mapzen.whosonfirst.placetypes.placetype(props["wof:placetype"])
+            pid = pt.id()
+
+        return int(pid)
+
+    def is_tracked(self, pid):
+
+        if self.placetypes == None:
+            return True
+
+        return int(pid) in self.placetypes
+
+    def add_feature(self, feature):
+
+        props = feature["properties"]
+        geom = feature.get("geometry", None)
+
+        if not geom:
+            return False
+
+        try:
+            pid = self.placetype_id(props)
+        except Exception as e:
+            logging.warning("failed to determine placetype ID for %s, because %s" % (props.get("wof:id", None), e))
+            return False
+
+        if not self.is_tracked(pid):
+            return False
+
+        bbox = feature.get("bbox", None) or mapzen.whosonfirst.hierarchy.geometry.bbox(geom)
+
+        self.add_bbox(pid, bbox)
+        return True
+
+    def add_features(self, features):
+
+        count = 0
+
+        for feature in features:
+
+            if self.add_feature(feature):
+                count += 1
+
+        return count
+
+    def add_bbox(self, pid, bbox):
+
+        minx, miny = self.cell(bbox[1], bbox[0])
+        maxx, maxy = self.cell(bbox[3], bbox[2])
+
+        pid = int(pid)
+
+        with self.lock:
+
+            self.loaded.add(pid)
+
+            if (maxx - minx + 1) * (maxy - miny + 1) > self.max_cells:
+                self.large.setdefault(pid, []).append(list(bbox))
+                return
+
+            cells = self.cells.setdefault(pid, set())
+
+            for x in range(minx, maxx + 1):
+
+                for y in range(miny, maxy + 1):
+                    cells.add((x, y))
+
+    def covers(self, lat, lon, pid):
+
+        # could there be a place with this placetype ID at this point?
+
+        pid = int(pid)
+
+        if not self.is_tracked(pid):
+            return True
+
+        if not pid in self.loaded:
+            return True
+
+        cells = self.cells.get(pid, None)
+
+        if cells and self.cell(lat, lon) in cells:
+            return True
+
+        for bbox in self.large.get(pid, []):
+
+            if mapzen.whosonfirst.hierarchy.geometry.bbox_contains(bbox, lat, lon):
+                return True
+
+        return False
+
+    def build(self, data_root, **kwargs):
+
+        # add every record in every repo (or just 'repos') under data_root
+
+        repos = kwargs.get("repos", None)
+
+        if repos == None:
+
+            repos = []
+
+            for repo in sorted(os.listdir(data_root)):
+
+                if os.path.isdir(os.path.join(data_root, repo, "data")):
+                    repos.append(repo)
+
+        count = 0
+
+        for repo in repos:
+
+            data = os.path.join(data_root, repo, "data")
+
+            logging.info("add %s to coverage index" % data)
+
+            for root, dirs, files in os.walk(data):
+
+                for fname in files:
+
+                    if not fname.endswith(".geojson"):
+                        continue
+
+                    if "-alt-" in fname:
+                        continue
+
+                    path = os.path.join(root, fname)
+
+                    try:
+                        feature = mapzen.whosonfirst.utils.load_file(path)
+                    except Exception as e:
+                        logging.warning("failed to load %s, because %s" % (path, e))
+                        continue
+
+                    if self.add_feature(feature):
+                        count += 1
+
+        # if we were told which placetypes to track then we now know about
+        # all of them, including the ones that there aren't any of
+
+        if self.placetypes != None:
+
+            with self.lock:
+                self.loaded.update(self.placetypes)
+
+        logging.info("added %s records to coverage index" % count)
+        return count
+
+    def dump(self, path):
+
+        cells = {}
+
+        for pid, _cells in self.cells.items():
+            cells[str(pid)] = sorted(map(list, _cells))
+
+        large = {}
+
+        for pid, bboxes in self.large.items():
+            large[str(pid)] = bboxes
+
+        placetypes = None
+
+        if self.placetypes != None:
+            placetypes = sorted(self.placetypes)
+
+        fh = open(path, "w")
+        json.dump({ "cell_size": self.cell_size, "placetypes": placetypes, "loaded": sorted(self.loaded), "cells": cells, "large": large }, fh)
+        fh.close()
+
+    def load(self, path):
+
+        fh = open(path, "r")
+        data = json.load(fh)
+        fh.close()
+
+        if data["cell_size"] != self.cell_size:
+            raise Exception("coverage index %s has a cell size of %s not %s" % (path, data["cell_size"], self.cell_size))
+
+        if data.get("placetypes", None) != None:
+            self.placetypes = set(data["placetypes"])
+
+        with self.lock:
+
+            for pid, _cells in data.get("cells", {}).items():
+
+                cells = self.cells.setdefault(int(pid), set())
+
+                for x, y in _cells:
+                    cells.add((x, y))
+
+            for pid, bboxes in data.get("large", {}).items():
+                self.large.setdefault(int(pid), []).extend(bboxes)
+
+            # older dumps don't say which placetypes were loaded
+
+            loaded = data.get("loaded", None)
+
+            if loaded == None:
+                loaded = list(data.get("cells", {}).keys()) + list(data.get("large", {}).keys())
+
+            for pid in loaded:
+                self.loaded.add(int(pid))
@@ -0,0 +1,592 @@
+# a small number of pure-Python geometry helpers for doing things locally
+# rather than asking a spatial client. these are not meant to be a general
+# purpose geometry library - they only know about the GeoJSON geometry types
+# that show up in WOF records.
+
+import math
+
+# numpy is optional; if it's present contains_many uses it to test lots of
+# points at once
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def coordinates(geom):
+
+    # yield every [ lon, lat ] position in a GeoJSON geometry
+
+    t = geom["type"]
+
+    if t == "GeometryCollection":
+
+        for g in geom["geometries"]:
+            for pt in coordinates(g):
+                yield pt
+
+        return
+
+    coords = geom["coordinates"]
+
+    if t == "Point":
+        yield coords
+
+    elif t in ("MultiPoint", "LineString"):
+
+        for pt in coords:
+            yield pt
+
+    elif t in ("MultiLineString", "Polygon"):
+
+        for ring in coords:
+            for pt in ring:
+                yield pt
+
+    elif t == "MultiPolygon":
+
+        for poly in coords:
+            for ring in poly:
+                for pt in ring:
+                    yield pt
+
+    else:
+        raise Exception("Unsupported geometry type %s" % t)
+
+def bbox(geom):
+
+    # returns [ minx, miny, maxx, maxy ]
+
+    minx = None
+    miny = None
+    maxx = None
+    maxy = None
+
+    for pt in coordinates(geom):
+
+        x = pt[0]
+        y = pt[1]
+
+        if minx == None or x < minx:
+            minx = x
+
+        if miny == None or y < miny:
+            miny = y
+
+        if maxx == None or x > maxx:
+            maxx = x
+
+        if maxy == None or y > maxy:
+            maxy = y
+
+    if minx == None:
+        raise Exception("Geometry has no coordinates")
+
+    return [ minx, miny, maxx, maxy ]
+
+def box(bbox):
+
+    # a GeoJSON polygon for [ minx, miny, maxx, maxy ]
+
+    minx, miny, maxx, maxy = bbox
+
+    return {
+        "type": "Polygon",
+        "coordinates": [[ [minx, miny], [maxx, miny], [maxx, maxy], [minx, maxy], [minx, miny] ]]
+    }
+
+def bbox_contains(bbox, lat, lon):
+
+    return bbox[0] <= lon <= bbox[2] and bbox[1] <= lat <= bbox[3]
+
+def bbox_distance(bbox, lat, lon):
+
+    # the (planar, in degrees) distance from a point to a bounding box, which
+    # is zero if the point is inside it
+
+    dx = max(bbox[0] - lon, 0.0, lon - bbox[2])
+    dy = max(bbox[1] - lat, 0.0, lat - bbox[3])
+
+    return math.hypot(dx, dy)
+
+def bbox_intersects(a, b):
+
+    if a[2] < b[0] or b[2] < a[0]:
+        return False
+
+    if a[3] < b[1] or b[3] < a[1]:
+        return False
+
+    return True
+
+def polygons(geom):
+
+    # yield each polygon (a list of rings) in a GeoJSON geometry
+
+    t = geom["type"]
+
+    if t == "Polygon":
+        yield geom["coordinates"]
+
+    elif t == "MultiPolygon":
+
+        for poly in geom["coordinates"]:
+            yield poly
+
+    elif t == "GeometryCollection":
+
+        for g in geom["geometries"]:
+            for poly in polygons(g):
+                yield poly
+
+def ring_contains(ring, lat, lon):
+
+    # plain old ray casting; points on the boundary may go either way
+
+    inside = False
+    count = len(ring)
+
+    j = count - 1
+
+    for i in range(count):
+
+        xi = ring[i][0]
+        yi = ring[i][1]
+
+        xj = ring[j][0]
+        yj = ring[j][1]
+
+        if (yi > lat) != (yj > lat):
+
+            x = (xj - xi) * (lat - yi) / (yj - yi) + xi
+
+            if lon < x:
+                inside = not inside
+
+        j = i
+
+    return inside
+
+def polygon_contains(poly, lat, lon):
+
+    if len(poly) == 0:
+        return False
+
+    if not ring_contains(poly[0], lat, lon):
+        return False
+
+    for hole in poly[1:]:
+
+        if ring_contains(hole, lat, lon):
+            return False
+
+    return True
+
+def contains(geom, lat, lon):
+
+    # does this GeoJSON geometry contain this point?
+
+    t = geom["type"]
+
+    if t == "Point":
+
+        coords = geom["coordinates"]
+        return coords[0] == lon and coords[1] == lat
+
+    if t == "MultiPoint":
+
+        for coords in geom["coordinates"]:
+
+            if coords[0] == lon and coords[1] == lat:
+                return True
+
+        return False
+
+    for poly in polygons(geom):
+
+        if polygon_contains(poly, lat, lon):
+            return True
+
+    return False
+
+def contains_many(geom, lats, lons):
+
+    # returns a list of booleans indicating whether each (lat, lon) pair
+    # is contained by a GeoJSON geometry
+
+    if numpy == None:
+
+        results = []
+
+        for i in range(len(lats)):
+            results.append(contains(geom, lats[i], lons[i]))
+
+        return results
+
+    lats = numpy.asarray(lats, dtype=float)
+    lons = numpy.asarray(lons, dtype=float)
+
+    t = geom["type"]
+
+    if t in ("Point", "MultiPoint"):
+
+        results = []
+
+        for i in range(len(lats)):
+            results.append(contains(geom, lats[i], lons[i]))
+
+        return results
+
+    inside = numpy.zeros(len(lats), dtype=bool)
+
+    for poly in polygons(geom):
+
+        if len(poly) == 0:
+            continue
+
+        in_poly = _ring_contains_many(poly[0], lats, lons)
+
+        for hole in poly[1:]:
+            in_poly &= ~_ring_contains_many(hole, lats, lons)
+
+        inside |= in_poly
+
+    return inside.tolist()
+
+def _ring_contains_many(ring, lats, lons):
+
+    # the same ray casting as ring_contains, one edge at a time across
+    # all the points
+
+    inside = numpy.zeros(len(lats), dtype=bool)
+    count = len(ring)
+
+    j = count - 1
+
+    for i in range(count):
+
+        xi = ring[i][0]
+        yi = ring[i][1]
+
+        xj = ring[j][0]
+        yj = ring[j][1]
+
+        j = i
+
+        if yi == yj:
+            continue
+
+        crosses = (yi > lats) != (yj > lats)
+        x = (xj - xi) * (lats - yi) / (yj - yi) + xi
+
+        inside ^= crosses & (lons < x)
+
+    return inside
+
+def segments(geom):
+
+    # yield each ([ x1, y1 ], [ x2, y2 ]) segment in the rings of a geometry
+
+    for poly in polygons(geom):
+
+        for ring in poly:
+
+            for i in range(len(ring) - 1):
+                yield ring[i], ring[i + 1]
+
+    t = geom["type"]
+
+    if t == "LineString":
+
+        coords = geom["coordinates"]
+
+        for i in range(len(coords) - 1):
+            yield coords[i], coords[i + 1]
+
+    elif t == "MultiLineString":
+
+        for coords in geom["coordinates"]:
+
+            for i in range(len(coords) - 1):
+                yield coords[i], coords[i + 1]
+
+def segment_distance(a, b, lat, lon):
+
+    # the (planar, in degrees) distance from a point to the segment a, b
+
+    dx = b[0] - a[0]
+    dy = b[1] - a[1]
+
+    t = 0.0
+
+    if dx != 0 or dy != 0:
+        t = ((lon - a[0]) * dx + (lat - a[1]) * dy) / (dx * dx + dy * dy)
+        t = min(max(t, 0.0), 1.0)
+
+    return math.hypot(lon - (a[0] + t * dx), lat - (a[1] + t * dy))
+
+def distance(geom, lat, lon):
+
+    # the (planar, in degrees) distance from a point to a geometry, which is
+    # zero if the point is inside it. this is what a 'buffer' argument to a
+    # spatial client is compared with.
+
+    if contains(geom, lat, lon):
+        return 0.0
+
+    d = None
+
+    for a, b in segments(geom):
+
+        _d = segment_distance(a, b, lat, lon)
+
+        if d == None or _d < d:
+            d = _d
+
+    if d == None:
+
+        # points (and multipoints)
+
+        for pt in coordinates(geom):
+
+            _d = math.hypot(lon - pt[0], lat - pt[1])
+
+            if d == None or _d < d:
+                d = _d
+
+    return d
+
+def _orientation(a, b, c):
+
+    v = (b[1] - a[1]) * (c[0] - b[0]) - (b[0] - a[0]) * (c[1] - b[1])
+
+    if v > 0:
+        return 1
+
+    if v < 0:
+        return -1
+
+    return 0
+
+def _on_segment(a, b, c):
+
+    return min(a[0], c[0]) <= b[0] <= max(a[0], c[0]) and min(a[1], c[1]) <= b[1] <= max(a[1], c[1])
+
+def segments_intersect(p1, p2, q1, q2):
+
+    o1 = _orientation(p1, p2, q1)
+    o2 = _orientation(p1, p2, q2)
+    o3 = _orientation(q1, q2, p1)
+    o4 = _orientation(q1, q2, p2)
+
+    if o1 != o2 and o3 != o4:
+        return True
+
+    if o1 == 0 and _on_segment(p1, q1, p2):
+        return True
+
+    if o2 == 0 and _on_segment(p1, q2, p2):
+        return True
+
+    if o3 == 0 and _on_segment(q1, p1, q2):
+        return True
+
+    if o4 == 0 and _on_segment(q1, p2, q2):
+        return True
+
+    return False
+
+def intersects(a, b, **kwargs):
+
+    # do these two GeoJSON geometries intersect? this is the brute-force
+    # approach (check whether any point of one is inside the other and then
+    # whether any of their edges cross) pruned by bounding boxes, which is
+    # good enough for comparing a handful of places but not much else
+
+    a_bbox = kwargs.get("a_bbox", None) or bbox(a)
+    b_bbox = kwargs.get("b_bbox", None) or bbox(b)
+
+    if not bbox_intersects(a_bbox, b_bbox):
+        return False
+
+    for pt in coordinates(a):
+
+        if contains(b, pt[1], pt[0]):
+            return True
+
+    for pt in coordinates(b):
+
+        if contains(a, pt[1], pt[0]):
+            return True
+
+    b_segments = []
+
+    for s in segments(b):
+
+        s_bbox = [ min(s[0][0], s[1][0]), min(s[0][1], s[1][1]), max(s[0][0], s[1][0]), max(s[0][1], s[1][1]) ]
+
+        if bbox_intersects(s_bbox, a_bbox):
+            b_segments.append((s, s_bbox))
+
+    if len(b_segments) == 0:
+        return False
+
+    for p1, p2 in segments(a):
+
+        p_bbox = [ min(p1[0], p2[0]), min(p1[1], p2[1]), max(p1[0], p2[0]), max(p1[1], p2[1]) ]
+
+        if not bbox_intersects(p_bbox, b_bbox):
+            continue
+
+        for (q1, q2), q_bbox in b_segments:
+
+            if not bbox_intersects(p_bbox, q_bbox):
+                continue
+
+            if segments_intersect(p1, p2, q1, q2):
+                return True
+
+    return False
+
+class tiling:
+
+    # splits the bounding box of a (multi) polygon in to square tiles that
+    # are 'size' degrees on a side and works out which of them the polygon
+    # might touch: the ones its edges pass through (or near, since this is
+    # done with the edges' bounding boxes) and the ones entirely inside it.
+    # it also answers point-in-polygon questions for the polygon without
+    # looking at every edge, which matters for countries: points in tiles
+    # entirely inside (or outside) it are easy and for everything else only
+    # the edges that span the same row of tiles can cross a ray cast from
+    # the point.
+
+    def __init__(self, geom, size, **kwargs):
+
+        self.geom = geom
+        self.bbox = kwargs.get("bbox", None) or bbox(geom)
+        self.size = float(size)
+
+        minx, miny, maxx, maxy = self.bbox
+
+        self.cols = max(1, int(math.ceil((maxx - minx) / self.size)))
+        self.rows = max(1, int(math.ceil((maxy - miny) / self.size)))
+
+        self.boundary = set()
+        self.inside = set()
+        self.edges = {}
+
+        for poly in polygons(geom):
+
+            for ring in poly:
+
+                for k in range(len(ring) - 1):
+
+                    x1, y1 = ring[k][0], ring[k][1]
+                    x2, y2 = ring[k + 1][0], ring[k + 1][1]
+
+                    i1, j1 = self.index(y1, x1)
+                    i2, j2 = self.index(y2, x2)
+
+                    for j in range(min(j1, j2), max(j1, j2) + 1):
+
+                        self.edges.setdefault(j, []).append((x1, y1, x2, y2))
+
+                        # the part of the edge in this row of tiles, so
+                        # that long diagonal edges don't mark everything
+                        # as the boundary
+
+                        xa, xb = x1, x2
+
+                        if y1 != y2:
+
+                            b = self.tile(0, j)
+
+                            ya = min(max(b[1], min(y1, y2)), max(y1, y2))
+                            yb = min(max(b[3], min(y1, y2)), max(y1, y2))
+
+                            xa = x1 + (x2 - x1) * (ya - y1) / (y2 - y1)
+                            xb = x1 + (x2 - x1) * (yb - y1) / (y2 - y1)
+
+                        eps = self.size * 0.000001
+
+                        ia = self.column(min(xa, xb) - eps)
+                        ib = self.column(max(xa, xb) + eps)
+
+                        for i in range(ia, ib + 1):
+                            self.boundary.add((i, j))
+
+        for i in range(self.cols):
+
+            for j in range(self.rows):
+
+                if (i, j) in self.boundary:
+                    continue
+
+                b = self.tile(i, j)
+
+                lat = (b[1] + b[3]) / 2.0
+                lon = (b[0] + b[2]) / 2.0
+
+                if self.ray_cast(j, lat, lon):
+                    self.inside.add((i, j))
+
+    def column(self, lon):
+
+        i = int(math.floor((lon - self.bbox[0]) / self.size))
+        return min(max(i, 0), self.cols - 1)
+
+    def row(self, lat):
+
+        j = int(math.floor((lat - self.bbox[1]) / self.size))
+        return min(max(j, 0), self.rows - 1)
+
+    def index(self, lat, lon):
+
+        return (self.column(lon), self.row(lat))
+
+    def tile(self, i, j):
+
+        minx = self.bbox[0] + (i * self.size)
+        miny = self.bbox[1] + (j * self.size)
+
+        return [ minx, miny, minx + self.size, miny + self.size ]
+
+    def tiles(self):
+
+        # the (i, j) index of every tile the polygon might touch
+
+        return sorted(self.boundary.union(self.inside))
+
+    def ray_cast(self, j, lat, lon):
+
+        # see also: ring_contains; this is the same thing for all the rings
+        # at once, which is the same as contains so long as the polygons in
+        # a multipolygon don't overlap
+
+        inside = False
+
+        for x1, y1, x2, y2 in self.edges.get(j, []):
+
+            if (y1 > lat) != (y2 > lat):
+
+                x = (x2 - x1) * (lat - y1) / (y2 - y1) + x1
+
+                if lon < x:
+                    inside = not inside
+
+        return inside
+
+    def contains(self, lat, lon):
+
+        if not bbox_contains(self.bbox, lat, lon):
+            return False
+
+        i, j = self.index(lat, lon)
+
+        if (i, j) in self.inside:
+            return True
+
+        if not (i, j) in self.boundary:
+            return False
+
+        return self.ray_cast(j, lat, lon)
@@ -0,0 +1,300 @@
+import os
+import logging
+import sqlite3
+import threading
+
+import mapzen.whosonfirst.utils
+
+import mapzen.whosonfirst.hierarchy.spatial
+
+# a local, on-disk (SQLite) index of who is whose parent and ancestor, so
+# that the descendants of a place can be found by asking "who has this ID
+# in their hierarchy" rather than "what intersects this polygon". that is
+# much cheaper for very big places and it also finds descendants that point
+# at a place but fall outside its geometry. it is kept up to date by
+# rebuild_and_export (see also: mapzen.whosonfirst.hierarchy.writer)
+#
+# for example:
+#
+# idx = mapzen.whosonfirst.hierarchy.index.hierarchy_index("/usr/local/data/hierarchy.db")
+# idx.build("/usr/local/data", repos=["whosonfirst-data-admin-us"])
+#
+# ancs = mapzen.whosonfirst.hierarchy.ancestors(spatial_client=pg_client, index=idx)
+# ancs.rebuild_and_export_feature(feature, data_root="/usr/local/data", descendants_from="both")
+
+schema = [
+    "CREATE TABLE IF NOT EXISTS places (id INTEGER PRIMARY KEY, parent_id INTEGER, placetype TEXT, repo TEXT, path TEXT, is_superseded INTEGER, is_deprecated INTEGER, is_ceased INTEGER, latitude REAL, longitude REAL)",
+    "CREATE TABLE IF NOT EXISTS ancestors (id INTEGER, ancestor_id INTEGER, ancestor_placetype TEXT)",
+    "CREATE INDEX IF NOT EXISTS ancestors_by_ancestor ON ancestors (ancestor_id)",
+    "CREATE INDEX IF NOT EXISTS ancestors_by_id ON ancestors (id)",
+    "CREATE INDEX IF NOT EXISTS places_by_parent ON places (parent_id)",
+]
+
+def relpath(wofid):
+
+    # the path for a WOF ID relative to a repo's data directory, as in
+    # 85834637 -> 858/346/37/85834637.geojson
+
+    tmp = str(wofid)
+    parts = []
+
+    while len(tmp) > 3:
+        parts.append(tmp[0:3])
+        tmp = tmp[3:]
+
+    if len(tmp):
+        parts.append(tmp)
+
+    parts.append("%s.geojson" % wofid)
+    return os.path.join(*parts)
+
+class hierarchy_index:
+
+    def __init__(self, path=":memory:", **kwargs):
+
+        self.path = path
+
+        # the connection is shared by all threads so every query happens
+        # while holding this lock
+
+        self.lock = threading.RLock()
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+
+        with self.lock:
+
+            for sql in schema:
+                self.conn.execute(sql)
+
+            # indexes created before places had coordinates (which are used
+            # to work out which tile they belong to when descendants are
+            # sharded) get empty ones until they are re-indexed
+
+            columns = [ row[1] for row in self.conn.execute("PRAGMA table_info(places)") ]
+
+            for col in ("latitude", "longitude"):
+
+                if not col in columns:
+                    self.conn.execute("ALTER TABLE places ADD COLUMN %s REAL" % col)
+
+            self.conn.commit()
+
+    def close(self):
+
+        with self.lock:
+            self.conn.close()
+
+    def build(self, data_root, **kwargs):
+
+        # (re) index all the records in one or more repos under data_root
+
+        repos = kwargs.get("repos", None)
+
+        if repos == None:
+
+            repos = []
+
+            for repo in sorted(os.listdir(data_root)):
+
+                if os.path.isdir(os.path.join(data_root, repo, "data")):
+                    repos.append(repo)
+
+        count = 0
+
+        for repo in repos:
+
+            data = os.path.join(data_root, repo, "data")
+            features = []
+
+            logging.info("add %s to hierarchy index" % data)
+
+            for root, dirs, files in os.walk(data):
+
+                for fname in files:
+
+                    if not fname.endswith(".geojson"):
+                        continue
+
+                    if "-alt-" in fname:
+                        continue
+
+                    path = os.path.join(root, fname)
+
+                    try:
+                        feature = mapzen.whosonfirst.utils.load_file(path)
+                    except Exception as e:
+                        logging.warning("failed to load %s, because %s" % (path, e))
+                        continue
+
+                    features.append(feature)
+
+                    if len(features) >= 1000:
+                        count += self.index_features(features)
+                        features = []
+
+            if len(features):
+                count += self.index_features(features)
+
+        logging.info("added %s records to hierarchy index" % count)
+        return count
+
+    def index_feature(self, feature, **kwargs):
+
+        return self.index_features([ feature ], **kwargs)
+
+    def index_features(self, features, **kwargs):
+
+        # add or update a list of features, all in a single transaction
+
+        count = 0
+
+        with self.lock:
+
+            try:
+
+                for feature in features:
+
+                    if self._index_feature(feature):
+                        count += 1
+
+                self.conn.commit()
+
+            except Exception as e:
+                self.conn.rollback()
+                raise e
+
+        return count
+
+    def _index_feature(self, feature):
+
+        # assumes the caller is holding the lock and will commit
+
+        props = feature["properties"]
+
+        wofid = props.get("wof:id", None)
+        placetype = props.get("wof:placetype", None)
+
+        if wofid == None or placetype == None:
+            logging.warning("feature is missing wof:id or wof:placetype, not indexing")
+            return False
+
+        is_superseded, is_deprecated, is_ceased = mapzen.whosonfirst.hierarchy.spatial.status(props)
+
+        try:
+            lat, lon = mapzen.whosonfirst.utils.reverse_geocoordinates(feature)
+        except Exception as e:
+            lat, lon = None, None
+
+        row = (
+            wofid,
+            props.get("wof:parent_id", -1),
+            placetype,
+            props.get("wof:repo", None),
+            relpath(wofid),
+            is_superseded,
+            is_deprecated,
+            is_ceased,
+            lat,
+            lon,
+        )
+
+        self.conn.execute("INSERT OR REPLACE INTO places (id, parent_id, placetype, repo, path, is_superseded, is_deprecated, is_ceased, latitude, longitude) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", row)
+        self.conn.execute("DELETE FROM ancestors WHERE id = ?", (wofid,))
+
+        # every ID in every hierarchy, except the feature itself and the
+        # placeholder (-1, -2, etc.) values
+
+        seen = set()
+
+        for h in props.get("wof:hierarchy", []):
+
+            for k, v in h.items():
+
+                if not k.endswith("_id"):
+                    continue
+
+                try:
+                    v = int(v)
+                except Exception as e:
+                    continue
+
+                if v <= 0 or v == wofid or v in seen:
+                    continue
+
+                seen.add(v)
+                self.conn.execute("INSERT INTO ancestors (id, ancestor_id, ancestor_placetype) VALUES (?, ?, ?)", (wofid, v, k[:-3]))
+
+        return True
+
+    def remove_feature(self, wofid):
+
+        with self.lock:
+
+            self.conn.execute("DELETE FROM places WHERE id = ?", (wofid,))
+            self.conn.execute("DELETE FROM ancestors WHERE id = ?", (wofid,))
+            self.conn.commit()
+
+    def get(self, wofid):
+
+        with self.lock:
+            rsp = self.conn.execute("SELECT id, parent_id, placetype, repo, path, latitude, longitude FROM places WHERE id = ?", (wofid,))
+            row = rsp.fetchone()
+
+        if row == None:
+            return None
+
+        return self.format_row(row)
+
+    def descendants(self, wofid, **kwargs):
+
+        # yield a row (formatted the same way as the features returned by
+        # a spatial client, but only with the properties we know about) for
+        # every current place that has wofid in its hierarchy or as its
+        # parent, optionally limited to a given placetype
+
+        placetype = kwargs.get("placetype", None)
+        current = kwargs.get("current", True)
+
+        sql = "SELECT p.id, p.parent_id, p.placetype, p.repo, p.path, p.latitude, p.longitude FROM places p WHERE p.id IN (SELECT id FROM ancestors WHERE ancestor_id = ? UNION SELECT id FROM places WHERE parent_id = ?)"
+        args = [ wofid, wofid ]
+
+        if placetype:
+            sql += " AND p.placetype = ?"
+            args.append(placetype)
+
+        if current:
+            sql += " AND p.is_superseded = 0 AND p.is_deprecated = 0 AND p.is_ceased = 0"
+
+        sql += " ORDER BY p.id"
+
+        # rows are fetched all at once because the same connection is used
+        # to update the index while descendants are being rebuilt
+
+        with self.lock:
+            rows = self.conn.execute(sql, args).fetchall()
+
+        for row in rows:
+            yield self.format_row(row)
+
+    def format_row(self, row):
+
+        wofid, parent_id, placetype, repo, path, lat, lon = row
+
+        props = {
+            "wof:id": wofid,
+            "wof:parent_id": parent_id,
+            "wof:placetype": placetype,
+            "wof:repo": repo,
+            "wof:path": path,
+        }
+
+        # the coordinates used for reverse geocoding, if we know them
+
+        if lat != None and lon != None:
+            props["reversegeo:latitude"] = lat
+            props["reversegeo:longitude"] = lon
+
+        return {
+            "type": "Feature",
+            "properties": props,
+        }
@@ -0,0 +1,299 @@
+import os
+import json
+import time
+import logging
+
+# a journal of progress for long-running calls to rebuild_and_export (or
+# rebuild_descendants) so that if something goes wrong halfway through a
+# country you don't have to start again from the beginning. it's a plain old
+# file with one JSON blob per line that is only ever appended to:
+#
+# {"event": "start", "root": 85633793, "time": 1508262341}
+# {"event": "feature", "id": 85633793, "repo": "whosonfirst-data"}
+# {"event": "records", "placetypes": ["region"], "rows": 1000, "ids": [...], "updated": [...]}
+# {"event": "placetypes", "placetypes": ["region"]}
+# {"event": "done", "time": 1508265941}
+#
+# records are only written to the journal once they have been dealt with
+# (for example flushed to disk by rebuild_and_export) so the worst thing that
+# can happen after a crash is that a few of them are done twice. on resume
+# placetypes that were finished are skipped entirely and anything else that
+# was already processed is skipped before it's loaded or rebuilt. spatial
+# clients don't expose their pagination cursors so the number of rows seen
+# for each placetype is recorded (and logged) but things are skipped by ID.
+#
+# records that couldn't be dealt with (see also: failed) are never written
+# to the journal and the placetypes they belong to are not marked as finished
+# so they are tried again on resume.
+#
+# if the journal says the last run finished then it is started over.
+
+class journal:
+
+    def __init__(self, path, feature, **kwargs):
+
+        self.path = path
+
+        # the number of processed records to keep in memory before writing
+        # them to the journal (which may mean flushing other things first)
+
+        self.checkpoint_size = kwargs.get("checkpoint_size", 1000)
+
+        props = feature["properties"]
+        self.root = props["wof:id"]
+
+        self.processed = set()
+        self.completed = set()
+        self.updated = []
+        self.rows = {}
+
+        self.feature = False
+        self.feature_repo = None
+
+        self.pending = []
+        self.pending_updated = []
+
+        # the IDs of records that failed since the last set of placetypes
+        # was completed, and how many failed altogether
+
+        self.failures = set()
+        self.failed_count = 0
+
+        self.fh = None
+
+        if os.path.exists(path):
+            self.load()
+
+        if self.fh == None:
+            self.start()
+
+    def load(self):
+
+        events = []
+
+        fh = open(self.path, "r")
+
+        for ln in fh:
+
+            ln = ln.strip()
+
+            if ln == "":
+                continue
+
+            try:
+                events.append(json.loads(ln))
+            except Exception as e:
+
+                # a partial line written just as something crashed
+
+                logging.warning("failed to parse journal entry in %s, because %s" % (self.path, e))
+
+        fh.close()
+
+        if len(events) == 0:
+            return
+
+        start = events[0]
+
+        if start.get("event", None) != "start":
+            raise Exception("%s is not a valid journal" % self.path)
+
+        if start.get("root", None) != self.root:
+            raise Exception("journal %s is for %s not %s" % (self.path, start.get("root", None), self.root))
+
+        if events[-1].get("event", None) == "done":
+            logging.info("journal %s is for a run that finished, starting over" % self.path)
+            return
+
+        for e in events[1:]:
+
+            event = e.get("event", None)
+
+            if event == "feature":
+
+                self.feature = True
+                self.feature_repo = e.get("repo", None)
+
+                if self.feature_repo and not self.feature_repo in self.updated:
+                    self.updated.append(self.feature_repo)
+
+            elif event == "records":
+
+                for wofid in e.get("ids", []):
+                    self.processed.add(wofid)
+
+                for repo in e.get("updated", []):
+
+                    if not repo in self.updated:
+                        self.updated.append(repo)
+
+                key = ";".join(e.get("placetypes", []))
+                self.rows[key] = max(self.rows.get(key, 0), e.get("rows", 0))
+
+            elif event == "placetypes":
+
+                for p in e.get("placetypes", []):
+                    self.completed.add(p)
+
+        logging.info("resume from journal %s, %s records processed, %s placetypes complete" % (self.path, len(self.processed), len(self.completed)))
+
+        for p, count in self.rows.items():
+            logging.info("resume %s after %s rows" % (p, count))
+
+        self.fh = open(self.path, "a")
+
+    def start(self):
+
+        self.processed = set()
+        self.completed = set()
+        self.updated = []
+        self.rows = {}
+
+        self.feature = False
+        self.feature_repo = None
+
+        self.fh = open(self.path, "w")
+        self.write({"event": "start", "root": self.root, "time": int(time.time())})
+
+    def write(self, event):
+
+        # one line at a time, and make sure it's on disk before returning
+
+        if self.fh == None:
+            self.fh = open(self.path, "a")
+
+        self.fh.write(json.dumps(event) + "\n")
+        self.fh.flush()
+
+        os.fsync(self.fh.fileno())
+
+    def close(self):
+
+        if self.fh:
+            self.fh.close()
+            self.fh = None
+
+    def finish(self):
+
+        # a run where something failed isn't finished, so that the next one
+        # picks up (only) whatever failed rather than starting over
+
+        if self.failed_count:
+            logging.warning("%s records failed, not marking journal %s as done" % (self.failed_count, self.path))
+            self.close()
+            return
+
+        self.write({"event": "done", "time": int(time.time())})
+        self.close()
+
+    def feature_done(self, repo=None):
+
+        self.feature = True
+        self.feature_repo = repo
+
+        if repo and not repo in self.updated:
+            self.updated.append(repo)
+
+        self.write({"event": "feature", "id": self.root, "repo": repo})
+
+    def is_complete(self, placetypes):
+
+        for p in placetypes:
+
+            if not str(p) in self.completed:
+                return False
+
+        return True
+
+    def filter(self, rows, placetypes):
+
+        # skip (placetype ID, row) tuples that have already been processed
+
+        key = ";".join(map(str, placetypes))
+        count = 0
+        skipped = 0
+
+        for pid, row in rows:
+
+            count += 1
+            self.rows[key] = count
+
+            if row["properties"]["wof:id"] in self.processed:
+                skipped += 1
+                continue
+
+            yield pid, row
+
+        if skipped:
+            logging.info("skipped %s (of %s) %s records already in journal" % (skipped, count, key))
+
+    def record(self, rsp):
+
+        # see also: ancestors.rebuild_descendant_record
+
+        self.pending.append(rsp["wof:id"])
+
+        repo = rsp.get("wof:repo", None)
+
+        if rsp.get("changed", False) and repo and not repo in self.pending_updated:
+            self.pending_updated.append(repo)
+
+    def failed(self, wofid):
+
+        # something that couldn't be dealt with (say because exporting it
+        # failed) is left out of the journal so it's tried again next time
+
+        self.failures.add(wofid)
+        self.failed_count += 1
+
+    def should_checkpoint(self):
+
+        return len(self.pending) >= self.checkpoint_size
+
+    def checkpoint(self, placetypes):
+
+        # assumes that everything pending has been dealt with
+
+        if len(self.pending) == 0:
+            return
+
+        key = ";".join(map(str, placetypes))
+
+        event = {
+            "event": "records",
+            "placetypes": list(map(str, placetypes)),
+            "rows": self.rows.get(key, 0),
+            "ids": self.pending,
+            "updated": self.pending_updated,
+        }
+
+        self.write(event)
+
+        for wofid in self.pending:
+            self.processed.add(wofid)
+
+        for repo in self.pending_updated:
+
+            if not repo in self.updated:
+                self.updated.append(repo)
+
+        self.pending = []
+        self.pending_updated = []
+
+    def complete(self, placetypes):
+
+        self.checkpoint(placetypes)
+
+        # if anything failed then these placetypes aren't finished, so that
+        # they are looked at again on resume (and anything that didn't fail
+        # is skipped)
+
+        if len(self.failures):
+            logging.warning("%s records (%s) failed, not marking them as complete in journal" % (len(self.failures), ";".join(map(str, placetypes))))
+            self.failures = set()
+            return
+
+        for p in placetypes:
+            self.completed.add(str(p))
+
+        self.write({"event": "placetypes", "placetypes": list(map(str, placetypes))})
@@ -0,0 +1,158 @@
+import sys
+import threading
+import queue
+
+# helpers for running (blocking) generators in background threads and
+# consuming their output in the calling thread, with a bounded amount of
+# stuff held in memory at any given time
+
+class _done:
+    pass
+
+class _failed:
+
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+def start(iterables, **kwargs):
+
+    # start consuming each of iterables in its own thread right now, returning
+    # a (queue, stop, threads) tuple for handing to consume (see also: merge)
+
+    maxsize = kwargs.get("maxsize", 1000)
+
+    q = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+
+    def put(item):
+
+        # don't block forever if the consumer has gone away
+
+        while not stop.is_set():
+
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    def produce(iterable):
+
+        try:
+
+            for item in iterable:
+
+                if not put(item):
+                    break
+
+        except Exception:
+            put(_failed(sys.exc_info()))
+
+        finally:
+
+            close = getattr(iterable, "close", None)
+
+            if close:
+                close()
+
+            put(_done())
+
+    threads = []
+
+    for iterable in iterables:
+
+        t = threading.Thread(target=produce, args=(iterable,))
+        t.daemon = True
+        t.start()
+
+        threads.append(t)
+
+    return q, stop, threads
+
+def consume(q, stop, threads):
+
+    remaining = len(threads)
+
+    try:
+
+        while remaining > 0:
+
+            item = q.get()
+
+            if isinstance(item, _done):
+                remaining -= 1
+                continue
+
+            if isinstance(item, _failed):
+                raise item.exc_info[1].with_traceback(item.exc_info[2])
+
+            yield item
+
+    finally:
+
+        stop.set()
+
+        for t in threads:
+            t.join()
+
+def merge(iterables, **kwargs):
+
+    # consume each iterable in its own thread and yield items as they
+    # arrive, in whatever order that happens to be. 'maxsize' is the number
+    # of items that may be waiting to be consumed before the threads block.
+    # if any of the iterables raise an exception it is re-raised here and
+    # the other threads are told to stop. nothing happens until the first
+    # item is asked for.
+
+    q, stop, threads = start(iterables, **kwargs)
+    items = consume(q, stop, threads)
+
+    try:
+
+        for item in items:
+            yield item
+
+    finally:
+        items.close()
+
+def readahead(iterable, **kwargs):
+
+    # consume iterable in a background thread, staying up to 'maxsize'
+    # items ahead of whoever is consuming them here, and yield items in the
+    # same order - for example so that the next page of a paginated query
+    # is being fetched while the current one is being processed. if the
+    # caller stops early the background thread is told to stop too.
+
+    return merge([ iterable ], maxsize=kwargs.get("maxsize", 1000))
+
+class prefetch:
+
+    # the same as readahead except that the background thread is started
+    # straight away, rather than when the first item is asked for, so that
+    # (for example) lots of queries can be running while we're busy with
+    # something else. be sure to call close if you don't consume everything.
+
+    def __init__(self, iterable, **kwargs):
+
+        self.q, self.stop, self.threads = start([ iterable ], maxsize=kwargs.get("maxsize", 1000))
+        self.items = consume(self.q, self.stop, self.threads)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.items)
+
+    def close(self):
+
+        # closing a generator that was never started doesn't run its
+        # finally block so stop things here too
+
+        self.items.close()
+
+        self.stop.set()
+
+        for t in self.threads:
+            t.join()
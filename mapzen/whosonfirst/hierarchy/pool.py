@@ -0,0 +1,156 @@
+import logging
+import threading
+import collections
+import concurrent.futures
+
+# helpers for rebuilding descendants using a pool of threads or processes
+# (see also: ancestors.rebuild_descendants and the 'workers' argument)
+#
+# thread pools share the ancestors instance (and its cache) and, by default,
+# its spatial client - which means the spatial client needs to be thread-safe.
+# if it isn't pass a 'client_factory' argument (a function that returns a new
+# spatial client) and each thread will get its own.
+#
+# process pools always need a 'client_factory' argument since spatial clients
+# (and their database connections) can't be shared across processes. it needs
+# to be something that can be pickled, like a plain old module-level function.
+# processes do not share the point-in-polygon cache since they would never see
+# the invalidations that happen when descendants are re-indexed.
+
+# processes have their own stats instance (if the parent has one) which is
+# drained after every record and merged back in to the parent's.
+
+# the ancestors instance for a given process in a process pool
+
+_ancestors = None
+
+def init_process(factory, options):
+
+    global _ancestors
+
+    import mapzen.whosonfirst.hierarchy
+
+    client = factory()
+    _ancestors = mapzen.whosonfirst.hierarchy.ancestors(spatial_client=client, **options)
+
+def rebuild_descendant_process(row, pid, kwargs):
+
+    rsp = _ancestors.rebuild_descendant_record(row, pid, **kwargs)
+    stats = None
+
+    if _ancestors.stats:
+        stats = _ancestors.stats.drain()
+
+    return rsp, stats
+
+def rebuild_descendants(ancs, rows, **kwargs):
+
+    # this yields the output of ancestors.rebuild_descendant_record in the
+    # same order as the rows it was derived from
+
+    workers = kwargs.get("workers", 1)
+    pool = kwargs.get("pool", "thread")
+    factory = kwargs.get("client_factory", None)
+
+    # the maximum number of rows that are being rebuilt (or waiting to be
+    # rebuilt) at any given time, so that memory stays flat no matter how
+    # many descendants there are
+
+    backlog = kwargs.get("backlog", workers * 2)
+
+    # only pass along the things that rebuild_descendant needs because
+    # kwargs may contain things (like callbacks) that can't be pickled
+
+    _kwargs = {}
+
+    for k in ("data_root", "use_spatial_feature", "complete_features", "required_properties", "splice", "rebuilt"):
+
+        if k in kwargs:
+            _kwargs[k] = kwargs[k]
+
+    if pool == "process":
+
+        # the places rebuilt during a top down run live in this process and
+        # copying them to every task would cost more than it saves, so
+        # processes ask the spatial client like everyone else
+
+        if _kwargs.pop("rebuilt", None):
+            logging.warning("process pools don't share rebuilt places, descendants will be resolved by the spatial client")
+
+        if not factory:
+            raise Exception("You must specify a client_factory parameter to rebuild descendants with a process pool")
+
+        options = {
+            "batch": ancs.batch,
+            "required_properties": ancs.required_properties,
+            "properties_only": ancs.properties_only,
+            "pip_properties": ancs.pip_properties,
+            "stats": ancs.stats != None,
+            "removed": ancs.removed,
+        }
+
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=init_process, initargs=(factory, options))
+        fn = rebuild_descendant_process
+
+    elif pool == "thread":
+
+        local = threading.local()
+
+        def fn(row, pid, kwargs):
+
+            _ancs = ancs
+
+            if factory:
+
+                _ancs = getattr(local, "ancestors", None)
+
+                if _ancs == None:
+                    _ancs = ancs.clone(spatial_client=factory())
+                    local.ancestors = _ancs
+
+            return _ancs.rebuild_descendant_record(row, pid, **kwargs)
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    else:
+        raise Exception("Unsupported pool type '%s'" % pool)
+
+    logging.info("rebuild descendants with a %s pool of %s workers" % (pool, workers))
+
+    def result(f):
+
+        rsp = f.result()
+
+        if pool == "process":
+
+            rsp, stats = rsp
+
+            if stats and ancs.stats:
+                ancs.stats.merge(stats)
+
+        return rsp
+
+    pending = collections.deque()
+
+    try:
+
+        for pid, row in rows:
+
+            pending.append(executor.submit(fn, row, pid, _kwargs))
+
+            while len(pending) >= backlog:
+                yield result(pending.popleft())
+
+        while len(pending):
+            yield result(pending.popleft())
+
+    finally:
+
+        # as in something went wrong or the caller has stopped listening
+        # (for example because the 'strict' flag is set) so don't bother
+        # with anything that hasn't started yet
+
+        for f in pending:
+            f.cancel()
+
+        executor.shutdown(wait=True)
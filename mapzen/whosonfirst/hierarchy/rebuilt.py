@@ -0,0 +1,176 @@
+import copy
+import logging
+import threading
+
+import mapzen.whosonfirst.placetypes
+
+import mapzen.whosonfirst.hierarchy.geometry
+
+# the places that have been rebuilt during a (top down) run of
+# rebuild_descendants, so that their descendants can be resolved against
+# the new version of things rather than whatever the spatial client has
+# (which might be out of date if it hasn't been re-indexed yet) - see also:
+# the 'top_down' argument to ancestors.iter_rebuild_descendants_many
+#
+# only places whose placetype is an ancestor of something that is still
+# to be rebuilt are kept, so venues (for example) are never held on to.
+#
+# if 'resolve_locally' is true then point-in-polygon lookups for a placetype
+# that has been finished, for points inside one of the root features, are
+# answered here without asking the spatial client at all. that assumes that
+# every place of that placetype that contains the point was rebuilt, which
+# is only true if everything that intersects the roots' geometries was (and
+# not just the things whose centroid is inside them, which is what usually
+# happens) so places of those placetypes are looked up without checking their
+# centroid (see also: resolves and ancestors.descendant_query_kwargs). it's
+# not the default.
+
+class rebuilt:
+
+    def __init__(self, roots, placetypes, **kwargs):
+
+        self.resolve_locally = kwargs.get("resolve_locally", False)
+        self.roles = kwargs.get("roles", [ "common", "common_optional", "optional" ])
+
+        self.lock = threading.Lock()
+
+        self.by_id = {}
+        self.by_placetype = {}
+        self.completed = set()
+
+        self.roots = []
+
+        # the placetypes that someone might want to look up
+
+        self.wanted = set()
+
+        for p in placetypes:
+
+            pt = mapzen.whosonfirst.placetypes.placetype(p)
+
+            for a in list(pt.parents()) + list(pt.ancestors(self.roles)):
+                self.wanted.add(str(a))
+
+        for f in roots:
+
+            self.add(f)
+
+            geom = f.get("geometry", None)
+
+            if geom and geom.get("type", None) in ("Polygon", "MultiPolygon"):
+                self.roots.append((f.get("bbox", None) or mapzen.whosonfirst.hierarchy.geometry.bbox(geom), geom))
+
+    def add(self, feature):
+
+        props = feature["properties"]
+        p = props.get("wof:placetype", None)
+
+        if not p in self.wanted:
+            return False
+
+        bbox = None
+        geom = feature.get("geometry", None)
+
+        if self.resolve_locally and geom:
+            bbox = feature.get("bbox", None) or mapzen.whosonfirst.hierarchy.geometry.bbox(geom)
+
+        with self.lock:
+
+            self.by_id[props["wof:id"]] = feature
+            self.by_placetype.setdefault(p, []).append((bbox, feature))
+
+        return True
+
+    def resolves(self, placetype):
+
+        # will lookups for places of this placetype be answered locally once
+        # they've all been rebuilt?
+
+        return self.resolve_locally and str(placetype) in self.wanted
+
+    def get(self, wofid):
+
+        return self.by_id.get(wofid, None)
+
+    def complete(self, placetypes):
+
+        # all the places of these placetypes have been added
+
+        with self.lock:
+
+            for p in placetypes:
+                self.completed.add(str(p))
+
+    def inside_roots(self, lat, lon):
+
+        for bbox, geom in self.roots:
+
+            if not mapzen.whosonfirst.hierarchy.geometry.bbox_contains(bbox, lat, lon):
+                continue
+
+            if mapzen.whosonfirst.hierarchy.geometry.contains(geom, lat, lon):
+                return True
+
+        return False
+
+    def point_in_polygon(self, lat, lon, placetype):
+
+        # returns a list of places of placetype that contain (lat, lon) or
+        # None if we can't say for sure (in which case ask the spatial client)
+
+        if not self.resolve_locally:
+            return None
+
+        p = str(placetype)
+
+        if not p in self.completed:
+            return None
+
+        if not self.inside_roots(lat, lon):
+            return None
+
+        possible = []
+
+        with self.lock:
+            candidates = list(self.by_placetype.get(p, []))
+
+        for bbox, feature in candidates:
+
+            if bbox == None:
+                return None
+
+            if not mapzen.whosonfirst.hierarchy.geometry.bbox_contains(bbox, lat, lon):
+                continue
+
+            if mapzen.whosonfirst.hierarchy.geometry.contains(feature["geometry"], lat, lon):
+                possible.append(feature)
+
+        logging.debug("resolved %s %s for %s, %s locally" % (len(possible), p, lat, lon))
+        return possible
+
+    def substitute(self, possible):
+
+        # swap the hierarchy (and parent) of anything that's been rebuilt in
+        # to a list of possible parents returned by the spatial client
+
+        updated = []
+
+        for f in possible:
+
+            r = self.by_id.get(f["properties"]["wof:id"], None)
+
+            if r == None:
+                updated.append(f)
+                continue
+
+            f = copy.copy(f)
+            f["properties"] = dict(f["properties"])
+
+            for k in ("wof:hierarchy", "wof:parent_id"):
+
+                if k in r["properties"]:
+                    f["properties"][k] = r["properties"][k]
+
+            updated.append(f)
+
+        return updated
@@ -0,0 +1,360 @@
+import os
+import json
+import time
+import socket
+import logging
+import sqlite3
+
+import mapzen.whosonfirst.hierarchy.geometry
+
+# rebuilding the descendants of a really big place (say after a country's
+# boundary has changed) split in to lots of small jobs - one per placetype
+# per tile - that are written to a local, on-disk (SQLite) queue so that any
+# number of worker processes, on this machine or any other machine that can
+# see the same filesystem, can claim them and do the work. there is no broker;
+# the queue is the only thing anyone needs to agree on.
+#
+# for example, to plan things:
+#
+# q = mapzen.whosonfirst.hierarchy.shard.queue("/usr/local/data/85633793.queue")
+# mapzen.whosonfirst.hierarchy.shard.plan(ancs, feature, q, data_root="/usr/local/data", tile_size=1.0)
+#
+# and then, in as many places as you like:
+#
+# q = mapzen.whosonfirst.hierarchy.shard.queue("/usr/local/data/85633793.queue")
+# mapzen.whosonfirst.hierarchy.shard.work(ancs, q)
+#
+# and finally:
+#
+# print(q.status(), q.updated())
+#
+# placetypes are processed from the top down and no jobs for a given placetype
+# are handed out until every job for the placetypes above it has finished, so
+# that descendants always see their parents' new hierarchies (each job flushes
+# and re-indexes its changes before it is marked as done). jobs that have been
+# claimed for longer than 'lease' seconds are assumed to belong to a worker
+# that died and are handed out again, up to 'max_attempts' times.
+#
+# every worker needs to be talking to the same spatial client (as in the same
+# database) so that they see each other's changes, which means not using the
+# 'local' client or a point-in-polygon cache. see also:
+# scripts/wof-hierarchy-shard. SQLite's locking is only as good as the
+# filesystem it's on so be careful with network filesystems.
+
+schema = [
+    "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)",
+    "CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY, level INTEGER, placetype TEXT, i INTEGER, j INTEGER, status TEXT, worker TEXT, claimed INTEGER, attempts INTEGER, updated TEXT, error TEXT)",
+    "CREATE INDEX IF NOT EXISTS jobs_by_status ON jobs (status, level)",
+]
+
+class queue:
+
+    def __init__(self, path, **kwargs):
+
+        self.path = path
+
+        # the number of seconds a job may be claimed for before someone
+        # else is allowed to have a go
+
+        self.lease = kwargs.get("lease", 3600)
+        self.max_attempts = kwargs.get("max_attempts", 3)
+
+        self.conn = sqlite3.connect(path, timeout=kwargs.get("timeout", 60), isolation_level=None)
+
+        for sql in schema:
+            self.conn.execute(sql)
+
+        # the root feature (which may be enormous) and its tiles, which
+        # never change once things have been planned
+
+        self._root = None
+        self._tiling = None
+
+    def root(self):
+
+        if self._root == None:
+            self._root = self.get_meta("root", None)
+
+        return self._root
+
+    def tiling(self):
+
+        if self._tiling == None:
+
+            feature = self.root()
+            options = self.get_meta("options", {})
+
+            geom = feature["geometry"]
+            bbox = feature.get("bbox", None) or mapzen.whosonfirst.hierarchy.geometry.bbox(geom)
+
+            self._tiling = mapzen.whosonfirst.hierarchy.geometry.tiling(geom, options.get("tile_size", 1.0), bbox=bbox)
+
+        return self._tiling
+
+    def close(self):
+
+        self.conn.close()
+
+    def get_meta(self, key, default=None):
+
+        row = self.conn.execute("SELECT value FROM meta WHERE key=?", (key,)).fetchone()
+
+        if row == None:
+            return default
+
+        return json.loads(row[0])
+
+    def set_meta(self, key, value):
+
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    def add(self, jobs):
+
+        # jobs is a list of (level, placetype, i, j) tuples
+
+        self.conn.execute("BEGIN IMMEDIATE")
+
+        try:
+
+            for level, placetype, i, j in jobs:
+                self.conn.execute("INSERT INTO jobs (level, placetype, i, j, status, attempts) VALUES (?, ?, ?, ?, 'pending', 0)", (level, placetype, i, j))
+
+            self.conn.execute("COMMIT")
+
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    def claim(self, worker):
+
+        # returns a dictionary describing a job, None if there is nothing to
+        # do right now but there might be later (because jobs further up the
+        # hierarchy are still being worked on) or False if everything is done
+
+        now = int(time.time())
+
+        self.conn.execute("BEGIN IMMEDIATE")
+
+        try:
+
+            # put jobs whose lease has expired back in the queue (or give up
+            # on them)
+
+            self.conn.execute("UPDATE jobs SET status='failed', error='too many attempts' WHERE status='claimed' AND claimed < ? AND attempts >= ?", (now - self.lease, self.max_attempts))
+            self.conn.execute("UPDATE jobs SET status='pending' WHERE status='claimed' AND claimed < ?", (now - self.lease,))
+
+            row = self.conn.execute("SELECT MIN(level) FROM jobs WHERE status IN ('pending', 'claimed')").fetchone()
+
+            if row[0] == None:
+                self.conn.execute("COMMIT")
+                return False
+
+            level = row[0]
+
+            row = self.conn.execute("SELECT id, level, placetype, i, j, attempts FROM jobs WHERE status='pending' AND level=? ORDER BY id LIMIT 1", (level,)).fetchone()
+
+            if row == None:
+                self.conn.execute("COMMIT")
+                return None
+
+            job_id, level, placetype, i, j, attempts = row
+
+            self.conn.execute("UPDATE jobs SET status='claimed', worker=?, claimed=?, attempts=? WHERE id=?", (worker, now, attempts + 1, job_id))
+            self.conn.execute("COMMIT")
+
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+
+        return {
+            "id": job_id,
+            "level": level,
+            "placetype": placetype,
+            "tile": (i, j),
+            "attempts": attempts + 1,
+        }
+
+    def done(self, job, updated):
+
+        self.conn.execute("UPDATE jobs SET status='done', updated=?, error=NULL WHERE id=?", (json.dumps(updated), job["id"]))
+
+    def failed(self, job, error):
+
+        # failed jobs are tried again until they've been tried too many times
+
+        status = "pending"
+
+        if job["attempts"] >= self.max_attempts:
+            status = "failed"
+
+        self.conn.execute("UPDATE jobs SET status=?, error=? WHERE id=?", (status, str(error), job["id"]))
+
+    def status(self):
+
+        counts = {}
+
+        for status, count in self.conn.execute("SELECT status, COUNT(id) FROM jobs GROUP BY status"):
+            counts[status] = count
+
+        return counts
+
+    def errors(self):
+
+        errors = []
+
+        for job_id, placetype, i, j, error in self.conn.execute("SELECT id, placetype, i, j, error FROM jobs WHERE status='failed' ORDER BY id"):
+            errors.append({ "id": job_id, "placetype": placetype, "tile": (i, j), "error": error })
+
+        return errors
+
+    def updated(self):
+
+        # the union of repos updated by all the jobs that are done, plus
+        # the root feature's repo if it was updated when things were planned
+
+        updated = list(self.get_meta("updated", []))
+
+        for row in self.conn.execute("SELECT updated FROM jobs WHERE status='done' AND updated IS NOT NULL"):
+
+            for repo in json.loads(row[0]):
+
+                if not repo in updated:
+                    updated.append(repo)
+
+        return updated
+
+def plan(ancs, feature, q, **kwargs):
+
+    # (optionally) rebuild and export feature itself and then add a job to
+    # q for every descendant placetype, for every tile that feature touches.
+    # any other arguments (like 'data_root' or 'descendants_from') are saved
+    # and handed to rebuild_and_export_descendants by each worker. if
+    # descendants come from the hierarchy index then each job only gets the
+    # ones in its own tile (see also: descendant_rows_from_index)
+
+    props = feature["properties"]
+
+    data_root = kwargs.get("data_root", None)
+
+    if not data_root:
+        raise Exception("You forgot to specify a data_root parameter")
+
+    if q.root() != None:
+        raise Exception("queue %s has already been planned" % q.path)
+
+    geom = feature.get("geometry", None)
+
+    if not geom or not geom["type"] in ("Polygon", "MultiPolygon"):
+        raise Exception("WOF ID %s (%s) does not have a polygon to shard" % (props["wof:id"], props.get("wof:name", "NO NAME")))
+
+    tile_size = kwargs.get("tile_size", 1.0)
+
+    updated = []
+
+    if kwargs.get("rebuild_feature", True):
+
+        _kwargs = dict(kwargs)
+        _kwargs["rebuild_descendants"] = False
+
+        updated = ancs.rebuild_and_export(feature, **_kwargs)
+
+    placetypes = ancs.descendant_placetypes(feature, **kwargs)
+    placetypes = sorted(placetypes, key=ancs.placetype_depth)
+
+    bbox = feature.get("bbox", None) or mapzen.whosonfirst.hierarchy.geometry.bbox(geom)
+    tiling = mapzen.whosonfirst.hierarchy.geometry.tiling(geom, tile_size, bbox=bbox)
+
+    tiles = tiling.tiles()
+    jobs = []
+
+    for level in range(len(placetypes)):
+
+        for i, j in tiles:
+            jobs.append((level, placetypes[level], i, j))
+
+    options = {}
+
+    for k in ("data_root", "export", "import", "buffer", "descendants_from", "use_spatial_feature", "complete_features", "required_properties", "export_batch_size", "index_batch_size", "strict"):
+
+        if k in kwargs:
+            options[k] = kwargs[k]
+
+    options["tile_size"] = tile_size
+
+    q.set_meta("root", feature)
+    q.set_meta("options", options)
+    q.set_meta("updated", updated)
+    q.set_meta("planned", int(time.time()))
+
+    q.add(jobs)
+
+    logging.info("planned %s jobs for %s (%s): %s placetypes, %s tiles" % (len(jobs), props["wof:id"], props.get("wof:name", "NO NAME"), len(placetypes), len(tiles)))
+    return len(jobs)
+
+def run_job(ancs, q, job, **kwargs):
+
+    # returns the list of repos updated by a single job
+
+    feature = q.root()
+    options = q.get_meta("options", {})
+
+    _kwargs = dict(options)
+    _kwargs.update(kwargs)
+
+    _kwargs["placetypes"] = [ job["placetype"] ]
+    _kwargs["query_geometry"] = "tiles"
+    _kwargs["tiling"] = q.tiling()
+    _kwargs["tiles"] = [ job["tile"] ]
+
+    return ancs.rebuild_and_export_descendants(feature, **_kwargs)
+
+def work(ancs, q, **kwargs):
+
+    # claim and run jobs until there are none left (or 'max_jobs' have been
+    # run) returning a dictionary of counts. any other arguments are handed
+    # to rebuild_and_export_descendants, overriding whatever was planned.
+
+    worker = kwargs.pop("worker", None) or "%s:%s" % (socket.gethostname(), os.getpid())
+    poll = kwargs.pop("poll", 5)
+    max_jobs = kwargs.pop("max_jobs", None)
+
+    counts = {
+        "done": 0,
+        "failed": 0,
+    }
+
+    while True:
+
+        if max_jobs != None and (counts["done"] + counts["failed"]) >= max_jobs:
+            break
+
+        job = q.claim(worker)
+
+        if job == False:
+            logging.info("no more jobs for %s" % worker)
+            break
+
+        if job == None:
+
+            # waiting for jobs higher up the hierarchy to finish
+
+            logging.debug("nothing to do yet for %s, waiting %s seconds" % (worker, poll))
+            time.sleep(poll)
+            continue
+
+        logging.info("%s claimed job %s (%s, tile %s,%s)" % (worker, job["id"], job["placetype"], job["tile"][0], job["tile"][1]))
+
+        try:
+            updated = run_job(ancs, q, job, **kwargs)
+        except Exception as e:
+
+            logging.error("job %s (%s, tile %s,%s) failed, because %s" % (job["id"], job["placetype"], job["tile"][0], job["tile"][1], e))
+
+            q.failed(job, e)
+            counts["failed"] += 1
+            continue
+
+        q.done(job, updated)
+        counts["done"] += 1
+
+    return counts
@@ -0,0 +1,565 @@
+import os
+import copy
+import math
+import logging
+import threading
+
+import mapzen.whosonfirst.utils
+import mapzen.whosonfirst.placetypes
+
+import mapzen.whosonfirst.hierarchy.geometry
+
+# a local, in-memory spatial client for when you don't have (or don't want
+# to wait for) PostGIS. it loads WOF records from one or more repos under a
+# data_root, indexes their bounding boxes in an STR-packed R-tree and then
+# does exact point-in-polygon and intersects tests in Python. it implements
+# the parts of the mapzen.whosonfirst.spatial.base interface that the
+# ancestors class uses:
+#
+# point_in_polygon, intersects, intersects_paginated, index_feature
+#
+# as well as point_in_polygon_many for looking up lots of points at once
+#
+# for example:
+#
+# client = mapzen.whosonfirst.hierarchy.spatial.local(data_root="/usr/local/data", repos=["whosonfirst-data-admin-us"])
+# ancs = mapzen.whosonfirst.hierarchy.ancestors(spatial_client=client)
+
+def status(props):
+
+    # returns an (is_superseded, is_deprecated, is_ceased) tuple of 1 or 0
+    # for a set of WOF properties
+
+    unknown = ("", "u", "uuuu", "open", "..")
+
+    superseded_by = props.get("wof:superseded_by", [])
+    deprecated = props.get("edtf:deprecated", "")
+    cessation = props.get("edtf:cessation", "")
+
+    is_superseded = 0
+    is_deprecated = 0
+    is_ceased = 0
+
+    if len(superseded_by) > 0:
+        is_superseded = 1
+
+    if deprecated and not deprecated in unknown:
+        is_deprecated = 1
+
+    if cessation and not cessation in unknown:
+        is_ceased = 1
+
+    return is_superseded, is_deprecated, is_ceased
+
+class str_tree:
+
+    # a sort-tile-recursive packed R-tree of (bbox, item) pairs. it is static
+    # once it's been built; the local client keeps track of anything that has
+    # been added or removed since and rebuilds the tree when necessary
+
+    def __init__(self, entries, **kwargs):
+
+        self.node_size = kwargs.get("node_size", 16)
+        self.root = None
+
+        if len(entries):
+            self.root = self.build(entries)
+
+    def build(self, entries):
+
+        # leaf nodes are (bbox, item, None) and branch nodes are
+        # (bbox, None, children)
+
+        nodes = []
+
+        for bbox, item in entries:
+            nodes.append((bbox, item, None))
+
+        while len(nodes) > 1:
+            nodes = self.pack(nodes)
+
+        return nodes[0]
+
+    def pack(self, nodes):
+
+        size = self.node_size
+
+        count = len(nodes)
+        leaves = int(math.ceil(count / float(size)))
+        slices = int(math.ceil(math.sqrt(leaves)))
+
+        center_x = lambda n: (n[0][0] + n[0][2]) / 2.0
+        center_y = lambda n: (n[0][1] + n[0][3]) / 2.0
+
+        nodes = sorted(nodes, key=center_x)
+        per_slice = slices * size
+
+        packed = []
+
+        for i in range(0, count, per_slice):
+
+            _slice = sorted(nodes[i:i + per_slice], key=center_y)
+
+            for j in range(0, len(_slice), size):
+
+                children = _slice[j:j + size]
+                packed.append((self.union(children), None, children))
+
+        return packed
+
+    def union(self, nodes):
+
+        minx = min([ n[0][0] for n in nodes ])
+        miny = min([ n[0][1] for n in nodes ])
+        maxx = max([ n[0][2] for n in nodes ])
+        maxy = max([ n[0][3] for n in nodes ])
+
+        return [ minx, miny, maxx, maxy ]
+
+    def query(self, bbox):
+
+        # yield every item whose bbox intersects bbox
+
+        if self.root == None:
+            return
+
+        stack = [ self.root ]
+
+        while len(stack):
+
+            node_bbox, item, children = stack.pop()
+
+            if not mapzen.whosonfirst.hierarchy.geometry.bbox_intersects(node_bbox, bbox):
+                continue
+
+            if children == None:
+                yield item
+            else:
+                stack.extend(children)
+
+class local:
+
+    # this client understands the 'properties' argument to point_in_polygon
+    # and point_in_polygon_many (see also: ancestors.properties_only) and a
+    # list of values for any filter (see also: ancestors.batch)
+
+    supports_properties = True
+    supports_placetype_lists = True
+
+    def __init__(self, **kwargs):
+
+        self.data_root = kwargs.get("data_root", None)
+
+        # the list of repos (under data_root) to load; the default is all
+        # of them which is probably not what you want for venues...
+
+        self.repos = kwargs.get("repos", None)
+
+        # if present only records with these placetypes are loaded
+
+        self.placetypes = kwargs.get("placetypes", None)
+
+        self.node_size = kwargs.get("node_size", 16)
+
+        # the number of features added (or updated) by index_feature since
+        # the tree was last built before it is built again
+
+        self.rebuild_threshold = kwargs.get("rebuild_threshold", 1000)
+
+        self.features = {}
+        self.bboxes = {}
+        self.spr = {}
+
+        self.tree = str_tree([])
+        self.pending = set()
+
+        self.lock = threading.RLock()
+
+        if self.data_root and kwargs.get("load", True):
+            self.load()
+
+    def load(self):
+
+        repos = self.repos
+
+        if repos == None:
+
+            repos = []
+
+            for repo in sorted(os.listdir(self.data_root)):
+
+                if os.path.isdir(os.path.join(self.data_root, repo, "data")):
+                    repos.append(repo)
+
+        for repo in repos:
+            self.load_repo(repo)
+
+        self.build()
+
+    def load_repo(self, repo):
+
+        data = os.path.join(self.data_root, repo, "data")
+        count = 0
+
+        logging.info("load %s into local spatial index" % data)
+
+        for root, dirs, files in os.walk(data):
+
+            for fname in files:
+
+                if not fname.endswith(".geojson"):
+                    continue
+
+                # alternate geometries are not part of the hierarchy
+
+                if "-alt-" in fname:
+                    continue
+
+                path = os.path.join(root, fname)
+
+                try:
+                    feature = mapzen.whosonfirst.utils.load_file(path)
+                except Exception as e:
+                    logging.warning("failed to load %s, because %s" % (path, e))
+                    continue
+
+                if self.add_feature(feature):
+                    count += 1
+
+        logging.info("loaded %s records from %s" % (count, data))
+        return count
+
+    def add_feature(self, feature):
+
+        props = feature["properties"]
+
+        if self.placetypes and not props.get("wof:placetype", None) in self.placetypes:
+            return False
+
+        geom = feature.get("geometry", None)
+
+        if not geom:
+            return False
+
+        wofid = props["wof:id"]
+
+        # work everything out first so that if something goes wrong we're not
+        # left with half a record
+
+        bbox = mapzen.whosonfirst.hierarchy.geometry.bbox(geom)
+        spr = self.derive_spr(feature)
+
+        with self.lock:
+
+            self.features[wofid] = feature
+            self.bboxes[wofid] = bbox
+            self.spr[wofid] = spr
+
+        return True
+
+    def derive_spr(self, feature):
+
+        # the subset of things that filters are applied to, computed once
+        # so we don't have to do it for every query
+
+        props = feature["properties"]
+
+        placetype_id = props.get("wof:placetype_id", None)
+
+        if placetype_id == None:
+
+            try:
+                pt = mapzen.whosonfirst.placetypes.placetype(props["wof:placetype"])
+                placetype_id = pt.id()
+            except Exception as e:
+                logging.warning("failed to determine placetype ID for %s, because %s" % (props["wof:id"], e))
+
+        is_superseded, is_deprecated, is_ceased = status(props)
+
+        try:
+            lat, lon = mapzen.whosonfirst.utils.reverse_geocoordinates(feature)
+        except Exception as e:
+            lat, lon = None, None
+
+        return {
+            "wof:placetype_id": placetype_id,
+            "wof:is_superseded": is_superseded,
+            "wof:is_deprecated": is_deprecated,
+            "wof:is_ceased": is_ceased,
+            "latitude": lat,
+            "longitude": lon,
+        }
+
+    def build(self):
+
+        with self.lock:
+
+            entries = []
+
+            for wofid, bbox in self.bboxes.items():
+                entries.append((bbox, wofid))
+
+            self.tree = str_tree(entries, node_size=self.node_size)
+            self.pending = set()
+
+        logging.debug("built local spatial index with %s records" % len(self.bboxes))
+
+    def index_feature(self, feature, **kwargs):
+
+        props = feature["properties"]
+        wofid = props["wof:id"]
+
+        with self.lock:
+
+            self.remove_feature(wofid)
+
+            if not self.add_feature(copy.deepcopy(feature)):
+                return False
+
+            self.pending.add(wofid)
+
+            if len(self.pending) >= self.rebuild_threshold:
+                self.build()
+
+        return True
+
+    def remove_feature(self, wofid):
+
+        with self.lock:
+
+            self.features.pop(wofid, None)
+            self.bboxes.pop(wofid, None)
+            self.spr.pop(wofid, None)
+
+            # it will be added back if (and only if) it is indexed again
+
+            self.pending.discard(wofid)
+
+    def candidates(self, bbox):
+
+        with self.lock:
+
+            ids = set()
+
+            for wofid in self.tree.query(bbox):
+
+                # it might have been removed (or moved) since the tree was built
+
+                if wofid in self.pending or not wofid in self.bboxes:
+                    continue
+
+                ids.add(wofid)
+
+            for wofid in self.pending:
+
+                if mapzen.whosonfirst.hierarchy.geometry.bbox_intersects(self.bboxes[wofid], bbox):
+                    ids.add(wofid)
+
+            return sorted(ids)
+
+    def matches_filters(self, wofid, filters):
+
+        spr = self.spr[wofid]
+        props = self.features[wofid]["properties"]
+
+        for k, v in filters.items():
+
+            if k in spr:
+                actual = spr[k]
+            else:
+                actual = props.get(k, None)
+
+            if type(v) in (list, tuple, set):
+
+                if not actual in v:
+                    return False
+
+            elif actual != v:
+                return False
+
+        return True
+
+    def format_results(self, ids, **kwargs):
+
+        # note that we don't hold the lock while yielding things since
+        # the caller might be doing anything (including waiting on another
+        # thread that wants to query the index)
+
+        as_feature = kwargs.get("as_feature", False)
+
+        # if present (and as_feature is false) only these properties are
+        # returned, which saves copying anything we don't need
+
+        properties = kwargs.get("properties", None)
+
+        for wofid in ids:
+
+            with self.lock:
+                feature = self.features.get(wofid, None)
+
+            if feature == None:
+                continue
+
+            if as_feature:
+                yield copy.deepcopy(feature)
+
+            elif properties:
+
+                props = feature["properties"]
+                row = {}
+
+                for k in properties:
+
+                    if k in props:
+                        row[k] = copy.deepcopy(props[k])
+
+                yield row
+
+            else:
+                yield copy.deepcopy(feature["properties"])
+
+    def point_in_polygon(self, lat, lon, **kwargs):
+
+        filters = kwargs.get("filters", {})
+
+        lat = float(lat)
+        lon = float(lon)
+
+        ids = []
+
+        with self.lock:
+
+            for wofid in self.candidates([ lon, lat, lon, lat ]):
+
+                if not self.matches_filters(wofid, filters):
+                    continue
+
+                geom = self.features[wofid]["geometry"]
+
+                if not mapzen.whosonfirst.hierarchy.geometry.contains(geom, lat, lon):
+                    continue
+
+                ids.append(wofid)
+
+        return self.format_results(ids, **kwargs)
+
+    def point_in_polygon_many(self, coords, **kwargs):
+
+        # the same as point_in_polygon but for a list of (lat, lon) tuples
+        # all at once; returns a list of lists of matches in the same order
+        # as coords. candidate polygons are looked up once for the whole set
+        # and then tested against all the points inside their bounding box
+        # (using numpy if it's available)
+
+        filters = kwargs.get("filters", {})
+        as_feature = kwargs.get("as_feature", False)
+
+        results = []
+
+        lats = []
+        lons = []
+
+        for lat, lon in coords:
+            lats.append(float(lat))
+            lons.append(float(lon))
+            results.append([])
+
+        if len(coords) == 0:
+            return results
+
+        bbox = [ min(lons), min(lats), max(lons), max(lats) ]
+
+        with self.lock:
+
+            matches = []
+
+            for wofid in self.candidates(bbox):
+
+                if not self.matches_filters(wofid, filters):
+                    continue
+
+                _bbox = self.bboxes[wofid]
+                idx = []
+
+                for i in range(len(lats)):
+
+                    if mapzen.whosonfirst.hierarchy.geometry.bbox_contains(_bbox, lats[i], lons[i]):
+                        idx.append(i)
+
+                if len(idx) == 0:
+                    continue
+
+                geom = self.features[wofid]["geometry"]
+                contained = mapzen.whosonfirst.hierarchy.geometry.contains_many(geom, [ lats[i] for i in idx ], [ lons[i] for i in idx ])
+
+                idx = [ idx[i] for i in range(len(idx)) if contained[i] ]
+
+                if len(idx):
+                    matches.append((wofid, idx))
+
+        for wofid, idx in matches:
+
+            # one copy per match shared by all the points it contains
+
+            for row in self.format_results([ wofid ], as_feature=as_feature, properties=kwargs.get("properties", None)):
+
+                for i in idx:
+                    results[i].append(row)
+
+        return results
+
+    def intersects(self, feature, **kwargs):
+
+        # 'use_centroid' means test the centroid of each candidate (rather
+        # than its geometry) against the query feature; 'check_centroid'
+        # means that a candidate whose geometry intersects the query feature
+        # must also have its centroid inside it
+
+        filters = kwargs.get("filters", {})
+
+        use_centroid = kwargs.get("use_centroid", False)
+        check_centroid = kwargs.get("check_centroid", False)
+
+        if kwargs.get("buffer", None):
+            logging.warning("the local spatial client does not support buffers, ignoring")
+
+        geom = feature["geometry"]
+        bbox = mapzen.whosonfirst.hierarchy.geometry.bbox(geom)
+
+        ids = []
+
+        with self.lock:
+
+            for wofid in self.candidates(bbox):
+
+                if not self.matches_filters(wofid, filters):
+                    continue
+
+                spr = self.spr[wofid]
+
+                lat = spr["latitude"]
+                lon = spr["longitude"]
+
+                if use_centroid or check_centroid:
+
+                    if lat == None or not mapzen.whosonfirst.hierarchy.geometry.contains(geom, lat, lon):
+                        continue
+
+                if not use_centroid:
+
+                    _geom = self.features[wofid]["geometry"]
+
+                    if not mapzen.whosonfirst.hierarchy.geometry.intersects(geom, _geom, a_bbox=bbox, b_bbox=self.bboxes[wofid]):
+                        continue
+
+                ids.append(wofid)
+
+        return self.format_results(ids, **kwargs)
+
+    def intersects_paginated(self, feature, **kwargs):
+
+        # there is no network to be nice to so "pages" are just a way
+        # of keeping the same interface as the other clients
+
+        for row in self.intersects(feature, **kwargs):
+            yield row
@@ -0,0 +1,280 @@
+import math
+import time
+import threading
+
+# counters and latency histograms for the different phases of rebuilding
+# hierarchies, so you can see where the time goes without grepping debug
+# logs. pass an instance to the ancestors class as its 'stats' argument:
+#
+# s = mapzen.whosonfirst.hierarchy.stats.stats()
+# ancs = mapzen.whosonfirst.hierarchy.ancestors(spatial_client=pg_client, stats=s)
+#
+# ancs.rebuild_and_export_feature(feature, data_root=data_root)
+#
+# for ln in s.report():
+#     print(ln)
+#
+# the phases are:
+#
+# rebuild - rebuild_feature, from start to finish
+# pip - point-in-polygon queries (per placetype ID, or 'batch')
+# pip_many - point-in-polygon queries for lots of points (see also: rebuild_features)
+# compare - working out whether a hierarchy has changed
+# intersects - waiting for the next descendant from the spatial client
+# load - loading descendants from disk
+# descendant - loading and rebuilding a single descendant
+# export - writing things to disk (see also: writer)
+# index - (re) indexing things with the spatial client (see also: writer)
+#
+# stats kept in other processes (for example the workers in a process pool)
+# are handed back with drain, which returns a summary and starts over, and
+# added to the parent's with merge.
+#
+# you can also register hooks which are called with the name of a phase and
+# the number of seconds it took every time something is timed. when there is
+# no stats instance nothing is counted or timed (see also: ancestors.timer)
+
+class timer:
+
+    def __init__(self, stats, phase):
+
+        self.stats = stats
+        self.phase = phase
+        self.t1 = None
+
+    def __enter__(self):
+
+        self.t1 = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+
+        self.stats.record(self.phase, time.time() - self.t1)
+        return False
+
+class null_timer:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+class histogram:
+
+    # latencies in power-of-two microsecond buckets, as in bucket 0 is
+    # less than 1us, bucket 1 is 1-2us, bucket 2 is 2-4us and so on up to
+    # bucket 21 which is about 1-2 seconds
+
+    def __init__(self):
+
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = {}
+
+    def add(self, seconds):
+
+        self.count += 1
+        self.total += seconds
+
+        if self.min == None or seconds < self.min:
+            self.min = seconds
+
+        if self.max == None or seconds > self.max:
+            self.max = seconds
+
+        us = seconds * 1000000.0
+        b = 0
+
+        if us >= 1:
+            b = int(math.log(us, 2)) + 1
+
+        self.buckets[b] = self.buckets.get(b, 0) + 1
+
+    def merge(self, summary):
+
+        # add the output of another histogram's summary method to this one
+
+        if not summary.get("count", 0):
+            return
+
+        self.count += summary["count"]
+        self.total += summary["total"]
+
+        if self.min == None or summary["min"] < self.min:
+            self.min = summary["min"]
+
+        if self.max == None or summary["max"] > self.max:
+            self.max = summary["max"]
+
+        for b, count in summary.get("buckets", {}).items():
+            b = int(b)
+            self.buckets[b] = self.buckets.get(b, 0) + count
+
+    def percentile(self, pct):
+
+        # the upper bound (in seconds) of the bucket containing the pct-th
+        # percentile, which is as precise as we can be
+
+        if self.count == 0:
+            return None
+
+        target = self.count * pct / 100.0
+        seen = 0
+
+        for b in sorted(self.buckets.keys()):
+
+            seen += self.buckets[b]
+
+            if seen >= target:
+                return min((2 ** b) / 1000000.0, self.max)
+
+        return self.max
+
+    def summary(self):
+
+        mean = None
+
+        if self.count:
+            mean = self.total / self.count
+
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": mean,
+            "min": self.min,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "buckets": dict(self.buckets),
+        }
+
+class stats:
+
+    def __init__(self, **kwargs):
+
+        self.lock = threading.Lock()
+
+        self.counters = {}
+        self.histograms = {}
+
+        self.hooks = list(kwargs.get("hooks", []))
+
+        self.started = time.time()
+
+    def add_hook(self, hook):
+
+        self.hooks.append(hook)
+
+    def incr(self, name, count=1):
+
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + count
+
+    def timer(self, phase):
+
+        return timer(self, phase)
+
+    def record(self, phase, seconds):
+
+        with self.lock:
+
+            h = self.histograms.get(phase, None)
+
+            if h == None:
+                h = histogram()
+                self.histograms[phase] = h
+
+            h.add(seconds)
+
+        for hook in self.hooks:
+            hook(phase, seconds)
+
+    def reset(self):
+
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+            self.started = time.time()
+
+    def drain(self):
+
+        # return a summary and start over, so that the same things aren't
+        # merged (see below) twice
+
+        with self.lock:
+
+            s = self._summary()
+
+            self.counters = {}
+            self.histograms = {}
+            self.started = time.time()
+
+            return s
+
+    def merge(self, summary):
+
+        # add the output of another stats instance's summary (or drain)
+        # method to this one. elapsed time is not merged since it's measured
+        # from when this instance was created. hooks are not called.
+
+        with self.lock:
+
+            for name, count in summary.get("counters", {}).items():
+                self.counters[name] = self.counters.get(name, 0) + count
+
+            for phase, p in summary.get("phases", {}).items():
+
+                h = self.histograms.get(phase, None)
+
+                if h == None:
+                    h = histogram()
+                    self.histograms[phase] = h
+
+                h.merge(p)
+
+    def summary(self):
+
+        with self.lock:
+            return self._summary()
+
+    def _summary(self):
+
+        # assumes the lock is held
+
+        phases = {}
+
+        for phase, h in self.histograms.items():
+            phases[phase] = h.summary()
+
+        return {
+            "elapsed": time.time() - self.started,
+            "counters": dict(self.counters),
+            "phases": phases,
+        }
+
+    def report(self):
+
+        # a list of human-readable lines, for logging or printing
+
+        s = self.summary()
+        lines = []
+
+        lines.append("elapsed %.3fs" % s["elapsed"])
+
+        for phase in sorted(s["phases"].keys()):
+
+            p = s["phases"][phase]
+
+            lines.append("%s count %d total %.3fs mean %.2fms min %.2fms max %.2fms p50 <=%.2fms p90 <=%.2fms p99 <=%.2fms" % (
+                phase, p["count"], p["total"], p["mean"] * 1000, p["min"] * 1000, p["max"] * 1000,
+                p["p50"] * 1000, p["p90"] * 1000, p["p99"] * 1000
+            ))
+
+        for name in sorted(s["counters"].keys()):
+            lines.append("%s %d" % (name, s["counters"][name]))
+
+        return lines
@@ -0,0 +1,186 @@
+import os
+import logging
+import pprint
+
+import mapzen.whosonfirst.export
+
+# this is the thing that rebuild_and_export uses to write changes to disk
+# and re-index them with the spatial client. exporters are created once per
+# repo and both exports and index updates can be buffered and flushed in
+# batches, so that a big rebuild doesn't mean one tiny database transaction
+# per record. the default batch size (1) is the same as not buffering at all.
+#
+# if the spatial client has an index_features method it is passed a list of
+# features to (re) index all at once, otherwise index_feature is called for
+# each one.
+#
+# it is important that changes are visible to the spatial client before any
+# of the things they are the parent of are rebuilt. rebuild_and_export takes
+# care of that by calling flush() after the feature itself has been rebuilt
+# and after each placetype of descendants has been processed. you should also
+# call flush() any time you need to be sure things have been written, and
+# always when you are done.
+
+class writer:
+
+    def __init__(self, ancs, **kwargs):
+
+        self.ancestors = ancs
+
+        self.data_root = kwargs.get("data_root", None)
+
+        self.export = kwargs.get("export", True)
+        self.index = kwargs.get("import", True)
+        self.debug = kwargs.get("debug", False)
+
+        self.export_batch_size = kwargs.get("export_batch_size", 1)
+        self.index_batch_size = kwargs.get("index_batch_size", 1)
+
+        # passed along to the spatial client when (re) indexing things
+
+        self.index_kwargs = kwargs.get("index_kwargs", {})
+
+        self.exporters = {}
+
+        self.to_export = []
+        self.to_index = []
+
+    def write(self, feature):
+
+        props = feature["properties"]
+
+        if self.debug:
+            logging.info("debugging enabled but normally we would export %s (%s) here", props['wof:id'], props.get("wof:name", "NO NAME"))
+            logging.debug(pprint.pformat(feature['properties']))
+        elif self.export == False:
+            logging.info("exporting is disabled but normally we would export %s (%s) here", props['wof:id'], props.get("wof:name", "NO NAME"))
+            logging.debug(pprint.pformat(feature['properties']))
+        else:
+            self.to_export.append(feature)
+
+        # debugging behaviour is handled by the spatial_client thingy
+
+        if self.index == False:
+            logging.info("indexing is disabled but normally we would index %s (%s) here", props['wof:id'], props.get("wof:name", "NO NAME"))
+        else:
+            self.to_index.append(feature)
+
+        if len(self.to_export) >= self.export_batch_size:
+            self.flush_exports()
+
+        if len(self.to_index) >= self.index_batch_size:
+            self.flush_index()
+
+        return True
+
+    def exporter(self, repo):
+
+        exporter = self.exporters.get(repo, None)
+
+        if exporter == None:
+
+            root = os.path.join(self.data_root, repo)
+            data = os.path.join(root, "data")
+
+            exporter = mapzen.whosonfirst.export.flatfile(data)
+            self.exporters[repo] = exporter
+
+        return exporter
+
+    def flush(self):
+
+        # exports first so that whatever is indexed has been written to disk;
+        # if an export fails then whatever was exported is still indexed but
+        # nothing else is (see also: flush_exports and ready_to_index)
+
+        try:
+            self.flush_exports()
+        finally:
+            self.flush_index()
+
+    def flush_exports(self):
+
+        features = self.to_export
+        self.to_export = []
+
+        if len(features) == 0:
+            return
+
+        logging.debug("EXPORT %s features" % len(features))
+
+        exported = 0
+
+        try:
+
+            with self.ancestors.timer("export"):
+
+                for feature in features:
+
+                    props = feature["properties"]
+                    repo = props["wof:repo"]
+
+                    logging.debug("EXPORT %s (%s)" % (props["wof:id"], props.get("wof:name", "NO NAME")))
+
+                    exporter = self.exporter(repo)
+                    exporter.export_feature(feature)
+
+                    exported += 1
+
+        finally:
+
+            # anything that wasn't exported, starting with whatever failed,
+            # stays in the queue (and out of the spatial client) until the
+            # next time someone calls flush
+
+            if exported < len(features):
+                self.to_export = features[exported:] + self.to_export
+
+            if exported:
+
+                self.ancestors.incr("exported", exported)
+
+                # the hierarchy index (if there is one) mirrors what's on disk
+
+                if self.ancestors.index:
+                    self.ancestors.index.index_features(features[0:exported])
+
+    def ready_to_index(self):
+
+        # returns the features that can be (re) indexed now, leaving anything
+        # that is still waiting to be exported (because the export batch size
+        # is bigger than the index batch size, or because exporting it failed)
+        # in the queue so that the spatial client never knows about something
+        # that isn't on disk
+
+        pending = set()
+
+        for feature in self.to_export:
+            pending.add(id(feature))
+
+        ready = []
+        waiting = []
+
+        for feature in self.to_index:
+
+            if id(feature) in pending:
+                waiting.append(feature)
+            else:
+                ready.append(feature)
+
+        self.to_index = waiting
+        return ready
+
+    def flush_index(self):
+
+        features = self.ready_to_index()
+
+        if len(features) == 0:
+            return
+
+        logging.debug("REINDEX %s features" % len(features))
+
+        try:
+            self.ancestors.index_features(features, **self.index_kwargs)
+        except Exception:
+            self.to_index = features + self.to_index
+            raise
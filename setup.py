@@ -28,7 +28,9 @@ setup(
     url='https://github.com/whosonfirst/py-mapzen-whosonfirst-hierarchy',
     packages=packages,
     scripts=[
-        'scripts/wof-hierarchy-rebuild'
+        'scripts/wof-hierarchy-rebuild',
+        'scripts/wof-hierarchy-benchmark',
+        'scripts/wof-hierarchy-shard',
         ],
     download_url='https://github.com/whosonfirst/py-mapzen-whosonfirst-spatial/releases/tag/' + version,
     license='BSD')
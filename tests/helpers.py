@@ -0,0 +1,127 @@
+import os
+import copy
+import shutil
+import tempfile
+
+import mapzen.whosonfirst.utils
+
+import mapzen.whosonfirst.hierarchy.benchmark
+
+# things that more than one test needs
+
+def box(wofid, placetype, bbox, hierarchy):
+
+    minx, miny, maxx, maxy = bbox
+
+    return {
+        "type": "Feature",
+        "bbox": [ minx, miny, maxx, maxy ],
+        "geometry": {
+            "type": "Polygon",
+            "coordinates": [[ [minx, miny], [maxx, miny], [maxx, maxy], [minx, maxy], [minx, miny] ]]
+        },
+        "properties": {
+            "wof:id": wofid,
+            "wof:name": "%s %s" % (placetype, wofid),
+            "wof:placetype": placetype,
+            "wof:repo": "whosonfirst-data",
+            "wof:parent_id": -1,
+            "wof:hierarchy": [ hierarchy ],
+            "geom:latitude": (miny + maxy) / 2.0,
+            "geom:longitude": (minx + maxx) / 2.0,
+        }
+    }
+
+def venue(wofid, lat, lon):
+
+    return {
+        "type": "Feature",
+        "bbox": [ lon, lat, lon, lat ],
+        "geometry": {
+            "type": "Point",
+            "coordinates": [ lon, lat ]
+        },
+        "properties": {
+            "wof:id": wofid,
+            "wof:name": "venue %s" % wofid,
+            "wof:placetype": "venue",
+            "wof:repo": "whosonfirst-data-venue",
+            "wof:parent_id": -1,
+            "wof:hierarchy": [],
+            "geom:latitude": lat,
+            "geom:longitude": lon,
+        }
+    }
+
+class world:
+
+    # a small synthetic data_root (see also: benchmark) in a temporary
+    # directory, which is removed by calling cleanup. venues start out
+    # without a parent or hierarchy unless 'stale' is false.
+
+    def __init__(self, **kwargs):
+
+        self.features = list(mapzen.whosonfirst.hierarchy.benchmark.generate(kwargs.get("scale", "small"), stale=kwargs.get("stale", True)))
+
+        self.data_root = tempfile.mkdtemp()
+        mapzen.whosonfirst.hierarchy.benchmark.write(self.data_root, self.features)
+
+    def cleanup(self):
+
+        shutil.rmtree(self.data_root)
+
+    def placetype(self, placetype):
+
+        # the features of a given placetype, in the order they were made
+
+        return [ f for f in self.features if f["properties"]["wof:placetype"] == placetype ]
+
+    def load(self, wofid):
+
+        # the current version of a record, from disk
+
+        for repo in sorted(os.listdir(self.data_root)):
+
+            data = os.path.join(self.data_root, repo, "data")
+            path = os.path.join(data, mapzen.whosonfirst.utils.id2relpath(wofid))
+
+            if os.path.exists(path):
+                return mapzen.whosonfirst.utils.load_file(path)
+
+        return None
+
+    def paths(self):
+
+        for repo in sorted(os.listdir(self.data_root)):
+
+            for dirpath, dirs, files in os.walk(os.path.join(self.data_root, repo)):
+
+                for fname in files:
+
+                    if fname.endswith(".geojson"):
+                        yield os.path.join(dirpath, fname)
+
+    def snapshot(self):
+
+        # wof:id -> (wof:parent_id, wof:hierarchy) for every record on disk
+
+        snapshot = {}
+
+        for path in self.paths():
+
+            props = mapzen.whosonfirst.utils.load_file(path)["properties"]
+            snapshot[ props["wof:id"] ] = (props["wof:parent_id"], props["wof:hierarchy"])
+
+        return snapshot
+
+    def copy(self):
+
+        # another world with the same records (as they are now) on disk
+
+        other = copy.copy(self)
+        other.data_root = tempfile.mkdtemp()
+
+        shutil.rmtree(other.data_root)
+        shutil.copytree(self.data_root, other.data_root)
+
+        return other
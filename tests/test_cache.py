@@ -0,0 +1,127 @@
+import copy
+import unittest
+
+import mapzen.whosonfirst.hierarchy
+import mapzen.whosonfirst.hierarchy.cache
+import mapzen.whosonfirst.hierarchy.spatial
+
+def box(wofid, placetype, bbox, hierarchy):
+
+    minx, miny, maxx, maxy = bbox
+
+    return {
+        "type": "Feature",
+        "geometry": {
+            "type": "Polygon",
+            "coordinates": [[ [minx, miny], [maxx, miny], [maxx, maxy], [minx, maxy], [minx, miny] ]]
+        },
+        "properties": {
+            "wof:id": wofid,
+            "wof:placetype": placetype,
+            "wof:repo": "whosonfirst-data",
+            "wof:parent_id": -1,
+            "wof:hierarchy": [ hierarchy ],
+            "geom:latitude": (miny + maxy) / 2.0,
+            "geom:longitude": (minx + maxx) / 2.0,
+        }
+    }
+
+def venue(wofid, lat, lon):
+
+    return {
+        "type": "Feature",
+        "geometry": {
+            "type": "Point",
+            "coordinates": [ lon, lat ]
+        },
+        "properties": {
+            "wof:id": wofid,
+            "wof:placetype": "venue",
+            "wof:repo": "whosonfirst-data-venue",
+            "wof:parent_id": -1,
+            "wof:hierarchy": [],
+            "geom:latitude": lat,
+            "geom:longitude": lon,
+        }
+    }
+
+class pip_cache_test(unittest.TestCase):
+
+    def setUp(self):
+
+        locality = { "locality_id": 40 }
+
+        self.places = [
+            box(40, "locality", (-10, -10, 10, 10), locality),
+            box(100, "neighbourhood", (-5, -5, 5, 5), { "locality_id": 40, "neighbourhood_id": 100 }),
+            box(101, "neighbourhood", (3, 3, 8, 8), { "locality_id": 40, "neighbourhood_id": 101 }),
+            box(200, "microhood", (1, 1, 2, 2), { "locality_id": 40, "neighbourhood_id": 100, "microhood_id": 200 }),
+        ]
+
+        # the first venue is only in a neighbourhood, the second is also in
+        # a microhood inside that neighbourhood and the third is in two
+        # neighbourhoods that overlap
+
+        self.venues = [
+            venue(1000, -1.0, -1.0),
+            venue(1001, 1.5, 1.5),
+            venue(1002, 4.0, 4.0),
+        ]
+
+    def client(self):
+
+        client = mapzen.whosonfirst.hierarchy.spatial.local(load=False)
+
+        for f in self.places:
+            client.add_feature(f)
+
+        client.build()
+        return client
+
+    def parents(self, **kwargs):
+
+        ancs = mapzen.whosonfirst.hierarchy.ancestors(spatial_client=self.client(), **kwargs)
+        parents = []
+
+        for f in self.venues:
+            f = copy.deepcopy(f)
+            ancs.rebuild_feature(f)
+            parents.append(f["properties"]["wof:parent_id"])
+
+        return parents
+
+    def test_expected(self):
+
+        self.assertEqual(self.parents(), [ 100, 200, -3 ])
+
+    def test_polygons(self):
+
+        expected = self.parents()
+
+        for batch in (False, True):
+
+            cache = mapzen.whosonfirst.hierarchy.cache.pip_cache(polygons=True, precision=2)
+            self.assertEqual(self.parents(batch=batch, cache=cache), expected)
+
+    def test_polygons_hit(self):
+
+        # a point that was never asked about, inside a polygon that was,
+        # is resolved locally (and correctly)
+
+        cache = mapzen.whosonfirst.hierarchy.cache.pip_cache(polygons=True)
+        ancs = mapzen.whosonfirst.hierarchy.ancestors(spatial_client=self.client(), cache=cache)
+
+        filters = { "wof:placetype_id": 102312319, "wof:is_superseded": 0, "wof:is_deprecated": 0, "wof:is_ceased": 0 }
+
+        first = ancs.point_in_polygon(-1.0, -1.0, filters=filters, as_feature=True)
+        self.assertEqual([ r["properties"]["wof:id"] for r in first ], [ 100 ])
+
+        hits = cache.stats()["hits"]
+
+        second = ancs.point_in_polygon(4.0, 4.0, filters=filters, as_feature=True)
+        self.assertEqual(sorted([ r["properties"]["wof:id"] for r in second ]), [ 100, 101 ])
+
+        self.assertEqual(cache.stats()["hits"], hits + 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,245 @@
+import os
+import json
+import subprocess
+import unittest
+
+import mapzen.whosonfirst.utils
+
+import mapzen.whosonfirst.hierarchy
+import mapzen.whosonfirst.hierarchy.benchmark
+import mapzen.whosonfirst.hierarchy.changes
+import mapzen.whosonfirst.hierarchy.geometry
+import mapzen.whosonfirst.hierarchy.spatial
+
+import helpers
+
+def git(repo_path, *args):
+
+    cmd = [ "git", "-C", repo_path, "-c", "user.email=test@example.com", "-c", "user.name=test" ] + list(args)
+    return subprocess.check_output(cmd)
+
+class no_remove:
+
+    # a spatial client that doesn't know how to forget about things
+
+    def __init__(self, client):
+
+        self.client = client
+
+    def __getattr__(self, name):
+
+        if name == "remove_feature":
+            raise AttributeError(name)
+
+        return getattr(self.client, name)
+
+class compare_test(unittest.TestCase):
+
+    def test_parse_range(self):
+
+        parse_range = mapzen.whosonfirst.hierarchy.changes.parse_range
+
+        self.assertEqual(parse_range("abc..def"), ("abc", "def"))
+        self.assertEqual(parse_range("abc.."), ("abc", "HEAD"))
+        self.assertEqual(parse_range("HEAD~1"), ("HEAD~1", "HEAD"))
+
+    def test_compare(self):
+
+        compare = mapzen.whosonfirst.hierarchy.changes.compare
+
+        old = helpers.box(100, "neighbourhood", (0, 0, 1, 1), { "neighbourhood_id": 100 })
+
+        self.assertEqual(compare(None, old), [ "added" ])
+        self.assertEqual(compare(old, None), [ "deleted" ])
+
+        new = json.loads(json.dumps(old))
+        new["properties"]["wof:name"] = "renamed"
+
+        self.assertEqual(compare(old, new), [])
+
+        new["properties"]["geom:latitude"] = 0.25
+        self.assertEqual(compare(old, new), [ "geometry" ])
+
+        new = json.loads(json.dumps(old))
+        new["properties"]["wof:placetype"] = "microhood"
+        new["properties"]["edtf:deprecated"] = "2017-01-01"
+
+        self.assertEqual(compare(old, new), [ "placetype", "status" ])
+
+class changes_test(unittest.TestCase):
+
+    def setUp(self):
+
+        # a world where everything is where it should be (as in has just been
+        # rebuilt) with each repo checked in to git
+
+        self.world = helpers.world()
+        self.country = self.world.placetype("country")[0]["properties"]["wof:id"]
+
+        self.rebuild_all(self.world)
+
+        for repo in sorted(os.listdir(self.world.data_root)):
+
+            repo_path = os.path.join(self.world.data_root, repo)
+
+            git(repo_path, "init", "-q")
+            git(repo_path, "add", ".")
+            git(repo_path, "commit", "-qm", "init")
+
+        self.repo = mapzen.whosonfirst.hierarchy.benchmark.admin_repo
+        self.repo_path = os.path.join(self.world.data_root, self.repo)
+
+        self.neighbourhood = self.world.placetype("neighbourhood")[0]["properties"]["wof:id"]
+
+        self.other = None
+
+    def tearDown(self):
+
+        self.world.cleanup()
+
+        if self.other:
+            self.other.cleanup()
+
+    def path(self, wofid):
+
+        return os.path.join("data", mapzen.whosonfirst.utils.id2relpath(wofid))
+
+    def commit(self, message):
+
+        git(self.repo_path, "commit", "-qam", message)
+
+        # the same records, rebuilt from the top the usual way, for comparing
+        # with the incremental version
+
+        self.other = self.world.copy()
+        self.rebuild_all(self.other)
+
+    def rebuild_all(self, world):
+
+        client = mapzen.whosonfirst.hierarchy.spatial.local(data_root=world.data_root)
+        ancs = mapzen.whosonfirst.hierarchy.ancestors(spatial_client=client)
+
+        ancs.rebuild_and_export_feature(world.load(self.country), data_root=world.data_root)
+
+    def shrink(self):
+
+        # the western half of a neighbourhood goes away, along with whatever
+        # venues were in it
+
+        feature = self.world.load(self.neighbourhood)
+
+        b = feature["bbox"]
+        b = [ b[0] + (b[2] - b[0]) / 2.0, b[1], b[2], b[3] ]
+
+        feature["bbox"] = b
+        feature["geometry"] = mapzen.whosonfirst.hierarchy.geometry.box(b)
+        feature["properties"]["geom:longitude"] = (b[0] + b[2]) / 2.0
+
+        with open(os.path.join(self.repo_path, self.path(self.neighbourhood)), "w") as fh:
+            json.dump(feature, fh)
+
+        self.commit("shrink")
+
+    def rebuild(self, client=None, **kwargs):
+
+        if client == None:
+            client = mapzen.whosonfirst.hierarchy.spatial.local(data_root=self.world.data_root)
+
+        ancs = mapzen.whosonfirst.hierarchy.ancestors(spatial_client=client, stats=True)
+        return list(mapzen.whosonfirst.hierarchy.changes.rebuild(ancs, self.world.data_root, self.repo, "HEAD~1..HEAD", **kwargs))
+
+    def parented_by(self, wofid):
+
+        parented = []
+
+        for k, (parent_id, hierarchy) in self.world.snapshot().items():
+
+            if k == wofid:
+                continue
+
+            if parent_id == wofid or any([ h.get("neighbourhood_id", None) == wofid for h in hierarchy ]):
+                parented.append(k)
+
+        return parented
+
+    def test_geometry(self):
+
+        before = self.parented_by(self.neighbourhood)
+        self.shrink()
+
+        rsp = self.rebuild()
+
+        self.assertEqual(sorted(rsp[-1].keys()), [ "updated" ])
+
+        records = rsp[:-1]
+
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]["wof:id"], self.neighbourhood)
+        self.assertEqual(records[0]["reasons"], [ "geometry" ])
+        self.assertTrue(records[0]["descendants"])
+
+        self.assertEqual(self.world.snapshot(), self.other.snapshot())
+        self.assertTrue(len(self.parented_by(self.neighbourhood)) < len(before))
+
+    def test_dry_run(self):
+
+        self.shrink()
+        before = self.world.snapshot()
+
+        rsp = self.rebuild(update=False)
+
+        self.assertEqual(self.world.snapshot(), before)
+        self.assertEqual([ r["wof:id"] for r in rsp ], [ self.neighbourhood ])
+        self.assertEqual(rsp[0]["new_parent_id"], before[self.neighbourhood][0])
+
+    def test_unchanged(self):
+
+        # a change that doesn't affect anyone's hierarchy
+
+        feature = self.world.load(self.neighbourhood)
+        feature["properties"]["wof:name"] = "renamed"
+
+        with open(os.path.join(self.repo_path, self.path(self.neighbourhood)), "w") as fh:
+            json.dump(feature, fh)
+
+        self.commit("rename")
+
+        before = self.world.snapshot()
+        rsp = self.rebuild()
+
+        self.assertEqual(rsp[0]["reasons"], [])
+        self.assertFalse(rsp[0]["rebuild"])
+        self.assertEqual(rsp[-1], { "updated": [] })
+
+        self.assertEqual(self.world.snapshot(), before)
+
+    def deleted(self, client):
+
+        self.assertTrue(len(self.parented_by(self.neighbourhood)) > 0)
+
+        git(self.repo_path, "rm", "-q", self.path(self.neighbourhood))
+        self.commit("delete")
+
+        rsp = self.rebuild(client=client)
+
+        self.assertEqual(rsp[0]["status"], "D")
+        self.assertTrue(rsp[0]["descendants"])
+
+        # nothing thinks the neighbourhood is still there, even though the
+        # spatial client was built before it was deleted
+
+        self.assertEqual(self.parented_by(self.neighbourhood), [])
+        self.assertEqual(self.world.snapshot(), self.other.snapshot())
+
+    def test_deleted(self):
+
+        client = mapzen.whosonfirst.hierarchy.spatial.local(data_root=self.world.data_root)
+        self.deleted(client)
+
+    def test_deleted_no_remove(self):
+
+        client = mapzen.whosonfirst.hierarchy.spatial.local(data_root=self.world.data_root)
+        self.deleted(no_remove(client))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mapzen.whosonfirst.placetypes
+
+import mapzen.whosonfirst.hierarchy
+import mapzen.whosonfirst.hierarchy.coverage
+import mapzen.whosonfirst.hierarchy.spatial
+
+import helpers
+
+def pid(placetype):
+
+    return mapzen.whosonfirst.placetypes.placetype(placetype).id()
+
+class coverage_test(unittest.TestCase):
+
+    def setUp(self):
+
+        self.cov = mapzen.whosonfirst.hierarchy.coverage.coverage(cell_size=1.0, max_cells=10)
+
+        self.cov.add_features([
+            helpers.box(40, "locality", (-10, -10, 10, 10), { "locality_id": 40 }),
+            helpers.box(100, "neighbourhood", (2.5, 2.5, 3.5, 3.5), { "locality_id": 40, "neighbourhood_id": 100 }),
+        ])
+
+    def test_covers(self):
+
+        self.assertTrue(self.cov.covers(3.0, 3.0, pid("neighbourhood")))
+        self.assertFalse(self.cov.covers(7.0, 7.0, pid("neighbourhood")))
+
+        # the locality covers too many cells so it's checked by its bounding
+        # box instead
+
+        self.assertEqual(self.cov.cells.get(pid("locality"), None), None)
+
+        self.assertTrue(self.cov.covers(7.0, 7.0, pid("locality")))
+        self.assertFalse(self.cov.covers(20.0, 20.0, pid("locality")))
+
+    def test_not_loaded(self):
+
+        # coverage has never heard of a microhood so they might be anywhere
+
+        self.assertTrue(self.cov.covers(7.0, 7.0, pid("microhood")))
+
+    def test_placetypes(self):
+
+        cov = mapzen.whosonfirst.hierarchy.coverage.coverage(placetypes=[ "neighbourhood", "microhood" ])
+
+        self.assertFalse(cov.add_feature(helpers.box(40, "locality", (-10, -10, 10, 10), { "locality_id": 40 })))
+        self.assertTrue(cov.covers(7.0, 7.0, pid("microhood")))
+
+        # once everything has been loaded a tracked placetype there aren't
+        # any of is nowhere, and untracked placetypes are still everywhere
+
+        data_root = tempfile.mkdtemp()
+
+        try:
+            cov.build(data_root)
+        finally:
+            shutil.rmtree(data_root)
+
+        self.assertFalse(cov.covers(7.0, 7.0, pid("microhood")))
+        self.assertTrue(cov.covers(7.0, 7.0, pid("locality")))
+
+    def test_dump(self):
+
+        tmp = tempfile.mkdtemp()
+        path = os.path.join(tmp, "coverage.json")
+
+        try:
+            self.cov.dump(path)
+
+            cov = mapzen.whosonfirst.hierarchy.coverage.coverage(cell_size=1.0)
+            cov.load(path)
+
+            with self.assertRaises(Exception):
+                mapzen.whosonfirst.hierarchy.coverage.coverage(cell_size=0.5).load(path)
+
+        finally:
+            shutil.rmtree(tmp)
+
+        self.assertEqual(cov.cells, self.cov.cells)
+        self.assertEqual(cov.large, self.cov.large)
+        self.assertEqual(cov.loaded, self.cov.loaded)
+
+        for lat, lon in ((3.0, 3.0), (7.0, 7.0), (20.0, 20.0)):
+
+            for p in ("locality", "neighbourhood", "microhood"):
+                self.assertEqual(cov.covers(lat, lon, pid(p)), self.cov.covers(lat, lon, pid(p)))
+
+class ancestors_coverage_test(unittest.TestCase):
+
+    def setUp(self):
+
+        self.world = helpers.world()
+        self.other = self.world.copy()
+
+        self.country = self.world.placetype("country")[0]["properties"]["wof:id"]
+
+    def tearDown(self):
+
+        self.world.cleanup()
+        self.other.cleanup()
+
+    def rebuild(self, world, **kwargs):
+
+        client = mapzen.whosonfirst.hierarchy.spatial.local(data_root=world.data_root)
+        ancs = mapzen.whosonfirst.hierarchy.ancestors(spatial_client=client, stats=True, **kwargs)
+
+        ancs.rebuild_and_export_feature(world.load(self.country), data_root=world.data_root)
+        return ancs
+
+    def test_coverage(self):
+
+        cov = mapzen.whosonfirst.hierarchy.coverage.coverage(cell_size=0.1, placetypes=[ "neighbourhood", "microhood", "campus" ])
+        cov.build(self.other.data_root)
+
+        self.rebuild(self.world)
+        ancs = self.rebuild(self.other, coverage=cov)
+
+        self.assertEqual(self.world.snapshot(), self.other.snapshot())
+        self.assertTrue(ancs.stats.summary()["counters"]["pip.coverage.skip"] > 0)
+
+if __name__ == "__main__":
+    unittest.main()
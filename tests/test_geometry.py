@@ -0,0 +1,235 @@
+import random
+import unittest
+
+import mapzen.whosonfirst.hierarchy
+import mapzen.whosonfirst.hierarchy.geometry
+import mapzen.whosonfirst.hierarchy.spatial
+
+import helpers
+
+# a concave polygon with a hole in it, and a separate triangle
+
+shape = {
+    "type": "MultiPolygon",
+    "coordinates": [
+        [
+            [ [0, 0], [10, 0], [10, 10], [5, 3], [0, 10], [0, 0] ],
+            [ [1, 1], [3, 1], [3, 3], [1, 3], [1, 1] ],
+        ],
+        [
+            [ [20, 20], [25, 20], [20, 25], [20, 20] ],
+        ],
+    ]
+}
+
+def ids(rows):
+
+    return sorted([ row["properties"]["wof:id"] for pid, row in rows ])
+
+class geometry_test(unittest.TestCase):
+
+    def test_bbox(self):
+
+        self.assertEqual(mapzen.whosonfirst.hierarchy.geometry.bbox(shape), [ 0, 0, 25, 25 ])
+
+        with self.assertRaises(Exception):
+            mapzen.whosonfirst.hierarchy.geometry.bbox({ "type": "Polygon", "coordinates": [] })
+
+    def test_contains(self):
+
+        contains = mapzen.whosonfirst.hierarchy.geometry.contains
+
+        self.assertTrue(contains(shape, 0.5, 0.5))
+        self.assertTrue(contains(shape, 6.0, 9.0))
+        self.assertTrue(contains(shape, 21.0, 21.0))
+
+        # in the hole, in the notch and in the gap between the polygons
+
+        self.assertFalse(contains(shape, 2.0, 2.0))
+        self.assertFalse(contains(shape, 8.0, 5.0))
+        self.assertFalse(contains(shape, 15.0, 15.0))
+
+    def test_contains_many(self):
+
+        rnd = random.Random(1)
+
+        lats = [ rnd.uniform(-1, 26) for i in range(500) ]
+        lons = [ rnd.uniform(-1, 26) for i in range(500) ]
+
+        expected = [ mapzen.whosonfirst.hierarchy.geometry.contains(shape, lats[i], lons[i]) for i in range(500) ]
+        self.assertEqual(mapzen.whosonfirst.hierarchy.geometry.contains_many(shape, lats, lons), expected)
+
+    def test_distance(self):
+
+        distance = mapzen.whosonfirst.hierarchy.geometry.distance
+
+        self.assertEqual(distance(shape, 0.5, 0.5), 0.0)
+        self.assertAlmostEqual(distance(shape, 5.0, -1.0), 1.0)
+        self.assertAlmostEqual(distance(shape, 2.0, 2.0), 1.0)
+
+        self.assertAlmostEqual(distance({ "type": "Point", "coordinates": [ 3, 4 ] }, 0.0, 0.0), 5.0)
+
+    def test_intersects(self):
+
+        intersects = mapzen.whosonfirst.hierarchy.geometry.intersects
+        box = mapzen.whosonfirst.hierarchy.geometry.box
+
+        # crossing edges, but no corners inside each other
+
+        self.assertTrue(intersects(box([ -1, 4, 11, 5 ]), box([ 4, -1, 5, 11 ])))
+
+        self.assertTrue(intersects(shape, box([ 21, 21, 22, 22 ])))
+        self.assertFalse(intersects(shape, box([ 1.5, 1.5, 2.5, 2.5 ])))
+        self.assertFalse(intersects(shape, box([ 30, 30, 31, 31 ])))
+
+class tiling_test(unittest.TestCase):
+
+    def test_tiles(self):
+
+        t = mapzen.whosonfirst.hierarchy.geometry.tiling(shape, 2.5)
+
+        self.assertEqual((t.cols, t.rows), (10, 10))
+        self.assertEqual(t.index(1.0, 6.0), (2, 0))
+        self.assertEqual(t.tile(2, 0), [ 5.0, 0.0, 7.5, 2.5 ])
+
+        # nothing is anywhere near the gap between the polygons
+
+        self.assertTrue((0, 0) in t.tiles())
+        self.assertFalse((6, 6) in t.tiles())
+
+        for i, j in t.inside:
+            self.assertFalse((i, j) in t.boundary)
+
+    def test_contains(self):
+
+        # the same answers as asking the geometry
+
+        rnd = random.Random(3)
+
+        for size in (0.5, 2.5, 7.0, 100.0):
+
+            t = mapzen.whosonfirst.hierarchy.geometry.tiling(shape, size)
+
+            for k in range(2000):
+
+                lat = rnd.uniform(-1, 26)
+                lon = rnd.uniform(-1, 26)
+
+                self.assertEqual(t.contains(lat, lon), mapzen.whosonfirst.hierarchy.geometry.contains(shape, lat, lon), (size, lat, lon))
+
+class box_client:
+
+    # a spatial client that returns everything whose centroid is inside (or
+    # within 'buffer' degrees of) the bounding box of what it's asked about,
+    # and everything it can't place at all
+
+    def __init__(self, rows):
+
+        self.rows = rows
+
+    def intersects_paginated(self, feature, **kwargs):
+
+        b = feature.get("bbox", None) or mapzen.whosonfirst.hierarchy.geometry.bbox(feature["geometry"])
+        buffer = kwargs.get("buffer", None) or 0.0
+
+        for row in self.rows:
+
+            props = row["properties"]
+
+            if not "geom:latitude" in props:
+                yield row
+                continue
+
+            if mapzen.whosonfirst.hierarchy.geometry.bbox_distance(b, props["geom:latitude"], props["geom:longitude"]) <= buffer:
+                yield row
+
+class tiles_test(unittest.TestCase):
+
+    def setUp(self):
+
+        self.root = helpers.box(1, "locality", (0, 0, 10, 10), { "locality_id": 1 })
+        self.root["geometry"] = { "type": "Polygon", "coordinates": shape["coordinates"][0] }
+        self.root["bbox"] = [ 0, 0, 10, 10 ]
+
+        self.venues = [
+            helpers.venue(100, 0.5, 0.5),
+            helpers.venue(101, 6.0, 9.0),
+            helpers.venue(102, 5.0, 5.0),
+            helpers.venue(103, 2.0, 2.0),
+            helpers.venue(104, 5.0, 10.25),
+            helpers.venue(105, -0.25, 5.0),
+            helpers.venue(106, 5.0, 12.0),
+        ]
+
+        # on the line between two tiles
+
+        self.venues.append(helpers.venue(107, 2.5, 5.0))
+
+        unlocated = helpers.venue(108, 0.0, 0.0)
+
+        for k in ("geom:latitude", "geom:longitude"):
+            del(unlocated["properties"][k])
+
+        del(unlocated["geometry"])
+        self.venues.append(unlocated)
+
+        self.ancs = mapzen.whosonfirst.hierarchy.ancestors(spatial_client=box_client(self.venues))
+
+    def rows(self, **kwargs):
+
+        return ids(self.ancs.descendant_rows(self.root, [ "venue" ], query_geometry="tiles", **kwargs))
+
+    def test_tiles(self):
+
+        for size in (0.5, 2.5, 3.0, 100.0):
+            self.assertEqual(self.rows(tile_size=size), [ 100, 101, 107, 108 ])
+
+    def test_buffer(self):
+
+        self.assertEqual(self.rows(tile_size=2.5, buffer=0.5), [ 100, 101, 104, 105, 107, 108 ])
+
+    def test_sharded(self):
+
+        # every row is yielded by exactly one tile
+
+        for buffer in (None, 0.5):
+
+            tiling = mapzen.whosonfirst.hierarchy.geometry.tiling(self.root["geometry"], 2.5)
+            seen = []
+
+            for t in tiling.tiles():
+                seen.extend(self.rows(tile_size=2.5, buffer=buffer, tiling=tiling, tiles=[ t ]))
+
+            self.assertEqual(sorted(seen), self.rows(tile_size=2.5, buffer=buffer))
+
+class local_tiles_test(unittest.TestCase):
+
+    def test_local(self):
+
+        # the same rows as asking about the whole geometry
+
+        world = helpers.world()
+
+        try:
+            client = mapzen.whosonfirst.hierarchy.spatial.local(data_root=world.data_root)
+            ancs = mapzen.whosonfirst.hierarchy.ancestors(spatial_client=client)
+
+            for placetype in ("region", "county"):
+
+                root = world.placetype(placetype)[0]
+                size = (root["bbox"][2] - root["bbox"][0]) / 7.0
+
+                for p in ("locality", "neighbourhood", "venue"):
+
+                    expected = ids(ancs.descendant_rows(root, [ p ]))
+
+                    self.assertTrue(len(expected) > 0)
+
+                    for kwargs in ({ "query_geometry": "bbox" }, { "query_geometry": "tiles", "tile_size": size }):
+                        self.assertEqual(ids(ancs.descendant_rows(root, [ p ], **kwargs)), expected)
+
+        finally:
+            world.cleanup()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,189 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+
+import mapzen.whosonfirst.hierarchy
+import mapzen.whosonfirst.hierarchy.journal
+import mapzen.whosonfirst.hierarchy.spatial
+import mapzen.whosonfirst.hierarchy.writer
+
+import helpers
+
+class crash(Exception):
+    pass
+
+class resume_test(unittest.TestCase):
+
+    def setUp(self):
+
+        self.world = helpers.world()
+        self.other = self.world.copy()
+
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, "journal")
+
+        self.country = self.world.placetype("country")[0]["properties"]["wof:id"]
+
+    def tearDown(self):
+
+        self.world.cleanup()
+        self.other.cleanup()
+
+        shutil.rmtree(self.tmp)
+
+    def rebuild(self, world, **kwargs):
+
+        client = mapzen.whosonfirst.hierarchy.spatial.local(data_root=world.data_root)
+        ancs = mapzen.whosonfirst.hierarchy.ancestors(spatial_client=client)
+
+        return ancs.rebuild_and_export_feature(world.load(self.country), data_root=world.data_root, **kwargs)
+
+    def events(self):
+
+        with open(self.path) as fh:
+            return [ json.loads(ln) for ln in fh if ln.strip() != "" ]
+
+    def resume(self, **kwargs):
+
+        write = mapzen.whosonfirst.hierarchy.writer.writer.write
+        writes = []
+
+        def counting(w, feature):
+            writes.append(feature["properties"]["wof:id"])
+            return write(w, feature)
+
+        with unittest.mock.patch.object(mapzen.whosonfirst.hierarchy.writer.writer, "write", counting):
+            updated = self.rebuild(self.world)
+
+        total = len(writes)
+        writes[:] = []
+
+        def crashing(w, feature):
+
+            writes.append(feature["properties"]["wof:id"])
+
+            if len(writes) == 30:
+                raise crash()
+
+            return write(w, feature)
+
+        with unittest.mock.patch.object(mapzen.whosonfirst.hierarchy.writer.writer, "write", crashing):
+
+            with self.assertRaises(crash):
+                self.rebuild(self.other, journal=self.path, checkpoint_size=5, **kwargs)
+
+        self.assertNotEqual(self.events()[-1]["event"], "done")
+
+        writes[:] = []
+
+        with unittest.mock.patch.object(mapzen.whosonfirst.hierarchy.writer.writer, "write", counting):
+            _updated = self.rebuild(self.other, journal=self.path, checkpoint_size=5, **kwargs)
+
+        # things that were checkpointed (every 5 records) before the crash
+        # aren't done again, and the end result is the same as if nothing
+        # went wrong
+
+        self.assertTrue(len(writes) <= total - 25, "%s of %s records written again" % (len(writes), total))
+        self.assertFalse(self.country in writes)
+
+        self.assertEqual(self.world.snapshot(), self.other.snapshot())
+        self.assertEqual(sorted(updated), sorted(_updated))
+
+        self.assertEqual(self.events()[-1]["event"], "done")
+
+    def test_resume(self):
+
+        self.resume()
+
+    def test_resume_workers(self):
+
+        self.resume(workers=3)
+
+    def test_start_over(self):
+
+        # a journal for a run that finished means starting again
+
+        self.rebuild(self.other, journal=self.path)
+        self.rebuild(self.other, journal=self.path)
+
+        events = self.events()
+
+        self.assertEqual([ e["event"] for e in events ].count("start"), 1)
+        self.assertEqual(events[-1]["event"], "done")
+
+    def test_wrong_root(self):
+
+        self.rebuild(self.other, journal=self.path, checkpoint_size=5)
+
+        with open(self.path, "w") as fh:
+            fh.write(json.dumps({ "event": "start", "root": 1 }) + "\n")
+
+        with self.assertRaises(Exception):
+            self.rebuild(self.other, journal=self.path)
+
+class journal_test(unittest.TestCase):
+
+    def setUp(self):
+
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, "journal")
+
+        self.locality = helpers.box(40, "locality", (-10, -10, 10, 10), { "locality_id": 40 })
+        self.venues = [ helpers.venue(1000 + i, float(i), float(i)) for i in range(5) ]
+
+        self.client = mapzen.whosonfirst.hierarchy.spatial.local(load=False)
+
+        for f in [ self.locality ] + self.venues:
+            self.client.add_feature(f)
+
+        self.client.build()
+
+    def tearDown(self):
+
+        shutil.rmtree(self.tmp)
+
+    def run_journal(self, fail):
+
+        j = mapzen.whosonfirst.hierarchy.journal.journal(self.path, self.locality)
+        seen = []
+
+        def cb(feature):
+            wofid = feature["properties"]["wof:id"]
+            seen.append(wofid)
+            return not wofid in fail
+
+        ancs = mapzen.whosonfirst.hierarchy.ancestors(spatial_client=self.client)
+        ancs.rebuild_descendants(self.locality, cb, journal=j, use_spatial_feature=True, complete_features=True)
+
+        j.finish()
+        return seen
+
+    def test_failed(self):
+
+        # a record whose callback failed isn't journaled so it's the only
+        # thing that's tried again, and the run isn't done until it works
+
+        self.assertEqual(len(self.run_journal(set([ 1002 ]))), 5)
+        self.assertEqual(self.run_journal(set()), [ 1002 ])
+
+        with open(self.path) as fh:
+            events = [ json.loads(ln) for ln in fh ]
+
+        self.assertEqual(events[-1]["event"], "done")
+
+        self.assertEqual(len(self.run_journal(set())), 5)
+
+    def test_partial_line(self):
+
+        self.run_journal(set([ 1002 ]))
+
+        with open(self.path, "a") as fh:
+            fh.write('{"event": "records", "ids": [10')
+
+        self.assertEqual(self.run_journal(set()), [ 1002 ])
+
+if __name__ == "__main__":
+    unittest.main()
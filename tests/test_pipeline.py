@@ -0,0 +1,88 @@
+import threading
+import unittest
+
+import mapzen.whosonfirst.hierarchy
+import mapzen.whosonfirst.hierarchy.pipeline
+import mapzen.whosonfirst.hierarchy.spatial
+
+import helpers
+
+def failing(count):
+
+    for i in range(count):
+        yield i
+
+    raise Exception("failed after %s" % count)
+
+class merge_test(unittest.TestCase):
+
+    def test_merge(self):
+
+        items = list(mapzen.whosonfirst.hierarchy.pipeline.merge([ range(0, 100), range(100, 150), [] ], maxsize=5))
+
+        self.assertEqual(sorted(items), list(range(150)))
+
+    def test_merge_error(self):
+
+        with self.assertRaises(Exception):
+            list(mapzen.whosonfirst.hierarchy.pipeline.merge([ range(100), failing(10) ], maxsize=5))
+
+    def test_merge_stop(self):
+
+        # if the caller stops early the threads are told to stop too, and
+        # whatever they were reading from is closed
+
+        closed = threading.Event()
+
+        def forever():
+
+            try:
+                i = 0
+
+                while True:
+                    yield i
+                    i += 1
+
+            finally:
+                closed.set()
+
+        items = mapzen.whosonfirst.hierarchy.pipeline.merge([ forever() ], maxsize=2)
+
+        self.assertEqual(next(items), 0)
+        items.close()
+
+        self.assertTrue(closed.is_set())
+
+class concurrent_placetypes_test(unittest.TestCase):
+
+    def setUp(self):
+
+        self.world = helpers.world()
+
+    def tearDown(self):
+
+        self.world.cleanup()
+
+    def rebuild(self, world, **kwargs):
+
+        client = mapzen.whosonfirst.hierarchy.spatial.local(data_root=world.data_root)
+        ancs = mapzen.whosonfirst.hierarchy.ancestors(spatial_client=client)
+
+        country = world.placetype("country")[0]
+        return ancs.rebuild_and_export_feature(world.load(country["properties"]["wof:id"]), data_root=world.data_root, **kwargs)
+
+    def test_concurrent_placetypes(self):
+
+        other = self.world.copy()
+
+        try:
+            updated = self.rebuild(self.world)
+            self.assertEqual(self.rebuild(other, concurrent_placetypes=True, maxsize=10), updated)
+
+            self.assertEqual(self.world.snapshot(), other.snapshot())
+
+        finally:
+            other.cleanup()
+
+if __name__ == "__main__":
+    unittest.main()
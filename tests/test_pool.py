@@ -0,0 +1,114 @@
+import functools
+import unittest
+
+import mapzen.whosonfirst.placetypes
+
+import mapzen.whosonfirst.hierarchy
+import mapzen.whosonfirst.hierarchy.pool
+import mapzen.whosonfirst.hierarchy.spatial
+
+import helpers
+
+class pool_test(unittest.TestCase):
+
+    def setUp(self):
+
+        self.world = helpers.world()
+
+    def tearDown(self):
+
+        self.world.cleanup()
+
+    def rebuild(self, world, **kwargs):
+
+        client = mapzen.whosonfirst.hierarchy.spatial.local(data_root=world.data_root)
+        ancs = mapzen.whosonfirst.hierarchy.ancestors(spatial_client=client, stats=kwargs.pop("stats", None))
+
+        country = world.placetype("country")[0]
+        ancs.rebuild_and_export_feature(world.load(country["properties"]["wof:id"]), data_root=world.data_root, **kwargs)
+
+        return ancs
+
+    def test_thread_pool(self):
+
+        other = self.world.copy()
+
+        try:
+            self.rebuild(self.world)
+            self.rebuild(other, workers=3)
+
+            self.assertEqual(self.world.snapshot(), other.snapshot())
+
+        finally:
+            other.cleanup()
+
+    def test_thread_pool_client_factory(self):
+
+        other = self.world.copy()
+        factory = functools.partial(mapzen.whosonfirst.hierarchy.spatial.local, data_root=other.data_root)
+
+        try:
+            self.rebuild(self.world)
+            self.rebuild(other, workers=3, client_factory=factory)
+
+            self.assertEqual(self.world.snapshot(), other.snapshot())
+
+        finally:
+            other.cleanup()
+
+    def test_process_pool(self):
+
+        # and the stats from each process end up in the parent's
+
+        other = self.world.copy()
+        factory = functools.partial(mapzen.whosonfirst.hierarchy.spatial.local, data_root=other.data_root)
+
+        try:
+            serial = self.rebuild(self.world, stats=True)
+            pooled = self.rebuild(other, workers=2, pool="process", client_factory=factory, stats=True)
+
+            self.assertEqual(self.world.snapshot(), other.snapshot())
+
+            s1 = serial.stats.summary()
+            s2 = pooled.stats.summary()
+
+            for k in ("changed", "unchanged", "loaded", "exported"):
+                self.assertEqual(s1["counters"].get(k, 0), s2["counters"].get(k, 0), k)
+
+            self.assertEqual(s1["phases"]["pip"]["count"], s2["phases"]["pip"]["count"])
+
+        finally:
+            other.cleanup()
+
+    def test_process_pool_requires_factory(self):
+
+        ancs = mapzen.whosonfirst.hierarchy.ancestors(spatial_client=None)
+
+        with self.assertRaises(Exception):
+            list(mapzen.whosonfirst.hierarchy.pool.rebuild_descendants(ancs, [], workers=2, pool="process"))
+
+    def test_unsupported_pool(self):
+
+        ancs = mapzen.whosonfirst.hierarchy.ancestors(spatial_client=None)
+
+        with self.assertRaises(Exception):
+            list(mapzen.whosonfirst.hierarchy.pool.rebuild_descendants(ancs, [], workers=2, pool="fiber"))
+
+    def test_order(self):
+
+        # results come back in the same order as the rows they're for, no
+        # matter which one finishes first
+
+        client = mapzen.whosonfirst.hierarchy.spatial.local(data_root=self.world.data_root)
+        ancs = mapzen.whosonfirst.hierarchy.ancestors(spatial_client=client)
+
+        venues = self.world.placetype("venue")
+        pid = mapzen.whosonfirst.placetypes.placetype("venue").id()
+        rows = [ (pid, v) for v in venues ]
+
+        rsp = list(mapzen.whosonfirst.hierarchy.pool.rebuild_descendants(ancs, rows, workers=4, backlog=3, data_root=self.world.data_root))
+
+        self.assertEqual([ r["wof:id"] for r in rsp ], [ v["properties"]["wof:id"] for v in venues ])
+
+if __name__ == "__main__":
+    unittest.main()
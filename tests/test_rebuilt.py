@@ -0,0 +1,94 @@
+import copy
+import unittest
+
+import mapzen.whosonfirst.hierarchy
+import mapzen.whosonfirst.hierarchy.spatial
+
+import helpers
+
+class resolve_locally_test(unittest.TestCase):
+
+    def setUp(self):
+
+        self.world = helpers.world()
+        self.other = self.world.copy()
+
+        self.country = self.world.placetype("country")[0]["properties"]["wof:id"]
+
+    def tearDown(self):
+
+        self.world.cleanup()
+        self.other.cleanup()
+
+    def rebuild(self, world, **kwargs):
+
+        client = mapzen.whosonfirst.hierarchy.spatial.local(data_root=world.data_root)
+        ancs = mapzen.whosonfirst.hierarchy.ancestors(spatial_client=client, stats=True)
+
+        updated = ancs.rebuild_and_export_feature(world.load(self.country), data_root=world.data_root, **kwargs)
+        return ancs, updated
+
+    def test_resolve_locally(self):
+
+        # the same answers as asking the spatial client, but (mostly)
+        # without asking the spatial client
+
+        full, updated = self.rebuild(self.world, top_down=True)
+        local, _updated = self.rebuild(self.other, top_down=True, resolve_locally=True)
+
+        self.assertEqual(self.world.snapshot(), self.other.snapshot())
+        self.assertEqual(sorted(updated), sorted(_updated))
+
+        self.assertFalse("pip.rebuilt" in full.stats.summary()["counters"])
+        self.assertTrue(local.stats.summary()["counters"]["pip.rebuilt"] > 0)
+
+    def test_workers(self):
+
+        self.rebuild(self.world, top_down=True)
+        self.rebuild(self.other, top_down=True, resolve_locally=True, workers=3)
+
+        self.assertEqual(self.world.snapshot(), self.other.snapshot())
+
+    def test_query_geometry(self):
+
+        # descendants found by something other than their geometry might
+        # miss places that overlap the root so it isn't safe to answer
+        # lookups locally
+
+        with self.assertLogs(level="WARNING"):
+            ancs, updated = self.rebuild(self.other, top_down=True, resolve_locally=True, query_geometry="bbox")
+
+        self.assertFalse("pip.rebuilt" in ancs.stats.summary()["counters"])
+
+class straddle_test(unittest.TestCase):
+
+    def test_straddle(self):
+
+        # a neighbourhood whose centroid is outside the locality being
+        # rebuilt but which still contains some of its venues
+
+        places = [
+            helpers.box(1, "country", (-20, -20, 20, 20), { "country_id": 1 }),
+            helpers.box(10, "locality", (0, 0, 10, 10), { "country_id": 1, "locality_id": 10 }),
+            helpers.box(20, "neighbourhood", (8, 4, 14, 6), { "country_id": 1, "locality_id": 10, "neighbourhood_id": 20 }),
+        ]
+
+        venue = helpers.venue(30, 5.0, 9.0)
+
+        client = mapzen.whosonfirst.hierarchy.spatial.local(load=False)
+
+        for f in places + [ venue ]:
+            client.add_feature(f)
+
+        client.build()
+
+        ancs = mapzen.whosonfirst.hierarchy.ancestors(spatial_client=client)
+
+        kwargs = { "top_down": True, "resolve_locally": True, "use_spatial_feature": True, "complete_features": True }
+        rows = ancs.iter_rebuild_descendants(copy.deepcopy(places[1]), **kwargs)
+
+        parents = dict([ (r["wof:id"], r["new_parent_id"]) for r in rows ])
+        self.assertEqual(parents[30], 20)
+
+if __name__ == "__main__":
+    unittest.main()
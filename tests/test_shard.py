@@ -0,0 +1,183 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import mapzen.whosonfirst.hierarchy
+import mapzen.whosonfirst.hierarchy.index
+import mapzen.whosonfirst.hierarchy.shard
+import mapzen.whosonfirst.hierarchy.spatial
+
+import helpers
+
+class queue_test(unittest.TestCase):
+
+    def setUp(self):
+
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, "queue.db")
+
+    def tearDown(self):
+
+        shutil.rmtree(self.tmp)
+
+    def test_claim(self):
+
+        q = mapzen.whosonfirst.hierarchy.shard.queue(self.path, max_attempts=1)
+        q.add([ (0, "locality", 0, 0), (0, "locality", 1, 0), (1, "venue", 0, 0) ])
+
+        a = q.claim("a")
+        b = q.claim("b")
+
+        self.assertEqual((a["placetype"], a["tile"]), ("locality", (0, 0)))
+        self.assertEqual((b["placetype"], b["tile"]), ("locality", (1, 0)))
+
+        # nothing further down the hierarchy is handed out until everything
+        # above it is done
+
+        self.assertEqual(q.claim("c"), None)
+
+        q.done(a, [ "whosonfirst-data-admin-xy" ])
+        self.assertEqual(q.claim("c"), None)
+
+        q.done(b, [ "whosonfirst-data-admin-xy" ])
+
+        c = q.claim("c")
+        self.assertEqual(c["placetype"], "venue")
+
+        q.failed(c, "boom")
+
+        self.assertEqual(q.claim("c"), False)
+
+        self.assertEqual(q.status(), { "done": 2, "failed": 1 })
+        self.assertEqual(q.errors(), [ { "id": c["id"], "placetype": "venue", "tile": (0, 0), "error": "boom" } ])
+        self.assertEqual(q.updated(), [ "whosonfirst-data-admin-xy" ])
+
+    def test_retry(self):
+
+        q = mapzen.whosonfirst.hierarchy.shard.queue(self.path, max_attempts=2)
+        q.add([ (0, "venue", 0, 0) ])
+
+        job = q.claim("a")
+        q.failed(job, "boom")
+
+        job = q.claim("a")
+        self.assertEqual(job["attempts"], 2)
+
+        q.done(job, [])
+
+        self.assertEqual(q.claim("a"), False)
+        self.assertEqual(q.errors(), [])
+
+    def test_lease(self):
+
+        # a job whose worker has gone quiet is handed out again, until it
+        # has been tried too many times
+
+        q = mapzen.whosonfirst.hierarchy.shard.queue(self.path, lease=-1, max_attempts=2)
+        q.add([ (0, "venue", 0, 0) ])
+
+        self.assertEqual(q.claim("a")["attempts"], 1)
+        self.assertEqual(q.claim("b")["attempts"], 2)
+        self.assertEqual(q.claim("c"), False)
+
+        self.assertEqual(q.errors()[0]["error"], "too many attempts")
+
+class shard_test(unittest.TestCase):
+
+    def setUp(self):
+
+        self.world = helpers.world()
+        self.other = self.world.copy()
+
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, "queue.db")
+
+        self.country = self.world.placetype("country")[0]["properties"]["wof:id"]
+
+    def tearDown(self):
+
+        self.world.cleanup()
+        self.other.cleanup()
+
+        shutil.rmtree(self.tmp)
+
+    def ancestors(self, world, **kwargs):
+
+        client = mapzen.whosonfirst.hierarchy.spatial.local(data_root=world.data_root)
+
+        if kwargs.get("index", False):
+
+            idx = mapzen.whosonfirst.hierarchy.index.hierarchy_index()
+            idx.build(world.data_root)
+
+            return mapzen.whosonfirst.hierarchy.ancestors(spatial_client=client, index=idx, stats=True)
+
+        return mapzen.whosonfirst.hierarchy.ancestors(spatial_client=client, stats=True)
+
+    def sharded(self, workers=1, **kwargs):
+
+        index = kwargs.get("descendants_from", "spatial") != "spatial"
+
+        full = self.ancestors(self.world, index=index)
+        updated = full.rebuild_and_export_feature(self.world.load(self.country), data_root=self.world.data_root, **kwargs)
+
+        ancs = self.ancestors(self.other, index=index)
+
+        q = mapzen.whosonfirst.hierarchy.shard.queue(self.path)
+        count = mapzen.whosonfirst.hierarchy.shard.plan(ancs, self.other.load(self.country), q, data_root=self.other.data_root, tile_size=90.0, **kwargs)
+
+        self.assertEqual(q.status(), { "pending": count })
+
+        def work():
+            mapzen.whosonfirst.hierarchy.shard.work(ancs, mapzen.whosonfirst.hierarchy.shard.queue(self.path), poll=0.01)
+
+        threads = [ threading.Thread(target=work) for i in range(workers) ]
+
+        for t in threads:
+            t.start()
+
+        for t in threads:
+            t.join()
+
+        self.assertEqual(q.status(), { "done": count })
+
+        self.assertEqual(self.world.snapshot(), self.other.snapshot())
+        self.assertEqual(sorted(q.updated()), sorted(updated))
+
+        # and nothing was done more than once
+
+        c1 = full.stats.summary()["counters"]
+        c2 = ancs.stats.summary()["counters"]
+
+        for k in ("loaded", "exported"):
+            self.assertEqual(c1[k], c2[k])
+
+    def test_sharded(self):
+
+        self.sharded()
+
+    def test_workers(self):
+
+        self.sharded(workers=3)
+
+    def test_index(self):
+
+        self.sharded(descendants_from="index")
+
+    def test_planned(self):
+
+        ancs = self.ancestors(self.other)
+        q = mapzen.whosonfirst.hierarchy.shard.queue(self.path)
+
+        with self.assertRaises(Exception):
+            mapzen.whosonfirst.hierarchy.shard.plan(ancs, self.other.load(self.country), q)
+
+        mapzen.whosonfirst.hierarchy.shard.plan(ancs, self.other.load(self.country), q, data_root=self.other.data_root, tile_size=90.0)
+
+        with self.assertRaises(Exception):
+            mapzen.whosonfirst.hierarchy.shard.plan(ancs, self.other.load(self.country), q, data_root=self.other.data_root, tile_size=90.0)
+
+if __name__ == "__main__":
+    unittest.main()
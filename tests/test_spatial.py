@@ -0,0 +1,215 @@
+import random
+import unittest
+
+import mapzen.whosonfirst.placetypes
+
+import mapzen.whosonfirst.hierarchy.spatial
+
+import helpers
+
+def filters(placetype, **kwargs):
+
+    f = {
+        "wof:placetype_id": mapzen.whosonfirst.placetypes.placetype(placetype).id(),
+        "wof:is_superseded": 0,
+        "wof:is_deprecated": 0,
+        "wof:is_ceased": 0,
+    }
+
+    f.update(kwargs)
+    return f
+
+def ids(rows):
+
+    return sorted([ r["wof:id"] if "wof:id" in r else r["properties"]["wof:id"] for r in rows ])
+
+class str_tree_test(unittest.TestCase):
+
+    def test_query(self):
+
+        # the tree returns exactly what a brute force search would
+
+        rnd = random.Random(1)
+        entries = []
+
+        for i in range(500):
+
+            x = rnd.uniform(-180, 170)
+            y = rnd.uniform(-90, 80)
+
+            entries.append(([ x, y, x + rnd.uniform(0, 10), y + rnd.uniform(0, 10) ], i))
+
+        tree = mapzen.whosonfirst.hierarchy.spatial.str_tree(entries, node_size=4)
+
+        for i in range(50):
+
+            x = rnd.uniform(-180, 170)
+            y = rnd.uniform(-90, 80)
+            bbox = [ x, y, x + 20, y + 20 ]
+
+            expected = [ item for b, item in entries if b[0] <= bbox[2] and b[2] >= bbox[0] and b[1] <= bbox[3] and b[3] >= bbox[1] ]
+            self.assertEqual(sorted(tree.query(bbox)), sorted(expected))
+
+    def test_empty(self):
+
+        tree = mapzen.whosonfirst.hierarchy.spatial.str_tree([])
+        self.assertEqual(list(tree.query([ -180, -90, 180, 90 ])), [])
+
+class local_test(unittest.TestCase):
+
+    def setUp(self):
+
+        self.places = [
+            helpers.box(40, "locality", (-10, -10, 10, 10), { "locality_id": 40 }),
+            helpers.box(100, "neighbourhood", (-5, -5, 5, 5), { "locality_id": 40, "neighbourhood_id": 100 }),
+            helpers.box(101, "neighbourhood", (3, 3, 8, 8), { "locality_id": 40, "neighbourhood_id": 101 }),
+            helpers.box(102, "neighbourhood", (6, -9, 9, -6), { "locality_id": 40, "neighbourhood_id": 102 }),
+        ]
+
+        self.venues = [
+            helpers.venue(1000, -1.0, -1.0),
+            helpers.venue(1001, 4.0, 4.0),
+            helpers.venue(1002, -7.5, 7.5),
+        ]
+
+        self.client = mapzen.whosonfirst.hierarchy.spatial.local(load=False)
+
+        for f in self.places + self.venues:
+            self.client.add_feature(f)
+
+        self.client.build()
+
+    def test_point_in_polygon(self):
+
+        rows = self.client.point_in_polygon(4.0, 4.0, filters=filters("neighbourhood"), as_feature=True)
+        self.assertEqual(ids(rows), [ 100, 101 ])
+
+        rows = self.client.point_in_polygon(-7.5, 7.5, filters=filters("neighbourhood"))
+        self.assertEqual(ids(rows), [ 102 ])
+
+        rows = self.client.point_in_polygon(20.0, 20.0, filters=filters("locality"))
+        self.assertEqual(ids(rows), [])
+
+    def test_placetype_lists(self):
+
+        pids = [ mapzen.whosonfirst.placetypes.placetype(p).id() for p in ("neighbourhood", "locality") ]
+
+        rows = self.client.point_in_polygon(-1.0, -1.0, filters=filters("locality", **{ "wof:placetype_id": pids }))
+        self.assertEqual(ids(rows), [ 40, 100 ])
+
+    def test_properties(self):
+
+        rows = list(self.client.point_in_polygon(-1.0, -1.0, filters=filters("neighbourhood"), properties=[ "wof:id", "wof:name" ]))
+        self.assertEqual(rows, [ { "wof:id": 100, "wof:name": "neighbourhood 100" } ])
+
+    def test_point_in_polygon_many(self):
+
+        coords = [ (v["properties"]["geom:latitude"], v["properties"]["geom:longitude"]) for v in self.venues ]
+        many = self.client.point_in_polygon_many(coords, filters=filters("neighbourhood"))
+
+        for i in range(len(coords)):
+
+            lat, lon = coords[i]
+            one = self.client.point_in_polygon(lat, lon, filters=filters("neighbourhood"))
+
+            self.assertEqual(ids(many[i]), ids(one))
+
+    def test_status(self):
+
+        superseded = helpers.box(103, "neighbourhood", (-2, -2, 0, 0), { "locality_id": 40, "neighbourhood_id": 103 })
+        superseded["properties"]["wof:superseded_by"] = [ 104 ]
+
+        self.client.index_feature(superseded)
+
+        rows = self.client.point_in_polygon(-1.0, -1.0, filters=filters("neighbourhood"))
+        self.assertEqual(ids(rows), [ 100 ])
+
+    def test_intersects(self):
+
+        locality = self.places[0]
+
+        rows = self.client.intersects(locality, filters=filters("neighbourhood"), check_centroid=True)
+        self.assertEqual(ids(rows), [ 100, 101, 102 ])
+
+        rows = self.client.intersects(self.places[1], filters=filters("venue"), use_centroid=True)
+        self.assertEqual(ids(rows), [ 1000, 1001 ])
+
+        # 101 straddles 100 but its centroid is outside
+
+        rows = self.client.intersects(self.places[1], filters=filters("neighbourhood"))
+        self.assertEqual(ids(rows), [ 100, 101 ])
+
+        rows = self.client.intersects(self.places[1], filters=filters("neighbourhood"), check_centroid=True)
+        self.assertEqual(ids(rows), [ 100 ])
+
+    def test_index_feature(self):
+
+        # things that are (re) indexed show up straight away, before the
+        # tree is rebuilt, and their old versions don't
+
+        moved = helpers.box(101, "neighbourhood", (-9, -9, -8, -8), { "locality_id": 40, "neighbourhood_id": 101 })
+        added = helpers.box(105, "neighbourhood", (-4, -4, -3, -3), { "locality_id": 40, "neighbourhood_id": 105 })
+
+        self.client.index_feature(moved)
+        self.client.index_feature(added)
+
+        self.assertEqual(ids(self.client.point_in_polygon(4.0, 4.0, filters=filters("neighbourhood"))), [ 100 ])
+        self.assertEqual(ids(self.client.point_in_polygon(-8.5, -8.5, filters=filters("neighbourhood"))), [ 101 ])
+        self.assertEqual(ids(self.client.point_in_polygon(-3.5, -3.5, filters=filters("neighbourhood"))), [ 100, 105 ])
+
+        self.client.build()
+
+        self.assertEqual(ids(self.client.point_in_polygon(4.0, 4.0, filters=filters("neighbourhood"))), [ 100 ])
+        self.assertEqual(ids(self.client.point_in_polygon(-3.5, -3.5, filters=filters("neighbourhood"))), [ 100, 105 ])
+
+    def test_remove_feature(self):
+
+        # including something that was indexed but never made it in to the
+        # tree, which should be forgotten about entirely
+
+        added = helpers.box(105, "neighbourhood", (-4, -4, -3, -3), { "locality_id": 40, "neighbourhood_id": 105 })
+        self.client.index_feature(added)
+
+        self.client.remove_feature(105)
+        self.client.remove_feature(101)
+
+        self.assertFalse(105 in self.client.pending)
+
+        self.assertEqual(ids(self.client.point_in_polygon(4.0, 4.0, filters=filters("neighbourhood"))), [ 100 ])
+        self.assertEqual(ids(self.client.point_in_polygon(-3.5, -3.5, filters=filters("neighbourhood"))), [ 100 ])
+
+    def test_bad_feature(self):
+
+        # a record that can't be indexed doesn't leave anything behind
+
+        bad = helpers.box(106, "neighbourhood", (-4, -4, -3, -3), { "locality_id": 40, "neighbourhood_id": 106 })
+        bad["geometry"] = { "type": "Polygon", "coordinates": None }
+
+        try:
+            self.client.index_feature(bad)
+        except Exception:
+            pass
+
+        self.assertFalse(106 in self.client.pending)
+        self.assertFalse(106 in self.client.features)
+
+        self.assertEqual(ids(self.client.point_in_polygon(-3.5, -3.5, filters=filters("neighbourhood"))), [ 100 ])
+
+class local_load_test(unittest.TestCase):
+
+    def test_load(self):
+
+        world = helpers.world()
+
+        try:
+            client = mapzen.whosonfirst.hierarchy.spatial.local(data_root=world.data_root)
+            self.assertEqual(len(client.features), len(world.features))
+
+            client = mapzen.whosonfirst.hierarchy.spatial.local(data_root=world.data_root, placetypes=[ "country" ])
+            self.assertEqual(len(client.features), 1)
+
+        finally:
+            world.cleanup()
+
+if __name__ == "__main__":
+    unittest.main()
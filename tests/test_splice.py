@@ -0,0 +1,140 @@
+import json
+import unittest
+
+import mapzen.whosonfirst.hierarchy
+import mapzen.whosonfirst.hierarchy.benchmark
+import mapzen.whosonfirst.hierarchy.spatial
+
+import helpers
+
+class splice_test(unittest.TestCase):
+
+    def setUp(self):
+
+        # a world where everything is where it should be except that one
+        # locality, and everything below it, thinks it's in a county that
+        # doesn't exist
+
+        self.world = helpers.world(stale=False)
+        self.locality = self.world.placetype("locality")[0]["properties"]["wof:id"]
+
+        for path in self.world.paths():
+
+            with open(path) as fh:
+                feature = json.load(fh)
+
+            stale = False
+
+            for h in feature["properties"]["wof:hierarchy"]:
+
+                if h.get("locality_id", None) == self.locality:
+                    h["county_id"] = 99
+                    stale = True
+
+            if stale:
+
+                with open(path, "w") as fh:
+                    json.dump(feature, fh)
+
+        self.other = self.world.copy()
+
+    def tearDown(self):
+
+        self.world.cleanup()
+        self.other.cleanup()
+
+    def rebuild(self, world, **kwargs):
+
+        client = mapzen.whosonfirst.hierarchy.spatial.local(data_root=world.data_root)
+        ancs = mapzen.whosonfirst.hierarchy.ancestors(spatial_client=client, stats=True)
+
+        updated = ancs.rebuild_and_export_feature(world.load(self.locality), data_root=world.data_root, **kwargs)
+        return ancs, updated
+
+    def test_splice(self):
+
+        full, updated = self.rebuild(self.world)
+        spliced, _updated = self.rebuild(self.other, incremental=True, geometry_changed=False)
+
+        self.assertEqual(self.world.snapshot(), self.other.snapshot())
+        self.assertEqual(sorted(updated), sorted(_updated))
+
+        for parent_id, hierarchy in self.other.snapshot().values():
+
+            for h in hierarchy:
+                self.assertNotEqual(h.get("county_id", None), 99)
+
+        c1 = full.stats.summary()["counters"]
+        c2 = spliced.stats.summary()["counters"]
+
+        # every descendant was spliced rather than looked up, and counted
+
+        self.assertTrue(c2["spliced"] > 0)
+        self.assertEqual(c2["changed"], c1["changed"])
+        self.assertEqual(c2["changed"], c2["exported"])
+        self.assertTrue(full.stats.summary()["phases"]["pip"]["count"] > spliced.stats.summary()["phases"]["pip"]["count"])
+
+    def test_geometry_changed(self):
+
+        # which means the descendants are rebuilt the usual way
+
+        self.rebuild(self.world)
+        ancs, updated = self.rebuild(self.other, incremental=True, geometry_changed=True)
+
+        self.assertEqual(self.world.snapshot(), self.other.snapshot())
+        self.assertFalse("spliced" in ancs.stats.summary()["counters"])
+
+    def test_unchanged(self):
+
+        # once everything has been fixed there is nothing to do except
+        # export the locality itself (see also: skip_check)
+
+        self.rebuild(self.other, incremental=True, geometry_changed=False)
+        before = self.other.snapshot()
+
+        ancs, updated = self.rebuild(self.other, incremental=True, geometry_changed=False)
+
+        self.assertEqual(updated, [ mapzen.whosonfirst.hierarchy.benchmark.admin_repo ])
+        self.assertEqual(self.other.snapshot(), before)
+        self.assertFalse("loaded" in ancs.stats.summary()["counters"])
+
+class hierarchy_splice_test(unittest.TestCase):
+
+    def test_hierarchy_splice(self):
+
+        ancs = mapzen.whosonfirst.hierarchy.ancestors(spatial_client=None)
+
+        old = [ { "country_id": 1, "region_id": 2, "county_id": 3, "locality_id": 4 } ]
+        new = { "country_id": 1, "region_id": 2, "county_id": 5, "locality_id": 4 }
+
+        locality = helpers.box(4, "locality", (0, 0, 1, 1), new)
+        splice = ancs.hierarchy_splice(locality, old)
+
+        self.assertEqual(splice["key"], "locality_id")
+        self.assertEqual(splice["id"], 4)
+        self.assertEqual(splice["hierarchy"], new)
+
+        child = helpers.venue(6, 0.5, 0.5)
+        child["properties"]["wof:parent_id"] = 4
+        child["properties"]["wof:hierarchy"] = [ dict(old[0], venue_id=6) ]
+
+        self.assertTrue(ancs.splice_hierarchy(child, splice))
+        self.assertEqual(child["properties"]["wof:hierarchy"], [ dict(new, venue_id=6) ])
+        self.assertEqual(child["properties"]["wof:parent_id"], 4)
+
+        self.assertFalse(ancs.splice_hierarchy(child, splice))
+
+    def test_ambiguous(self):
+
+        # more than one hierarchy means there's no way to know which chain
+        # goes with which descendant
+
+        ancs = mapzen.whosonfirst.hierarchy.ancestors(spatial_client=None)
+
+        locality = helpers.box(4, "locality", (0, 0, 1, 1), { "county_id": 5, "locality_id": 4 })
+        locality["properties"]["wof:hierarchy"].append({ "county_id": 7, "locality_id": 4 })
+
+        self.assertEqual(ancs.hierarchy_splice(locality, [ { "county_id": 3, "locality_id": 4 } ]), None)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,165 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mapzen.whosonfirst.utils
+
+import mapzen.whosonfirst.hierarchy
+import mapzen.whosonfirst.hierarchy.index
+import mapzen.whosonfirst.hierarchy.writer
+
+import helpers
+
+class recording_client:
+
+    # a spatial client that remembers what it was asked to index, and how
+
+    def __init__(self, **kwargs):
+
+        self.batches = []
+        self.fail = kwargs.get("fail", 0)
+
+    def index_features(self, features, **kwargs):
+
+        if self.fail:
+            self.fail -= 1
+            raise Exception("index failed")
+
+        self.batches.append([ f["properties"]["wof:id"] for f in features ])
+
+    def indexed(self):
+
+        return [ wofid for batch in self.batches for wofid in batch ]
+
+class failing_exporter:
+
+    # fails to export a given WOF ID until wofid is set to None
+
+    def __init__(self, exporter, wofid):
+
+        self.exporter = exporter
+        self.wofid = wofid
+
+    def export_feature(self, feature):
+
+        if feature["properties"]["wof:id"] == self.wofid:
+            raise Exception("export failed")
+
+        return self.exporter.export_feature(feature)
+
+class writer_test(unittest.TestCase):
+
+    def setUp(self):
+
+        self.data_root = tempfile.mkdtemp()
+
+        self.client = recording_client()
+        self.index = mapzen.whosonfirst.hierarchy.index.hierarchy_index()
+
+        self.ancs = mapzen.whosonfirst.hierarchy.ancestors(spatial_client=self.client, index=self.index, stats=True)
+
+        self.venues = [ helpers.venue(1000 + i, 1.0, float(i)) for i in range(10) ]
+
+    def tearDown(self):
+
+        self.index.close()
+        shutil.rmtree(self.data_root)
+
+    def writer(self, **kwargs):
+
+        return mapzen.whosonfirst.hierarchy.writer.writer(self.ancs, data_root=self.data_root, **kwargs)
+
+    def on_disk(self, wofid):
+
+        path = os.path.join(self.data_root, "whosonfirst-data-venue", "data", mapzen.whosonfirst.utils.id2relpath(wofid))
+        return os.path.exists(path)
+
+    def test_unbuffered(self):
+
+        w = self.writer()
+
+        for f in self.venues[0:3]:
+            w.write(f)
+
+        self.assertEqual(self.client.batches, [ [ 1000 ], [ 1001 ], [ 1002 ] ])
+        self.assertTrue(all([ self.on_disk(f["properties"]["wof:id"]) for f in self.venues[0:3] ]))
+
+    def test_batches(self):
+
+        w = self.writer(export_batch_size=4, index_batch_size=3)
+
+        for f in self.venues:
+            w.write(f)
+
+        # nothing is indexed before it has been exported
+
+        for wofid in self.client.indexed():
+            self.assertTrue(self.on_disk(wofid))
+
+        w.flush()
+
+        self.assertEqual(self.client.indexed(), [ f["properties"]["wof:id"] for f in self.venues ])
+        self.assertEqual(self.ancs.stats.summary()["counters"]["exported"], 10)
+
+        for f in self.venues:
+            self.assertNotEqual(self.index.get(f["properties"]["wof:id"]), None)
+
+    def test_disabled(self):
+
+        w = self.writer(export=False, **{ "import": False })
+
+        for f in self.venues:
+            w.write(f)
+
+        w.flush()
+
+        self.assertEqual(self.client.batches, [])
+        self.assertFalse(self.on_disk(1000))
+
+    def test_export_failed(self):
+
+        # only the things that were exported are indexed, and the rest are
+        # tried again the next time around
+
+        w = self.writer(export_batch_size=10, index_batch_size=10)
+
+        exporter = failing_exporter(w.exporter("whosonfirst-data-venue"), 1002)
+        w.exporters["whosonfirst-data-venue"] = exporter
+
+        for f in self.venues[0:5]:
+            w.write(f)
+
+        with self.assertRaises(Exception):
+            w.flush()
+
+        self.assertEqual(self.client.indexed(), [ 1000, 1001 ])
+        self.assertEqual(self.index.get(1002), None)
+        self.assertFalse(self.on_disk(1002))
+        self.assertEqual(self.ancs.stats.summary()["counters"]["exported"], 2)
+
+        exporter.wofid = None
+        w.flush()
+
+        self.assertEqual(self.client.indexed(), [ 1000, 1001, 1002, 1003, 1004 ])
+        self.assertTrue(self.on_disk(1002))
+        self.assertNotEqual(self.index.get(1004), None)
+
+    def test_index_failed(self):
+
+        self.client.fail = 1
+
+        w = self.writer(export_batch_size=3, index_batch_size=3)
+
+        with self.assertRaises(Exception):
+
+            for f in self.venues[0:3]:
+                w.write(f)
+
+        self.assertEqual(self.client.indexed(), [])
+
+        w.flush()
+        self.assertEqual(self.client.indexed(), [ 1000, 1001, 1002 ])
+
+if __name__ == "__main__":
+    unittest.main()